@@ -0,0 +1,144 @@
+import datetime
+import json
+import os
+import queue
+import random
+import sys
+import threading
+import time
+
+# Share of successful thumbnail cache hits and revalidations that are logged;
+# a page view causes hundreds of them and they all look alike
+DEFAULT_HIT_SAMPLE_RATE = 0.1
+
+# Records are written in batches of up to this many, gathered for at most
+# this many seconds after the first one
+WRITE_BATCH_SIZE = 512
+FLUSH_INTERVAL = 0.5
+
+# Records waiting for the writer beyond this are dropped rather than let the
+# backlog grow without bound when the log can't keep up
+MAX_PENDING_RECORDS = 100000
+
+DEFAULT_BACKUP_COUNT = 5
+
+# Successful responses sampled by AccessLog.request: thumbnail cache hits
+# and thumbnail revalidations (304s, which never touch a cache)
+SAMPLED_ROUTES = ('thumbnail',)
+SAMPLED_CACHE_STATUSES = ('memory', 'disk', None)
+
+
+class AccessLog:
+    """JSON-lines access and error log written by a background thread.
+
+    Request threads only build a dict and queue it; encoding and writing
+    happen on the writer thread, which writes records in batches. ``path``
+    of None or ``'-'`` logs to stderr. With ``max_bytes``, the file is
+    rotated once it grows past that size, keeping ``backup_count`` old
+    files as ``path.1`` (newest) to ``path.N``.
+    """
+
+    def __init__(self, path=None, hit_sample_rate=DEFAULT_HIT_SAMPLE_RATE, max_bytes=0,
+                 backup_count=DEFAULT_BACKUP_COUNT):
+        self.path = None if path in (None, '-') else path
+        self.hit_sample_rate = hit_sample_rate
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.dropped = 0
+        self._queue = queue.Queue(MAX_PENDING_RECORDS)
+        self._stream = None
+        self._thread = None
+        if self.path is not None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            self._stream = open(self.path, 'a', encoding='utf-8')
+
+    def request(self, record):
+        """Queue the record of an answered request, sampling routine thumbnail hits.
+
+        Sampled records carry the ``sample_rate`` they were kept at, so a
+        reader can weight them back up.
+        """
+        if (record.get('route') in SAMPLED_ROUTES and record.get('status') in (200, 304)
+                and record.get('cache') in SAMPLED_CACHE_STATUSES and self.hit_sample_rate < 1.0):
+            if random.random() >= self.hit_sample_rate:
+                return
+            record['sample_rate'] = self.hit_sample_rate
+        self._put('info', record)
+
+    def error(self, message, **fields):
+        """Queue an error record; these are never sampled"""
+        fields['message'] = message
+        self._put('error', fields)
+
+    def _put(self, level, fields):
+        record = {'time': datetime.datetime.now().isoformat(timespec='milliseconds'), 'level': level}
+        record.update(fields)
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _write(self, records):
+        data = ''.join(json.dumps(record, ensure_ascii=False, default=str) + '\n' for record in records)
+        stream = self._stream or sys.stderr
+        try:
+            stream.write(data)
+            stream.flush()
+            if self.max_bytes and self._stream is not None and self._stream.tell() >= self.max_bytes:
+                self.rotate()
+        except (OSError, ValueError) as e:
+            self.dropped += len(records)
+            print(f"Error writing access log {self.path}: {e}", file=sys.stderr)
+
+    def rotate(self):
+        """Shift ``path`` to ``path.1``, ``path.1`` to ``path.2`` and so on, and reopen it"""
+        self._stream.close()
+        try:
+            for n in range(self.backup_count - 1, 0, -1):
+                source = f'{self.path}.{n}'
+                if os.path.exists(source):
+                    os.replace(source, f'{self.path}.{n + 1}')
+            if self.backup_count > 0:
+                os.replace(self.path, f'{self.path}.1')
+            else:
+                os.unlink(self.path)
+        finally:
+            self._stream = open(self.path, 'a', encoding='utf-8')
+
+    def run(self):
+        """Write queued records until a None sentinel arrives"""
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + FLUSH_INTERVAL
+            while batch[-1] is not None and len(batch) < WRITE_BATCH_SIZE:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            stopping = batch[-1] is None
+            if stopping:
+                batch.pop()
+            if batch:
+                self._write(batch)
+            if stopping:
+                return
+
+    def start(self):
+        """Run the writer in a background daemon thread"""
+        self._thread = threading.Thread(target=self.run, name='gallery-access-log', daemon=True)
+        self._thread.start()
+        return self._thread
+
+    def stop(self):
+        """Write out everything queued so far and stop the writer"""
+        if self._thread is not None:
+            # The sentinel must not be dropped, so wait for room if need be
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
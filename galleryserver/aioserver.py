@@ -0,0 +1,239 @@
+import asyncio
+import io
+import os
+import re
+import socket
+import sys
+import traceback
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+
+from .pool import SERVICE_UNAVAILABLE_RESPONSE, default_worker_count
+
+# Longest request head (request line plus headers) read from a client
+MAX_HEAD_SIZE = 64 * 1024
+
+# sendfile() hands files to the loop in pieces of this size, each bounded by
+# the connection timeout: a client must take this much per timeout or be cut off
+SENDFILE_CHUNK_SIZE = 256 * 1024
+
+_CONTENT_LENGTH_RE = re.compile(rb'^content-length:[ \t]*(\d+)[ \t]*\r?$', re.IGNORECASE | re.MULTILINE)
+_TRANSFER_ENCODING_RE = re.compile(rb'^transfer-encoding:', re.IGNORECASE | re.MULTILINE)
+
+
+class AsyncConnection:
+    """Socket-like stand-in handed to a request handler by the asyncio engine.
+
+    The handler runs on a worker thread and uses this object both as its
+    ``wfile`` and as its ``connection``. Writes and ``sendfile`` calls are
+    handed to the event loop and return once the transport has taken the
+    data, so a slow client only ever holds up its own handler. Each write
+    and sendfile piece must be taken within ``timeout`` seconds, or the
+    connection is aborted and the handler gets a ConnectionAbortedError,
+    like the socket timeout of the threaded engine.
+    """
+
+    def __init__(self, loop, writer, timeout=None):
+        self.loop = loop
+        self.writer = writer
+        self.timeout = timeout
+        self.head = b''
+        self.requests_handled = 0
+        self.keep_alive = True
+
+    def write(self, data):
+        self._call(self._write(bytes(data)))
+        return len(data)
+
+    async def _write(self, data):
+        self.writer.write(data)
+        await self.writer.drain()
+
+    def flush(self):
+        pass
+
+    def sendfile(self, file, offset=0, count=None):
+        """Same contract as socket.sendfile; zero-copy on plain TCP transports"""
+        if count is None:
+            count = os.fstat(file.fileno()).st_size - offset
+        sent = 0
+        while sent < count:
+            piece = min(SENDFILE_CHUNK_SIZE, count - sent)
+            written = self._call(self.loop.sendfile(self.writer.transport, file, offset + sent, piece))
+            if not written:
+                break
+            sent += written
+        return sent
+
+    def _call(self, coro):
+        if self.loop.is_closed():
+            coro.close()
+            raise ConnectionAbortedError("Server is shutting down")
+        return asyncio.run_coroutine_threadsafe(self._bounded(coro), self.loop).result()
+
+    async def _bounded(self, coro):
+        try:
+            return await asyncio.wait_for(coro, self.timeout)
+        except asyncio.TimeoutError:
+            # A client that stopped reading would otherwise hold its worker forever
+            self.writer.transport.abort()
+            raise ConnectionAbortedError(f"Client took no data for {self.timeout:g}s") from None
+
+
+def async_handler_class(handler_class):
+    """Adapt a socketserver handler class to answer one request from an AsyncConnection"""
+
+    class AsyncRequestHandler(handler_class):
+        def setup(self):
+            self.connection = self.wfile = self.request
+            self.rfile = io.BytesIO(self.request.head)
+            self.requests_handled = self.request.requests_handled
+
+        def handle(self):
+            # Routing, validators and framing are all the regular handler's
+            self.close_connection = True
+            self.handle_one_request()
+            self.request.keep_alive = not self.close_connection
+
+        def finish(self):
+            pass
+
+    return AsyncRequestHandler
+
+
+class AsyncHTTPServer:
+    """HTTP server running every connection on a single asyncio event loop.
+
+    An idle connection costs a coroutine rather than a thread, so thousands
+    of mostly idle browsers (kiosk displays, slideshows) are cheap. Request
+    heads are read on the loop; each request is then answered by the regular
+    handler class on a pool of ``workers`` threads, which keeps PIL and
+    filesystem work off the loop. At most ``queue_size`` more requests wait
+    for a thread; past ``admission_timeout`` seconds they get a 503.
+    """
+
+    request_queue_size = 1024
+
+    def __init__(self, server_address, handler_class, workers=None, queue_size=128,
+                 admission_timeout=5.0, keepalive_timeout=5.0):
+        self.RequestHandlerClass = async_handler_class(handler_class)
+        self.workers = workers or default_worker_count()
+        self.queue_size = queue_size
+        self.admission_timeout = admission_timeout
+        self.keepalive_timeout = keepalive_timeout
+        self.socket = socket.create_server(server_address, backlog=self.request_queue_size)
+        self.server_address = self.socket.getsockname()
+        self._executor = ThreadPoolExecutor(max_workers=self.workers,
+                                            thread_name_prefix='gallery-worker')
+        self._active = 0
+        self._closing = False
+        self._loop = None
+        self._slots = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.server_close()
+
+    @property
+    def pending_requests(self):
+        """Number of requests currently running or waiting for a worker"""
+        return self._active
+
+    @property
+    def active_requests(self):
+        """Number of requests being answered right now; idle connections never count"""
+        return self._active
+
+    @property
+    def queued_requests(self):
+        """Number of admitted requests waiting for a worker thread"""
+        return max(0, self._active - self.workers)
+
+    @property
+    def reclaim_idle_connections(self):
+        """True once the server is shutting down; idle connections hold no worker here"""
+        return self._closing
+
+    def serve_forever(self):
+        asyncio.run(self._serve())
+
+    async def _serve(self):
+        self._loop = asyncio.get_running_loop()
+        self._slots = asyncio.Semaphore(self.workers + self.queue_size)
+        server = await asyncio.start_server(self.handle_connection, sock=self.socket,
+                                            limit=MAX_HEAD_SIZE)
+        async with server:
+            await server.serve_forever()
+
+    async def handle_connection(self, reader, writer):
+        """Read requests off one connection until it closes or idles out"""
+        connection = AsyncConnection(self._loop, writer, self.keepalive_timeout)
+        client_address = writer.get_extra_info('peername')
+        try:
+            while connection.keep_alive and not self._closing:
+                try:
+                    connection.head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'),
+                                                             self.keepalive_timeout)
+                    reusable = await self.discard_request_body(reader, connection.head)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError,
+                        asyncio.LimitOverrunError, ConnectionError):
+                    break
+                connection.requests_handled += 1
+
+                try:
+                    await asyncio.wait_for(self._slots.acquire(), self.admission_timeout)
+                except asyncio.TimeoutError:
+                    writer.write(SERVICE_UNAVAILABLE_RESPONSE)
+                    break
+                self._active += 1
+                try:
+                    await self._loop.run_in_executor(self._executor, self.process_request,
+                                                     connection, client_address)
+                finally:
+                    self._active -= 1
+                    self._slots.release()
+                if not reusable:
+                    break
+        except asyncio.CancelledError:
+            # Server shutdown; end the connection task quietly (the stream
+            # callback logs an error for cancelled connection tasks on 3.11)
+            pass
+        finally:
+            writer.close()
+
+    async def discard_request_body(self, reader, head):
+        """Skip any request body; returns False if the connection can't be reused"""
+        if _TRANSFER_ENCODING_RE.search(head):
+            # Chunked request bodies aren't parsed; answer, then close
+            return False
+        match = _CONTENT_LENGTH_RE.search(head)
+        if match:
+            length = int(match.group(1))
+            if length > MAX_HEAD_SIZE:
+                # Only GET and HEAD are served; don't read uploads just to drop them
+                return False
+            await asyncio.wait_for(reader.readexactly(length), self.keepalive_timeout)
+        return True
+
+    def process_request(self, connection, client_address):
+        """Answer one request on a worker thread"""
+        try:
+            self.RequestHandlerClass(connection, client_address, self)
+        except (ConnectionError, CancelledError):
+            connection.keep_alive = False
+        except Exception:
+            connection.keep_alive = False
+            self.handle_error(client_address)
+
+    def handle_error(self, client_address):
+        """Print the traceback of a failed request, like socketserver does"""
+        print('-' * 40, file=sys.stderr)
+        print('Exception occurred during processing of request from', client_address, file=sys.stderr)
+        traceback.print_exc()
+        print('-' * 40, file=sys.stderr)
+
+    def server_close(self):
+        self._closing = True
+        self.socket.close()
+        self._executor.shutdown(wait=True)
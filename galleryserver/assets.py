@@ -0,0 +1,834 @@
+import hashlib
+
+from .compression import compress, supported_encodings
+
+# Versioned asset URLs live under this prefix and never change content
+ASSET_PREFIX = '/__gallery/'
+
+GALLERY_CSS = '''* {
+    margin: 0;
+    padding: 0;
+    box-sizing: border-box;
+}
+
+body { 
+    font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, Oxygen, Ubuntu, Cantarell, sans-serif;
+    background: linear-gradient(135deg, #1a1a2e 0%, #16213e 50%, #0f3460 100%);
+    min-height: 100vh;
+    color: #e0e0e0;
+}
+
+.header {
+    background: rgba(30, 30, 50, 0.95);
+    backdrop-filter: blur(10px);
+    padding: 20px;
+    margin-bottom: 30px;
+    box-shadow: 0 4px 20px rgba(0, 0, 0, 0.3);
+    border-bottom: 1px solid rgba(255, 255, 255, 0.1);
+}
+
+h1 { 
+    color: #ffffff;
+    font-size: clamp(1.5rem, 4vw, 2.5rem);
+    font-weight: 700;
+    text-align: center;
+    margin-bottom: 10px;
+}
+
+.breadcrumb {
+    text-align: center;
+    color: #b0b0b0;
+    font-size: 0.9rem;
+}
+
+.sort-links {
+    text-align: center;
+    color: #b0b0b0;
+    font-size: 0.9rem;
+    margin-bottom: 20px;
+}
+
+.sort-links a {
+    color: #4facfe;
+    text-decoration: none;
+    margin: 0 6px;
+}
+
+.sort-links a.active {
+    color: white;
+    font-weight: 600;
+}
+
+.parent-button {
+    display: block;
+    width: 100%;
+    max-width: 300px;
+    margin: 20px auto;
+    padding: 15px 25px;
+    background: linear-gradient(135deg, #4facfe 0%, #00f2fe 100%);
+    color: white;
+    text-decoration: none;
+    border-radius: 50px;
+    font-size: 16px;
+    font-weight: 600;
+    text-align: center;
+    transition: all 0.3s ease;
+    box-shadow: 0 4px 15px rgba(79, 172, 254, 0.3);
+}
+
+.parent-button:hover {
+    transform: translateY(-2px);
+    box-shadow: 0 8px 25px rgba(79, 172, 254, 0.4);
+}
+
+.parent-button.disabled {
+    background: #444;
+    color: #888;
+    cursor: not-allowed;
+    box-shadow: none;
+}
+
+.parent-button.disabled:hover {
+    transform: none;
+    box-shadow: none;
+}
+
+.container {
+    max-width: 1400px;
+    margin: 0 auto;
+    padding: 0 20px;
+}
+
+.grid {
+    display: grid;
+    grid-template-columns: repeat(auto-fill, minmax(280px, 1fr));
+    gap: 25px;
+    margin-bottom: 40px;
+}
+
+.item {
+    background: rgba(45, 45, 70, 0.95);
+    backdrop-filter: blur(10px);
+    border-radius: 16px;
+    overflow: hidden;
+    box-shadow: 0 8px 32px rgba(0, 0, 0, 0.4);
+    transition: all 0.3s cubic-bezier(0.4, 0, 0.2, 1);
+    border: 1px solid rgba(255, 255, 255, 0.1);
+}
+
+.item:hover {
+    transform: translateY(-8px) scale(1.02);
+    box-shadow: 0 20px 40px rgba(0, 0, 0, 0.6);
+    border-color: rgba(79, 172, 254, 0.3);
+}
+
+.thumbnail-container {
+    position: relative;
+    width: 100%;
+    height: 220px;
+    overflow: hidden;
+    background: linear-gradient(45deg, #2c2c3e, #1a1a2e);
+    cursor: pointer;
+}
+
+.thumbnail {
+    width: 100%;
+    height: 100%;
+    object-fit: cover;
+    transition: transform 0.3s ease, opacity 0.3s ease;
+}
+
+.item:hover .thumbnail {
+    transform: scale(1.1);
+}
+
+/* A cell of a sprite sheet, sized to cover the tile like object-fit does */
+.thumbnail.sprite-tile {
+    position: absolute;
+    top: 50%;
+    left: 50%;
+    translate: -50% -50%;
+    width: max(100%, 330px);
+    height: auto;
+    aspect-ratio: 3 / 2;
+    background-repeat: no-repeat;
+}
+
+.item-content {
+    padding: 20px;
+}
+
+.filename {
+    font-size: 16px;
+    font-weight: 600;
+    color: #ffffff;
+    text-decoration: none;
+    display: block;
+    margin-bottom: 8px;
+    word-break: break-word;
+    line-height: 1.4;
+}
+
+.filename:hover {
+    color: #4facfe;
+}
+
+.directory {
+    display: flex;
+    flex-direction: column;
+    align-items: center;
+    justify-content: center;
+    height: 220px;
+    font-size: 18px;
+    font-weight: 600;
+    color: white;
+    text-decoration: none;
+    background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
+    transition: all 0.3s ease;
+}
+
+.directory:hover {
+    background: linear-gradient(135deg, #5a67d8 0%, #667eea 100%);
+}
+
+.directory-icon {
+    font-size: 3rem;
+    margin-bottom: 10px;
+    display: block;
+}
+
+.file-info {
+    font-size: 13px;
+    color: #b0b0b0;
+    display: flex;
+    justify-content: space-between;
+    align-items: center;
+}
+
+.file-type {
+    background: rgba(79, 172, 254, 0.2);
+    color: #4facfe;
+    padding: 4px 8px;
+    border-radius: 12px;
+    font-size: 11px;
+    font-weight: 500;
+    text-transform: uppercase;
+    letter-spacing: 0.5px;
+    border: 1px solid rgba(79, 172, 254, 0.3);
+}
+
+.image-overlay {
+    position: absolute;
+    top: 10px;
+    right: 10px;
+    background: rgba(0, 0, 0, 0.8);
+    color: white;
+    padding: 4px 8px;
+    border-radius: 12px;
+    font-size: 12px;
+    font-weight: 500;
+}
+
+.loading {
+    position: absolute;
+    top: 50%;
+    left: 50%;
+    transform: translate(-50%, -50%);
+    color: #888;
+    font-size: 14px;
+}
+
+@media (max-width: 768px) {
+    .grid {
+        grid-template-columns: repeat(auto-fill, minmax(250px, 1fr));
+        gap: 20px;
+    }
+
+    .header {
+        padding: 15px;
+        margin-bottom: 20px;
+    }
+
+    .container {
+        padding: 0 15px;
+    }
+
+    .thumbnail-container {
+        height: 180px;
+    }
+
+    .thumbnail.sprite-tile {
+        width: max(100%, 270px);
+    }
+
+    .item-content {
+        padding: 15px;
+    }
+}
+
+@media (max-width: 480px) {
+    .grid {
+        grid-template-columns: repeat(auto-fill, minmax(200px, 1fr));
+        gap: 15px;
+    }
+
+    .thumbnail-container {
+        height: 160px;
+    }
+
+    .thumbnail.sprite-tile {
+        width: max(100%, 240px);
+    }
+}
+
+.fade-in {
+    animation: fadeIn 0.6s ease-out;
+}
+
+@keyframes fadeIn {
+    from {
+        opacity: 0;
+        transform: translateY(20px);
+    }
+    to {
+        opacity: 1;
+        transform: translateY(0);
+    }
+}
+
+.no-items {
+    text-align: center;
+    padding: 60px 20px;
+    color: #b0b0b0;
+    font-size: 18px;
+    background: rgba(45, 45, 70, 0.9);
+    border-radius: 16px;
+    margin: 20px;
+    border: 1px solid rgba(255, 255, 255, 0.1);
+}
+
+.grid-sentinel {
+    height: 1px;
+}
+
+/* Image Modal */
+.modal {
+    display: none;
+    position: fixed;
+    z-index: 10000;
+    padding-top: 60px;
+    left: 0;
+    top: 0;
+    width: 100%;
+    height: 100%;
+    overflow: hidden;
+    background: rgba(0,0,0,0.9);
+    touch-action: none;
+}
+
+.modal-inner {
+    width: 100%;
+    height: 100%;
+    display: flex;
+    align-items: center;
+    justify-content: center;
+    position: relative;
+}
+
+.modal-content {
+    margin: auto;
+    display: block;
+    max-width: 90%;
+    max-height: 80vh;
+    transition: transform 0.2s ease;
+    will-change: transform;
+    cursor: grab;
+    touch-action: none;
+}
+
+.modal-content.grabbing {
+    cursor: grabbing;
+}
+
+.close {
+    position: absolute;
+    top: 20px;
+    right: 40px;
+    color: #fff;
+    font-size: 40px;
+    font-weight: bold;
+    cursor: pointer;
+    z-index: 10001;
+}
+
+.prev, .next {
+    cursor: pointer;
+    position: absolute;
+    top: 50%;
+    padding: 16px;
+    margin-top: -50px;
+    color: #fff;
+    font-weight: bold;
+    font-size: 40px;
+    user-select: none;
+    z-index: 10001;
+    background: rgba(0,0,0,0.2);
+    border-radius: 6px;
+}
+
+.prev { left: 10px; }
+.next { right: 10px; }
+
+.modal-caption {
+    text-align: center;
+    color: #bbb;
+    margin-top: 10px;
+    position: absolute;
+    bottom: 24px;
+    left: 50%;
+    transform: translateX(-50%);
+    z-index: 10001;
+    font-size: 14px;
+}
+
+.modal-controls {
+    position: absolute;
+    top: 20px;
+    left: 40px;
+    z-index: 10001;
+    display: flex;
+    gap: 10px;
+    align-items: center;
+}
+
+.control-btn {
+    background: rgba(255,255,255,0.06);
+    color: #fff;
+    padding: 8px 12px;
+    border-radius: 8px;
+    font-size: 14px;
+    cursor: pointer;
+    border: 1px solid rgba(255,255,255,0.06);
+}
+
+.control-btn.playing {
+    background: rgba(79, 172, 254, 0.95);
+    color: #04213a;
+    border-color: rgba(79,172,254,0.7);
+}
+
+@media (max-width: 480px) {
+    .close { right: 20px; font-size: 36px; top: 14px; }
+    .prev, .next { font-size: 32px; padding: 12px; }
+    .modal-caption { font-size: 13px; bottom: 18px; }
+}
+'''
+
+GALLERY_JS = '''(function(){
+    // Utilities
+    const q = s => document.querySelector(s);
+    const qa = s => Array.from(document.querySelectorAll(s));
+
+    document.addEventListener("DOMContentLoaded", function () {
+        // Fade-in stagger
+        const items = document.querySelectorAll(".fade-in");
+        items.forEach((item, index) => {
+            item.style.animationDelay = (index * 0.1) + "s";
+        });
+
+        // Lazy thumb animations
+        function wireThumbnailLoad(img) {
+            // Sprite tiles are backgrounds, with no load event of their own
+            if (img.tagName !== "IMG") return;
+            img.addEventListener("load", function () { this.style.opacity = "1"; });
+            img.addEventListener("error", function () { this.style.display = "none"; this.nextElementSibling.style.display = "block"; });
+            img.style.opacity = "0";
+            img.style.transition = "opacity 0.3s ease";
+        }
+        qa(".thumbnail").forEach(wireThumbnailLoad);
+
+        // Modal elements
+        const modal = q("#imgModal");
+        const modalImg = q("#modalImg");
+        const modalCaption = q("#modalCaption");
+        const closeBtn = q("#modalClose");
+        const prevBtn = q("#modalPrev");
+        const nextBtn = q("#modalNext");
+        const slideshowBtn = q("#slideshowBtn");
+        const zoomResetBtn = q("#zoomResetBtn");
+
+        const thumbnails = qa(".thumbnail");
+        let currentIndex = 0;
+
+        // Zoom & pan state
+        let scale = 1, minScale = 1, maxScale = 5;
+        let translateX = 0, translateY = 0;
+        let isPanning = false, startX = 0, startY = 0;
+
+        // Slideshow state
+        let slideshowInterval = null;
+        const SLIDE_DELAY = 3000; // 3s per slide
+
+        function resetTransform() {
+            scale = 1; translateX = 0; translateY = 0;
+            applyTransform();
+        }
+
+        function applyTransform() {
+            modalImg.style.transform = `translate(${translateX}px, ${translateY}px) scale(${scale})`;
+            if (scale > 1 && modalImg.dataset.full && modalImg.getAttribute("src") !== modalImg.dataset.full) {
+                modalImg.src = modalImg.dataset.full;
+            }
+        }
+
+        function openModal(index) {
+            if (thumbnails.length === 0) return;
+            currentIndex = (index + thumbnails.length) % thumbnails.length;
+            const thumb = thumbnails[currentIndex];
+            const full = thumb.dataset.full || thumb.src;
+            // Show the screen-sized preview; the original loads once the user zooms in
+            modalImg.dataset.full = full;
+            modalImg.src = thumb.dataset.preview || full;
+            const label = thumb.alt || thumb.getAttribute("aria-label") || "";
+            modalImg.alt = label;
+            modalCaption.textContent = label;
+            modal.style.display = "block";
+            modal.setAttribute("aria-hidden", "false");
+            resetTransform();
+            // focus for keyboard events
+            setTimeout(()=> modal.focus && modal.focus(), 50);
+        }
+
+        function closeModal() {
+            modal.style.display = "none";
+            modal.setAttribute("aria-hidden", "true");
+            stopSlideshow();
+        }
+
+        function showNext() {
+            openModal(currentIndex + 1);
+        }
+
+        function showPrev() {
+            openModal(currentIndex - 1);
+        }
+
+        // Thumbnail handlers
+        function wireThumbnail(thumb) {
+            // Single click → modal open
+            thumb.addEventListener("click", function (event) {
+                event.preventDefault();
+                openModal(thumbnails.indexOf(thumb));
+            });
+
+            // Double-click → open image in new tab
+            thumb.addEventListener("dblclick", function (event) {
+                event.preventDefault();
+                const href = thumb.parentElement.parentElement.href || thumb.dataset.full || thumb.src;
+                window.open(href, "_blank");
+            });
+        }
+        thumbnails.forEach(wireThumbnail);
+
+        // Modal button events
+        closeBtn.addEventListener("click", closeModal);
+        prevBtn.addEventListener("click", showPrev);
+        nextBtn.addEventListener("click", showNext);
+
+        // Keyboard navigation (← → Esc) and space toggles slideshow
+        document.addEventListener("keydown", function(e) {
+            if (modal.style.display !== "block") return;
+            if (e.key === "ArrowRight") { showNext(); }
+            else if (e.key === "ArrowLeft") { showPrev(); }
+            else if (e.key === "Escape") { closeModal(); }
+            else if (e.key === " " || e.key === "Spacebar") { // space toggles slideshow
+                e.preventDefault();
+                toggleSlideshow();
+            }
+        });
+
+        // Slideshow controls
+        function startSlideshow() {
+            if (slideshowInterval) return;
+            slideshowBtn.classList.add("playing");
+            slideshowBtn.textContent = "⏸ Pause";
+            slideshowInterval = setInterval(showNext, SLIDE_DELAY);
+        }
+        function stopSlideshow() {
+            if (!slideshowInterval) return;
+            slideshowBtn.classList.remove("playing");
+            slideshowBtn.textContent = "▶ Play";
+            clearInterval(slideshowInterval); slideshowInterval = null;
+        }
+        function toggleSlideshow() {
+            if (slideshowInterval) stopSlideshow(); else startSlideshow();
+        }
+        slideshowBtn.addEventListener("click", toggleSlideshow);
+        // Reset zoom button
+        zoomResetBtn.addEventListener("click", resetTransform);
+
+        // Click on modal image toggles fullscreen
+        modalImg.addEventListener("click", function(e) {
+            // If image is zoomed (scale>1), do nothing on click to avoid accidental fullscreen toggle
+            if (Math.abs(scale - 1) > 0.01) return;
+            toggleFullScreen();
+        });
+
+        // Fullscreen helpers
+        function toggleFullScreen() {
+            if (!document.fullscreenElement) {
+                if (modal.requestFullscreen) modal.requestFullscreen();
+                else if (modal.webkitRequestFullscreen) modal.webkitRequestFullscreen();
+            } else {
+                if (document.exitFullscreen) document.exitFullscreen();
+                else if (document.webkitExitFullscreen) document.webkitExitFullscreen();
+            }
+        }
+
+        // Mouse wheel for zoom (desktop)
+        modalImg.addEventListener("wheel", function(e) {
+            if (modal.style.display !== "block") return;
+            e.preventDefault();
+            const delta = -e.deltaY || e.wheelDelta;
+            const zoomFactor = delta > 0 ? 1.08 : 0.92;
+            const newScale = Math.min(maxScale, Math.max(minScale, scale * zoomFactor));
+            // adjust translate so zoom is centered at mouse position
+            const rect = modalImg.getBoundingClientRect();
+            const mx = e.clientX - rect.left;
+            const my = e.clientY - rect.top;
+            const dx = (mx - translateX) / scale;
+            const dy = (my - translateY) / scale;
+            translateX = mx - dx * newScale;
+            translateY = my - dy * newScale;
+            scale = newScale;
+            applyTransform();
+        }, { passive: false });
+
+        // Drag to pan (mouse)
+        modalImg.addEventListener("mousedown", function(e) {
+            if (scale <= 1) return;
+            isPanning = true;
+            startX = e.clientX - translateX;
+            startY = e.clientY - translateY;
+            modalImg.classList.add("grabbing");
+        });
+        document.addEventListener("mousemove", function(e) {
+            if (!isPanning) return;
+            translateX = e.clientX - startX;
+            translateY = e.clientY - startY;
+            applyTransform();
+        });
+        document.addEventListener("mouseup", function() {
+            isPanning = false; modalImg.classList.remove("grabbing");
+        });
+
+        // Touch handling: pan, swipe, pinch-zoom
+        let touchStartX = 0, touchStartY = 0, touchStartTime = 0;
+        let lastTouchDistance = null;
+        let isTouchPanning = false;
+
+        modalImg.addEventListener("touchstart", function(e) {
+            if (e.touches.length === 1) {
+                touchStartX = e.touches[0].clientX;
+                touchStartY = e.touches[0].clientY;
+                touchStartTime = Date.now();
+                isTouchPanning = (scale > 1);
+                startX = e.touches[0].clientX - translateX;
+                startY = e.touches[0].clientY - translateY;
+                lastTouchDistance = null;
+            } else if (e.touches.length === 2) {
+                lastTouchDistance = Math.hypot(
+                    e.touches[0].clientX - e.touches[1].clientX,
+                    e.touches[0].clientY - e.touches[1].clientY
+                );
+            }
+        }, { passive: false });
+
+        modalImg.addEventListener("touchmove", function(e) {
+            if (e.touches.length === 1 && isTouchPanning) {
+                e.preventDefault();
+                translateX = e.touches[0].clientX - startX;
+                translateY = e.touches[0].clientY - startY;
+                applyTransform();
+            } else if (e.touches.length === 2) {
+                e.preventDefault();
+                const dist = Math.hypot(
+                    e.touches[0].clientX - e.touches[1].clientX,
+                    e.touches[0].clientY - e.touches[1].clientY
+                );
+                if (lastTouchDistance) {
+                    const zoomFactor = dist / lastTouchDistance;
+                    const newScale = Math.min(maxScale, Math.max(minScale, scale * zoomFactor));
+                    // center between touches
+                    const rect = modalImg.getBoundingClientRect();
+                    const mx = (e.touches[0].clientX + e.touches[1].clientX)/2 - rect.left;
+                    const my = (e.touches[0].clientY + e.touches[1].clientY)/2 - rect.top;
+                    const dx = (mx - translateX) / scale;
+                    const dy = (my - translateY) / scale;
+                    translateX = mx - dx * newScale;
+                    translateY = my - dy * newScale;
+                    scale = newScale;
+                    applyTransform();
+                }
+                lastTouchDistance = dist;
+            }
+        }, { passive: false });
+
+        modalImg.addEventListener("touchend", function(e) {
+            // detect swipe left/right for quick navigation when not zooming
+            if (e.changedTouches.length === 1 && Math.abs(scale - 1) < 0.01) {
+                const dx = e.changedTouches[0].clientX - touchStartX;
+                const dt = Date.now() - touchStartTime;
+                if (dt < 500 && Math.abs(dx) > 60) {
+                    if (dx < 0) showNext(); else showPrev();
+                } else {
+                    // detect single tap vs double-tap for fullscreen toggle or open in new tab
+                    const target = e.target;
+                    // single tap: open fullscreen if not zoomed
+                }
+            }
+            // reset pinch state
+            lastTouchDistance = null; isTouchPanning = false;
+        });
+
+        // Double-tap to zoom (mobile)
+        let lastTap = 0;
+        modalImg.addEventListener("touchend", function(e) {
+            const currentTime = Date.now();
+            const tapLength = currentTime - lastTap;
+            if (tapLength < 300 && tapLength > 0) {
+                // double tap -> toggle zoom between min and 2x (or maxScale)
+                if (scale <= 1.01) scale = Math.min(2, maxScale);
+                else scale = 1;
+                applyTransform();
+            }
+            lastTap = currentTime;
+        });
+
+        // Prevent gestures outside modal from scrolling the body while modal open
+        modal.addEventListener("touchmove", function(e){ if (modal.style.display === "block") e.preventDefault(); }, { passive:false });
+
+        // Accessibility: close on focus loss (optional) and trap focus could be added later
+
+        // Close when clicking outside image (but allow clicks on controls)
+        modal.addEventListener("click", function(e) {
+            if (e.target === modal) closeModal();
+        });
+
+        // Clean up image transforms when an image fails to load
+        modalImg.addEventListener("error", function(){
+            // A preview the server can't render falls back to the original
+            if (modalImg.dataset.full && modalImg.getAttribute("src") !== modalImg.dataset.full) {
+                modalImg.src = modalImg.dataset.full;
+                return;
+            }
+            resetTransform();
+        });
+
+
+        // Windowed loading: fetch the rest of large folders from the JSON listing API
+        const grid = q(".grid");
+        const sentinel = q("#gridSentinel");
+        const esc = s => String(s).replace(/[&<>"']/g, c => ({"&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;", "'": "&#x27;"})[c]);
+
+        function tileHtml(e) {
+            const name = esc(e.name);
+            if (e.type === "directory") {
+                return `<div class="item fade-in"><a href="${esc(e.url)}" class="directory">` +
+                    `<span class="directory-icon">📁</span><div>${name}</div></a></div>`;
+            }
+            if (e.type === "image" && e.sprite) {
+                const style = `background-image: url('${e.sprite.url}'); background-size: ${e.sprite.size}; background-position: ${e.sprite.position}`;
+                return `<div class="item fade-in"><a href="${esc(e.url)}" target="_blank">` +
+                    `<div class="thumbnail-container"><div class="thumbnail sprite-tile" role="img" aria-label="${name}" style="${esc(style)}" ` +
+                    `data-preview="${esc(e.preview)}" data-full="${esc(e.url)}"></div><div class="image-overlay">${esc(e.ext)}</div></div>` +
+                    `<div class="item-content"><div class="filename">${name}</div><div class="file-info">` +
+                    `<span>${esc(e.size_text)}</span><span class="file-type">Image</span></div></div></a></div>`;
+            }
+            if (e.type === "image") {
+                return `<div class="item fade-in"><a href="${esc(e.url)}" target="_blank">` +
+                    `<div class="thumbnail-container"><img src="${esc(e.thumb)}" srcset="${esc(e.srcset)}" sizes="${esc(e.sizes)}" ` +
+                    `data-preview="${esc(e.preview)}" data-full="${esc(e.url)}" alt="${name}" class="thumbnail" loading="lazy">` +
+                    `<div class="loading" style="display: none;">🖼️ Image unavailable</div><div class="image-overlay">${esc(e.ext)}</div></div>` +
+                    `<div class="item-content"><div class="filename">${name}</div><div class="file-info">` +
+                    `<span>${esc(e.size_text)}</span><span class="file-type">Image</span></div></div></a></div>`;
+            }
+            const isText = e.type === "text";
+            return `<div class="item fade-in"><a href="${esc(e.url)}"${isText ? "" : " target=\\"_blank\\""}>` +
+                `<div class="thumbnail-container"><div class="directory" style="background: linear-gradient(135deg, #6c5ce7 0%, #a29bfe 100%);">` +
+                `<span class="directory-icon">${esc(e.icon)}</span><div>${esc(e.ext)}</div></div></div>` +
+                `<div class="item-content"><div class="filename">${name}</div><div class="file-info">` +
+                `<span>${esc(e.size_text)}</span><span class="file-type">${isText ? "Text" : "File"}</span></div></div></a></div>`;
+        }
+
+        function appendWindow(entries) {
+            const holder = document.createElement("div");
+            holder.innerHTML = entries.map(tileHtml).join("");
+            Array.from(holder.children).forEach((item, index) => {
+                item.style.animationDelay = Math.min(index * 0.02, 0.5) + "s";
+                grid.appendChild(item);
+                item.querySelectorAll(".thumbnail").forEach(img => {
+                    thumbnails.push(img);
+                    wireThumbnailLoad(img);
+                    wireThumbnail(img);
+                });
+            });
+        }
+
+        if (sentinel && grid && "IntersectionObserver" in window) {
+            let nextOffset = parseInt(sentinel.dataset.offset, 10);
+            const limit = parseInt(sentinel.dataset.limit, 10);
+            let loading = false;
+            const observer = new IntersectionObserver(function (observed) {
+                if (!observed[0].isIntersecting || loading) return;
+                loading = true;
+                const sort = sentinel.dataset.sort ? `&sort=${encodeURIComponent(sentinel.dataset.sort)}` : "";
+                fetch(`?list=json&offset=${nextOffset}&limit=${limit}${sort}`)
+                    .then(response => response.json())
+                    .then(data => {
+                        appendWindow(data.entries);
+                        nextOffset = data.offset + data.entries.length;
+                        loading = false;
+                        if (nextOffset >= data.total || data.entries.length === 0) {
+                            observer.disconnect();
+                            sentinel.remove();
+                        } else {
+                            // Re-observe so a sentinel that is still on screen fires again
+                            observer.unobserve(sentinel);
+                            observer.observe(sentinel);
+                        }
+                    })
+                    .catch(() => { loading = false; });
+            }, { rootMargin: "1000px 0px" });
+            observer.observe(sentinel);
+        }
+    });
+})();
+'''
+
+
+class StaticAsset:
+    """A static file built once at startup and served with far-future caching.
+
+    The URL embeds a digest of the content, so a changed asset gets a new URL
+    and the old one can be cached forever. A variant for every supported
+    content coding is compressed up front so requests never pay for it.
+    """
+
+    def __init__(self, name, content_type, text):
+        self.content_type = content_type
+        self.body = text.encode('utf-8')
+        self.digest = hashlib.sha256(self.body).hexdigest()[:12]
+        stem, ext = name.rsplit('.', 1)
+        self.url = f'{ASSET_PREFIX}{stem}.{self.digest}.{ext}'
+        self.etag = f'"{self.digest}"'
+        self.compressed = {coding: compress(self.body, coding) for coding in supported_encodings()}
+
+
+GALLERY_CSS_ASSET = StaticAsset('gallery.css', 'text/css; charset=utf-8', GALLERY_CSS)
+GALLERY_JS_ASSET = StaticAsset('gallery.js', 'text/javascript; charset=utf-8', GALLERY_JS)
+
+ASSETS = {asset.url: asset for asset in (GALLERY_CSS_ASSET, GALLERY_JS_ASSET)}
+
+# Changes whenever any asset changes; part of the listing page validators
+ASSETS_VERSION = hashlib.sha256(''.join(sorted(ASSETS)).encode('utf-8')).hexdigest()[:12]
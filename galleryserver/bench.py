@@ -0,0 +1,456 @@
+import argparse
+import http.client
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import PIL
+from PIL import Image, ImageDraw
+
+from . import __version__
+from .cache import ThumbnailDiskCache, ThumbnailMemoryCache
+from .compression import CompressedResponseCache
+from .listing import DirectoryIndex
+from .metadata import DEFAULT_METADATA_DB_NAME, MetadataIndex, MetadataIndexer
+from .pool import PooledTCPServer
+from .render import supported_modern_formats
+from .server import create_handler_class
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Source images: (width, height) and format, cycled through by the corpus
+# builder. TIFF is written uncompressed like most scanners do, so it stays
+# at the smaller sizes to keep the corpus a reasonable size on disk.
+CORPUS_SIZES = ((640, 480), (1600, 1200), (2400, 1600), (1080, 1440))
+CORPUS_FORMATS = (('JPEG', '.jpg'), ('PNG', '.png'), ('TIFF', '.tif'), ('WEBP', '.webp'))
+TIFF_MAX_PIXELS = 1600 * 1200
+
+SCENARIOS = ('thumbnail_cold', 'thumbnail_warm', 'thumbnail_revalidate', 'listing_html',
+             'listing_json', 'concurrent')
+CORPUS_MARKER = 'corpus.json'
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, round(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def peak_rss_bytes():
+    """Peak resident set size of this process since start or the last reset, or None where unknown"""
+    try:
+        with open('/proc/self/status', encoding='ascii') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def reset_peak_rss():
+    """Restart this process's peak RSS from its current RSS; returns False where unsupported"""
+    try:
+        with open('/proc/self/clear_refs', 'w', encoding='ascii') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def draw_image(rng, size):
+    """A synthetic photo-like image: a gradient with a few shapes on it"""
+    width, height = size
+    start = tuple(rng.randrange(256) for _ in range(3))
+    end = tuple(rng.randrange(256) for _ in range(3))
+    gradient = Image.linear_gradient('L').resize(size)
+    img = Image.composite(Image.new('RGB', size, end), Image.new('RGB', size, start), gradient)
+    draw = ImageDraw.Draw(img)
+    for _ in range(12):
+        x, y = rng.randrange(width), rng.randrange(height)
+        w, h = rng.randrange(width // 8, width // 2), rng.randrange(height // 8, height // 2)
+        draw.ellipse((x, y, x + w, y + h), fill=tuple(rng.randrange(256) for _ in range(3)))
+    return img
+
+
+def build_corpus(root, images=200, depth=4, listing_entries=10000, seed=0):
+    """Generate the benchmark tree under root, or reuse one built with the same parameters.
+
+    ``photos/`` holds ``images`` mixed JPEG/PNG/TIFF/WebP files spread over
+    nested folders ``depth`` levels deep. ``big/`` is one folder of
+    ``listing_entries`` small JPEGs (hard links to one file where the
+    filesystem allows) for listing at scale.
+    """
+    params = {'images': images, 'depth': depth, 'listing_entries': listing_entries, 'seed': seed}
+    marker = os.path.join(root, CORPUS_MARKER)
+    try:
+        with open(marker, encoding='utf-8') as f:
+            if json.load(f) == params:
+                return False
+    except (OSError, ValueError):
+        pass
+
+    for name in ('photos', 'big'):
+        shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+    rng = random.Random(seed)
+    for index in range(images):
+        folder = os.path.join(root, 'photos', *(f'level{level}-{index % (level + 2)}'
+                                                 for level in range(index % (depth + 1))))
+        os.makedirs(folder, exist_ok=True)
+        output_format, extension = CORPUS_FORMATS[index % len(CORPUS_FORMATS)]
+        size = CORPUS_SIZES[index % len(CORPUS_SIZES)]
+        if output_format == 'TIFF' and size[0] * size[1] > TIFF_MAX_PIXELS:
+            size = CORPUS_SIZES[0]
+        draw_image(rng, size).save(os.path.join(folder, f'img{index:05d}{extension}'), format=output_format)
+
+    big = os.path.join(root, 'big')
+    os.makedirs(big)
+    source = os.path.join(big, 'entry000000.jpg')
+    draw_image(rng, (320, 240)).save(source, format='JPEG')
+    for index in range(1, listing_entries):
+        target = os.path.join(big, f'entry{index:06d}.jpg')
+        try:
+            os.link(source, target)
+        except OSError:
+            shutil.copyfile(source, target)
+
+    with open(marker, 'w', encoding='utf-8') as f:
+        json.dump(params, f)
+    return True
+
+
+def iter_corpus_images(root):
+    for dirpath, dirnames, filenames in os.walk(os.path.join(root, 'photos')):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            yield os.path.relpath(os.path.join(dirpath, filename), root).replace(os.sep, '/')
+
+
+class BenchServer:
+    """A gallery server on an ephemeral localhost port, run in a background thread.
+
+    The benchmark runs it in a child process (see ServerProcess), so client
+    threads don't share its GIL and its memory is measured on its own. Like
+    the server's default setup it has a metadata index, filled before the
+    server starts as it would be once the background indexer has caught up.
+    """
+
+    def __init__(self, cache_dir, memory_cache_bytes, workers, thumbnail_formats=()):
+        thumbnail_cache = ThumbnailDiskCache(cache_dir)
+        memory_cache = ThumbnailMemoryCache(memory_cache_bytes) if memory_cache_bytes > 0 else None
+        self.metadata_index = MetadataIndex(os.path.join(cache_dir, DEFAULT_METADATA_DB_NAME))
+        MetadataIndexer(self.metadata_index).run_pass()
+        handler_class = create_handler_class(200, thumbnail_cache, memory_cache,
+                                             listing_index=DirectoryIndex(),
+                                             compressed_cache=CompressedResponseCache(),
+                                             thumbnail_formats=thumbnail_formats,
+                                             metadata_index=self.metadata_index)
+
+        class QuietHandler(handler_class):
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = PooledTCPServer(('127.0.0.1', 0), QuietHandler, workers=workers)
+        self.port = self.httpd.server_address[1]
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.metadata_index.close()
+
+
+def serve_main(argv):
+    """Child side of ServerProcess: serve the current directory and answer commands on stdin.
+
+    Prints the port once listening, then for each ``reset`` line resets the
+    peak RSS (replying ``ok`` or ``unsupported``) and for each ``rss`` line
+    replies with the peak RSS in bytes. Exits when stdin closes.
+    """
+    cache_dir, memory_cache_bytes, workers, thumbnail_formats = argv
+    server = BenchServer(cache_dir, int(memory_cache_bytes), int(workers),
+                         tuple(name for name in thumbnail_formats.split(',') if name))
+    print(server.port, flush=True)
+    try:
+        for line in sys.stdin:
+            command = line.strip()
+            if command == 'reset':
+                print('ok' if reset_peak_rss() else 'unsupported', flush=True)
+            elif command == 'rss':
+                print(peak_rss_bytes() or 0, flush=True)
+    finally:
+        server.close()
+
+
+class ServerProcess:
+    """Run a BenchServer in a child process serving ``root``"""
+
+    def __init__(self, root, cache_dir, memory_cache_bytes, workers, thumbnail_formats=()):
+        env = dict(os.environ)
+        # The child starts in the corpus, so make this package importable from there
+        package_parent = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env['PYTHONPATH'] = os.pathsep.join(filter(None, (package_parent, env.get('PYTHONPATH'))))
+        self.process = subprocess.Popen(
+            [sys.executable, '-m', 'galleryserver', 'bench', 'serve', cache_dir,
+             str(memory_cache_bytes), str(workers), ','.join(thumbnail_formats)],
+            cwd=root, env=env, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+        port = self.process.stdout.readline()
+        if not port:
+            self.close()
+            raise RuntimeError("Benchmark server failed to start")
+        self.port = int(port)
+
+    def _ask(self, command):
+        self.process.stdin.write(command + '\n')
+        self.process.stdin.flush()
+        return self.process.stdout.readline().strip()
+
+    def reset_peak_rss(self):
+        """Start measuring the server's peak RSS afresh; returns False where that isn't possible"""
+        return self._ask('reset') == 'ok'
+
+    def peak_rss_bytes(self):
+        return int(self._ask('rss')) or None
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=10)
+        except (OSError, subprocess.TimeoutExpired):
+            self.process.kill()
+            self.process.wait()
+
+
+class Client:
+    """One keep-alive connection that times each request"""
+
+    def __init__(self, port, headers=None):
+        self.port = port
+        self.headers = headers or {}
+        self.connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+
+    def get(self, path, headers=None):
+        """Fetch path; returns (status, seconds, body, response headers)"""
+        started = time.perf_counter()
+        try:
+            self.connection.request('GET', path, headers={**self.headers, **(headers or {})})
+            response = self.connection.getresponse()
+            body = response.read()
+        except (OSError, http.client.HTTPException):
+            self.connection.close()
+            self.connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=60)
+            return None, time.perf_counter() - started, b'', {}
+        return response.status, time.perf_counter() - started, body, dict(response.getheaders())
+
+    def close(self):
+        self.connection.close()
+
+
+def summarize(latencies, wall_seconds, errors, extra=None):
+    """Latency percentiles (ms) and throughput"""
+    ordered = sorted(latencies)
+    ms = lambda seconds: None if seconds is None else round(seconds * 1000, 3)
+    result = {
+        'requests': len(latencies),
+        'errors': errors,
+        'p50_ms': ms(percentile(ordered, 0.50)),
+        'p95_ms': ms(percentile(ordered, 0.95)),
+        'p99_ms': ms(percentile(ordered, 0.99)),
+        'max_ms': ms(ordered[-1] if ordered else None),
+        'mean_ms': ms(sum(ordered) / len(ordered) if ordered else None),
+        'throughput_rps': round(len(latencies) / wall_seconds, 1) if wall_seconds > 0 else None,
+    }
+    result.update(extra or {})
+    return result
+
+
+def run_sequential(client, paths, expect=200, headers_for=None):
+    latencies = []
+    errors = 0
+    started = time.perf_counter()
+    for path in paths:
+        status, seconds, _, _ = client.get(path, headers_for(path) if headers_for else None)
+        latencies.append(seconds)
+        if status != expect:
+            errors += 1
+    return summarize(latencies, time.perf_counter() - started, errors)
+
+
+def run_concurrent(port, paths, clients, total_requests, headers=None):
+    """``clients`` threads on their own connections share ``total_requests`` requests"""
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    counter = iter(range(total_requests))
+
+    def worker():
+        client = Client(port, headers)
+        local = []
+        local_errors = 0
+        while True:
+            with lock:
+                index = next(counter, None)
+            if index is None:
+                break
+            status, seconds, _, _ = client.get(paths[index % len(paths)])
+            local.append(seconds)
+            if status != 200:
+                local_errors += 1
+        client.close()
+        with lock:
+            latencies.extend(local)
+            errors[0] += local_errors
+
+    threads = [threading.Thread(target=worker) for _ in range(clients)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return summarize(latencies, time.perf_counter() - started, errors[0], {'clients': clients})
+
+
+def run_benchmarks(root, scenarios=SCENARIOS, workers=8, clients=8, requests=2000, listing_repeats=20,
+                   thumbnail_formats=(), accept='image/jpeg,*/*'):
+    """Run the scenarios against a fresh server and cache; returns {scenario: summary}.
+
+    Each summary includes ``server_peak_rss_bytes``, the server process's
+    peak RSS during that scenario where the peak can be reset (Linux,
+    ``server_peak_rss_scope`` "scenario") or since it started ("process").
+    """
+    images = [f'/{path}' for path in iter_corpus_images(root)]
+    thumbs = [f'{path}?thumb=1' for path in images]
+    headers = {'Accept': accept}
+    results = {}
+    cache_dir = tempfile.mkdtemp(prefix='galleryserver-bench-cache-')
+    server = ServerProcess(root, cache_dir, 64 * 1024 * 1024, workers, thumbnail_formats)
+    client = Client(server.port, headers)
+
+    def measure(name, run):
+        scope = 'scenario' if server.reset_peak_rss() else 'process'
+        results[name] = run()
+        results[name]['server_peak_rss_bytes'] = server.peak_rss_bytes()
+        results[name]['server_peak_rss_scope'] = scope
+
+    try:
+        if 'thumbnail_cold' in scenarios or 'thumbnail_warm' in scenarios:
+            # Warm runs need the cold pass to have filled the caches
+            measure('thumbnail_cold', lambda: run_sequential(client, thumbs))
+        if 'thumbnail_warm' in scenarios:
+            measure('thumbnail_warm', lambda: run_sequential(client, thumbs))
+        if 'thumbnail_revalidate' in scenarios:
+            etags = {path: client.get(path)[3].get('ETag', '') for path in thumbs}
+            measure('thumbnail_revalidate', lambda: run_sequential(
+                client, thumbs, expect=304, headers_for=lambda path: {'If-None-Match': etags[path]}))
+        if 'listing_html' in scenarios:
+            # Sent without Accept-Encoding, so no cached compressed page is reused
+            measure('listing_html', lambda: run_sequential(client, ['/big/'] * listing_repeats))
+        if 'listing_json' in scenarios:
+            total = len(os.listdir(os.path.join(root, 'big')))
+            windows = [f'/big/?list=json&offset={offset}&limit=200' for offset in range(0, total, 200)]
+            measure('listing_json', lambda: run_sequential(client, windows))
+        if 'concurrent' in scenarios:
+            # Warm thumbnails mixed with listing windows, as a page scroll causes
+            mix = thumbs + ['/big/?list=json&offset=0&limit=200']
+            measure('concurrent', lambda: run_concurrent(server.port, mix, clients, requests, headers))
+    finally:
+        client.close()
+        server.close()
+        shutil.rmtree(cache_dir, ignore_errors=True)
+    return results
+
+
+def main(argv=None):
+    """Entry point for ``galleryserver bench``"""
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] == ['serve']:
+        # Internal: the server side of a benchmark run, see ServerProcess
+        serve_main(argv[1:])
+        return
+    parser = argparse.ArgumentParser(prog='galleryserver bench',
+                                     description='Benchmark thumbnail and listing hot paths on a '
+                                                 'synthetic corpus and print the results as JSON')
+    parser.add_argument('--corpus', default=None,
+                        help='Directory for the synthetic corpus; kept and reused by later runs '
+                             'with the same corpus options (default: a temporary directory)')
+    parser.add_argument('--images', type=int, default=200,
+                        help='Images in the nested photo tree (default: 200)')
+    parser.add_argument('--depth', type=int, default=4,
+                        help='Folder depth of the photo tree (default: 4)')
+    parser.add_argument('--listing-entries', type=int, default=10000,
+                        help='Entries in the large folder used for listings (default: 10000)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed for the corpus contents (default: 0)')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help=f'Comma-separated scenarios to run (default: {",".join(SCENARIOS)})')
+    parser.add_argument('--workers', type=int, default=8,
+                        help='Server worker threads (default: 8)')
+    parser.add_argument('--clients', type=int, default=8,
+                        help='Concurrent clients in the concurrent scenario (default: 8)')
+    parser.add_argument('--requests', type=int, default=2000,
+                        help='Requests made in the concurrent scenario (default: 2000)')
+    parser.add_argument('--listing-repeats', type=int, default=20,
+                        help='Page loads of the large folder in listing_html (default: 20)')
+    parser.add_argument('--accept', default='image/jpeg,*/*',
+                        help='Accept header sent with every request; add image/avif or image/webp '
+                             'to measure those encoders (default: %(default)s)')
+    parser.add_argument('--output', '-o', default=None,
+                        help='Write the JSON report to this file instead of stdout')
+
+    args = parser.parse_args(argv)
+    scenarios = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = [name for name in scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(unknown)}")
+
+    corpus = args.corpus or tempfile.mkdtemp(prefix='galleryserver-bench-')
+    os.makedirs(corpus, exist_ok=True)
+    try:
+        started = time.perf_counter()
+        built = build_corpus(corpus, args.images, args.depth, args.listing_entries, args.seed)
+        corpus_seconds = time.perf_counter() - started
+        print(f"📦 Corpus {'built' if built else 'reused'} in {corpus_seconds:.1f}s: {corpus}", file=sys.stderr)
+
+        results = run_benchmarks(os.path.abspath(corpus), scenarios, args.workers, args.clients,
+                                 args.requests, args.listing_repeats, supported_modern_formats(),
+                                 args.accept)
+    finally:
+        if args.corpus is None:
+            shutil.rmtree(corpus, ignore_errors=True)
+
+    report = {
+        'version': __version__,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(),
+        'pillow': PIL.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'corpus': {'images': args.images, 'depth': args.depth, 'listing_entries': args.listing_entries,
+                   'seed': args.seed, 'build_seconds': round(corpus_seconds, 2), 'reused': not built},
+        'settings': {'workers': args.workers, 'clients': args.clients, 'requests': args.requests,
+                     'listing_repeats': args.listing_repeats, 'accept': args.accept},
+        'scenarios': results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
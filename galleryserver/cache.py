@@ -0,0 +1,217 @@
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+DEFAULT_CACHE_DIR = '.galleryserver-cache'
+DEFAULT_CACHE_MAX_BYTES = 512 * 1024 * 1024
+DEFAULT_MEMORY_CACHE_BYTES = 64 * 1024 * 1024
+
+# Part of every cached rendition's key; bump it when rendered output changes
+# (2: thumbnails follow EXIF orientation) so stale renditions are never served
+RENDITION_VERSION = '2'
+
+_HEX_DIGITS = frozenset('0123456789abcdef')
+
+
+def _is_hex(name, length):
+    return len(name) == length and _HEX_DIGITS.issuperset(name)
+
+
+def thumbnail_cache_key(file_path, stat_result, thumbnail_size, output_format):
+    """Build a cache key from the source file identity and render parameters"""
+    parts = (
+        RENDITION_VERSION,
+        os.path.normpath(file_path),
+        str(stat_result.st_mtime_ns),
+        str(stat_result.st_size),
+        str(thumbnail_size),
+        output_format.upper(),
+    )
+    return hashlib.sha256('\0'.join(parts).encode('utf-8')).hexdigest()
+
+
+class ThumbnailDiskCache:
+    """Content-addressed on-disk store of encoded thumbnails with LRU eviction.
+
+    Entries live at ``<cache_dir>/<key[:2]>/<key>`` and are written to a
+    temporary file first, then moved into place, so readers never see a
+    partial thumbnail. Recency is tracked in memory and persisted through the
+    entry mtimes, so the LRU order survives a restart. Anything else in the
+    cache directory (the metadata index, request traces) is left alone.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self._load_index()
+
+    def _load_index(self):
+        """Rebuild the LRU index from the files already in the cache directory"""
+        found = []
+        for shard in os.scandir(self.cache_dir):
+            if not _is_hex(shard.name, 2) or not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if not _is_hex(entry.name, 64) or not entry.name.startswith(shard.name) or not entry.is_file():
+                    continue
+                st = entry.stat()
+                found.append((st.st_mtime, entry.name, st.st_size))
+        found.sort()
+        for _, key, size in found:
+            self._entries[key] = size
+            self.total_bytes += size
+        self._evict()
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def contains(self, key):
+        """Check whether key is cached without reading it or touching its recency"""
+        with self._lock:
+            return key in self._entries
+
+    def get(self, key):
+        """Return the cached bytes for key, or None on a miss"""
+        try:
+            with open(self._entry_path(key), 'rb') as f:
+                data = f.read()
+        except OSError:
+            with self._lock:
+                self.misses += 1
+                size = self._entries.pop(key, None)
+                if size is not None:
+                    self.total_bytes -= size
+            return None
+        with self._lock:
+            self.hits += 1
+            if key in self._entries:
+                self._entries.move_to_end(key)
+            else:
+                # Written by another process sharing the directory (say, a
+                # prewarm run); count it against the budget from now on
+                self._entries[key] = len(data)
+                self.total_bytes += len(data)
+                self._evict()
+        try:
+            os.utime(self._entry_path(key))
+        except OSError:
+            pass
+        return data
+
+    def put(self, key, data):
+        """Atomically store data under key and evict old entries if over budget"""
+        if len(data) > self.max_bytes:
+            return
+        path = self._entry_path(key)
+        shard = os.path.dirname(path)
+        os.makedirs(shard, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix='.tmp-', dir=shard)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+        with self._lock:
+            old_size = self._entries.pop(key, None)
+            if old_size is not None:
+                self.total_bytes -= old_size
+            self._entries[key] = len(data)
+            self.total_bytes += len(data)
+            self._evict()
+
+    def discard(self, key):
+        """Remove the entry for key, if any"""
+        with self._lock:
+            size = self._entries.pop(key, None)
+            if size is None:
+                return
+            self.total_bytes -= size
+        try:
+            os.unlink(self._entry_path(key))
+        except OSError:
+            pass
+
+    def _evict(self):
+        """Drop least recently used entries until the cache fits max_bytes"""
+        while self.total_bytes > self.max_bytes and self._entries:
+            key, size = self._entries.popitem(last=False)
+            self.total_bytes -= size
+            try:
+                os.unlink(self._entry_path(key))
+            except OSError:
+                pass
+
+
+class ThumbnailMemoryCache:
+    """In-process LRU cache of encoded thumbnails bounded by a byte budget.
+
+    Entries remember the mtime and size of the source file they were rendered
+    from; a lookup with a newer stat result drops the stale entry.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MEMORY_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, stat_result):
+        """Return cached bytes for key if they match the source stat, else None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            mtime_ns, size, data = entry
+            if mtime_ns != stat_result.st_mtime_ns or size != stat_result.st_size:
+                del self._entries[key]
+                self.total_bytes -= len(data)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def put(self, key, stat_result, data):
+        """Store data for key and evict least recently used entries over budget"""
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.total_bytes -= len(old[2])
+            self._entries[key] = (stat_result.st_mtime_ns, stat_result.st_size, data)
+            self.total_bytes += len(data)
+            while self.total_bytes > self.max_bytes:
+                _, (_, _, evicted) = self._entries.popitem(last=False)
+                self.total_bytes -= len(evicted)
+
+    def invalidate(self, key):
+        """Drop the entry for key, if any"""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.total_bytes -= len(entry[2])
+
+    def hit_ratio(self):
+        """Fraction of lookups served from memory"""
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
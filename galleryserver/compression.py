@@ -0,0 +1,138 @@
+import gzip
+import threading
+import zlib
+from collections import OrderedDict
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Bodies smaller than this are sent as is; compression would barely pay off
+MIN_COMPRESS_SIZE = 1024
+
+# Text files larger than this are sent uncompressed, straight from disk
+MAX_COMPRESS_FILE_SIZE = 8 * 1024 * 1024
+
+DEFAULT_COMPRESSED_CACHE_BYTES = 16 * 1024 * 1024
+
+# Content types worth compressing; images, video and archives already are
+COMPRESSIBLE_TYPES = {
+    'application/javascript',
+    'application/json',
+    'application/xml',
+    'image/svg+xml',
+}
+
+
+def is_compressible_type(content_type):
+    """Check whether a Content-Type benefits from compression"""
+    content_type = content_type.split(';', 1)[0].strip().lower()
+    return content_type.startswith('text/') or content_type in COMPRESSIBLE_TYPES
+
+
+def supported_encodings():
+    """Content codings this server can produce, most preferred first"""
+    return ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+def parse_accept_encoding(header):
+    """Parse an Accept-Encoding header into a {coding: qvalue} dict"""
+    accepted = {}
+    for part in (header or '').split(','):
+        coding, _, params = part.strip().partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params.split(';'):
+            name, _, value = param.strip().partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[coding] = q
+    return accepted
+
+
+def choose_encoding(header, available=None):
+    """Pick the best content coding the client accepts, or None for identity"""
+    accepted = parse_accept_encoding(header)
+    best, best_q = None, 0.0
+    for coding in available or supported_encodings():
+        q = accepted.get(coding, accepted.get('*', 0.0))
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+
+def compress(data, coding):
+    """Compress a complete body with the given content coding"""
+    if coding == 'br':
+        return brotli.compress(data, quality=5)
+    return gzip.compress(data, compresslevel=6, mtime=0)
+
+
+class StreamEncoder:
+    """Incrementally compress a streamed body, flushing after every piece.
+
+    Each ``compress`` call returns output the client can decode right away,
+    so streaming keeps working with compression on.
+    """
+
+    def __init__(self, coding):
+        self.coding = coding
+        if coding == 'br':
+            self._compressor = brotli.Compressor(quality=5)
+        else:
+            self._compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data):
+        if self.coding == 'br':
+            return self._compressor.process(data) + self._compressor.flush()
+        return self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        if self.coding == 'br':
+            return self._compressor.finish()
+        return self._compressor.flush()
+
+
+class CompressedResponseCache:
+    """LRU cache of compressed response bodies bounded by a byte budget.
+
+    Keys should include a validator (such as the listing ETag) so entries
+    for changed content are simply never looked up again and age out.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_COMPRESSED_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            body = self._entries.get(key)
+            if body is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries.move_to_end(key)
+            return body
+
+    def put(self, key, body):
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.total_bytes -= len(old)
+            self._entries[key] = body
+            self.total_bytes += len(body)
+            while self.total_bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.total_bytes -= len(evicted)
@@ -0,0 +1,97 @@
+import os
+import threading
+from collections import OrderedDict, namedtuple
+
+ListingEntry = namedtuple('ListingEntry', ['name', 'is_dir', 'size', 'mtime'])
+
+
+def scan_directory(dir_path):
+    """List the visible entries of a directory with os.scandir, sorted by name.
+
+    Hidden entries are skipped up front. ``is_dir`` comes from the cached
+    ``DirEntry`` type information, so only files cost a stat call (for their
+    size and mtime).
+    """
+    entries = []
+    with os.scandir(dir_path) as it:
+        for entry in it:
+            if entry.name.startswith('.'):
+                continue
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            size = mtime = None
+            if not is_dir:
+                try:
+                    st = entry.stat()
+                    size, mtime = st.st_size, st.st_mtime
+                except OSError:
+                    pass
+            entries.append(ListingEntry(entry.name, is_dir, size, mtime))
+    entries.sort(key=lambda e: e.name)
+    return entries
+
+
+class DirectoryIndex:
+    """In-memory cache of directory listings, invalidated by directory mtime.
+
+    Adding, removing or renaming an entry bumps the directory mtime, so an
+    unchanged folder is served without touching the filesystem beyond the
+    one stat of the directory itself. Up to ``max_dirs`` listings are kept,
+    least recently used first out, along with whatever was derived from
+    them through ``derive``.
+    """
+
+    def __init__(self, max_dirs=256):
+        self.max_dirs = max_dirs
+        self._listings = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, dir_path, dir_stat=None):
+        """Return the sorted ListingEntry list for dir_path"""
+        key = os.path.normpath(dir_path)
+        if dir_stat is None:
+            dir_stat = os.stat(dir_path)
+        with self._lock:
+            cached = self._listings.get(key)
+            if cached is not None and cached[0] == dir_stat.st_mtime_ns:
+                self._listings.move_to_end(key)
+                return cached[1]
+
+        entries = scan_directory(dir_path)
+        with self._lock:
+            self._listings[key] = (dir_stat.st_mtime_ns, entries, {})
+            self._listings.move_to_end(key)
+            while len(self._listings) > self.max_dirs:
+                self._listings.popitem(last=False)
+        return entries
+
+    def derive(self, dir_path, entries, name, build):
+        """Return build(entries), computed once per cached listing.
+
+        ``entries`` must be a listing returned by ``get``; the result is
+        kept under ``name`` until that listing is replaced or dropped.
+        """
+        key = os.path.normpath(dir_path)
+        with self._lock:
+            cached = self._listings.get(key)
+            if cached is None or cached[1] is not entries:
+                cached = None
+            elif name in cached[2]:
+                return cached[2][name]
+        value = build(entries)
+        if cached is not None:
+            with self._lock:
+                cached[2][name] = value
+        return value
+
+    def invalidate(self, dir_path):
+        """Forget the cached listing for dir_path"""
+        with self._lock:
+            self._listings.pop(os.path.normpath(dir_path), None)
+
+    def clear(self):
+        """Forget every cached listing"""
+        with self._lock:
+            self._listings.clear()
@@ -0,0 +1,299 @@
+import datetime
+import os
+import queue
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from PIL import Image
+
+from .prewarm import lower_thread_priority
+from .render import IMAGE_EXTENSIONS
+
+# The index lives inside the thumbnail cache directory by default
+DEFAULT_METADATA_DB_NAME = 'metadata.sqlite3'
+DEFAULT_RESCAN_INTERVAL = 300.0
+
+# Rows are committed in batches of this size, so a huge folder shows up
+# in the index while it is still being read
+WRITE_BATCH_SIZE = 256
+
+# Whole-directory row sets kept in memory for date-sorted listings, and the
+# most names looked up in one query (SQLite's oldest variable limit is 999)
+DEFAULT_CACHED_DIRECTORIES = 16
+MAX_QUERY_NAMES = 900
+
+EXIF_ORIENTATION = 0x0112
+EXIF_DATETIME = 0x0132
+EXIF_IFD = 0x8769
+EXIF_DATETIME_ORIGINAL = 0x9003
+
+ImageMetadata = namedtuple('ImageMetadata', ['size', 'mtime_ns', 'width', 'height', 'orientation', 'taken'])
+
+
+def parse_exif_date(value):
+    """Turn an EXIF ``YYYY:MM:DD HH:MM:SS`` stamp into ISO 8601, or None"""
+    if not isinstance(value, str):
+        return None
+    try:
+        return datetime.datetime.strptime(value.strip('\0 ')[:19], '%Y:%m:%d %H:%M:%S').isoformat()
+    except ValueError:
+        return None
+
+
+def read_image_metadata(file_path):
+    """Read pixel size, EXIF orientation and capture date from an image header.
+
+    Only the header is parsed; no pixel data is decoded.
+    """
+    with Image.open(file_path) as img:
+        width, height = img.size
+        exif = img.getexif()
+        orientation = exif.get(EXIF_ORIENTATION) or 1
+        taken = exif.get_ifd(EXIF_IFD).get(EXIF_DATETIME_ORIGINAL) or exif.get(EXIF_DATETIME)
+    return width, height, orientation, parse_exif_date(taken)
+
+
+def display_size(metadata):
+    """Width and height of an image as shown, after its EXIF orientation"""
+    if metadata.orientation in (5, 6, 7, 8):
+        return metadata.height, metadata.width
+    return metadata.width, metadata.height
+
+
+class MetadataIndex:
+    """SQLite store of per-image metadata for the served tree.
+
+    Rows are keyed by directory (relative to the served root) and file name.
+    ``generation`` grows with every write and is persisted; each directory
+    records the generation of its last write as its version, so pages built
+    from the index can use it as part of their validators without one
+    folder's changes invalidating every other folder. The rows of the
+    ``max_cached_dirs`` most recently read directories are kept in memory
+    until that version changes.
+    """
+
+    def __init__(self, db_path, max_cached_dirs=DEFAULT_CACHED_DIRECTORIES):
+        self.db_path = db_path
+        self.max_cached_dirs = max_cached_dirs
+        self._directories = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        with self._db:
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('''CREATE TABLE IF NOT EXISTS images (
+                dir TEXT NOT NULL,
+                name TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                width INTEGER,
+                height INTEGER,
+                orientation INTEGER,
+                taken TEXT,
+                PRIMARY KEY (dir, name))''')
+            self._db.execute('CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value INTEGER)')
+            self._db.execute('CREATE TABLE IF NOT EXISTS directories (dir TEXT PRIMARY KEY, version INTEGER)')
+        row = self._db.execute("SELECT value FROM state WHERE key = 'generation'").fetchone()
+        self.generation = row[0] if row else 0
+
+    def get_directory(self, dir_path, cache=True):
+        """Return {name: ImageMetadata} for the indexed images of one directory.
+
+        The dict is shared with other callers and must not be modified.
+        With ``cache`` false it is read afresh and not kept.
+        """
+        key = os.path.normpath(dir_path)
+        with self._lock:
+            version = self._version(key)
+            cached = self._directories.get(key)
+            if cached is not None and cached[0] == version:
+                self._directories.move_to_end(key)
+                return cached[1]
+            rows = self._db.execute(
+                'SELECT name, size, mtime_ns, width, height, orientation, taken FROM images WHERE dir = ?',
+                (key,)).fetchall()
+            metadata = {row[0]: ImageMetadata(*row[1:]) for row in rows}
+            if not cache:
+                return metadata
+            self._directories[key] = (version, metadata)
+            self._directories.move_to_end(key)
+            while len(self._directories) > self.max_cached_dirs:
+                self._directories.popitem(last=False)
+        return metadata
+
+    def get_images(self, dir_path, names):
+        """Return {name: ImageMetadata} for the indexed images among ``names`` of one directory"""
+        key = os.path.normpath(dir_path)
+        names = list(names)
+        metadata = {}
+        with self._lock:
+            cached = self._directories.get(key)
+            if cached is not None and cached[0] == self._version(key):
+                return {name: cached[1][name] for name in names if name in cached[1]}
+            for start in range(0, len(names), MAX_QUERY_NAMES):
+                chunk = names[start:start + MAX_QUERY_NAMES]
+                rows = self._db.execute(
+                    'SELECT name, size, mtime_ns, width, height, orientation, taken FROM images '
+                    'WHERE dir = ? AND name IN (%s)' % ', '.join('?' * len(chunk)),
+                    [key] + chunk).fetchall()
+                metadata.update((row[0], ImageMetadata(*row[1:])) for row in rows)
+        return metadata
+
+    def directory_version(self, dir_path):
+        """Return a number that changes whenever the rows of one directory change"""
+        with self._lock:
+            return self._version(os.path.normpath(dir_path))
+
+    def _version(self, key):
+        row = self._db.execute('SELECT version FROM directories WHERE dir = ?', (key,)).fetchone()
+        return row[0] if row else 0
+
+    def update_directory(self, dir_path, changed, removed=()):
+        """Store changed rows ({name: ImageMetadata}) and drop removed names in one transaction"""
+        key = os.path.normpath(dir_path)
+        with self._lock, self._db:
+            self._db.executemany(
+                'INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                [(key, name) + tuple(metadata) for name, metadata in changed.items()])
+            self._db.executemany('DELETE FROM images WHERE dir = ? AND name = ?',
+                                 [(key, name) for name in removed])
+            self.generation += 1
+            self._db.execute("INSERT OR REPLACE INTO state VALUES ('generation', ?)", (self.generation,))
+            self._db.execute('INSERT OR REPLACE INTO directories VALUES (?, ?)', (key, self.generation))
+
+    def count(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM images').fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class MetadataIndexer:
+    """Keep a MetadataIndex in sync with the images under a directory tree.
+
+    Each pass walks the tree and opens only images whose size or mtime
+    differ from their row; rows of deleted images are dropped. Passes repeat
+    every ``interval`` seconds on a low-priority thread that pauses while
+    ``is_busy()`` reports live requests. Directories passed to ``request``
+    (say, one a page was just served for) are indexed ahead of the walk.
+    """
+
+    def __init__(self, index, root='.', interval=DEFAULT_RESCAN_INTERVAL, is_busy=None):
+        self.index = index
+        self.root = root
+        self.interval = interval
+        self.is_busy = is_busy
+        self._requests = queue.Queue()
+        self._requested = set()
+        self._requested_lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def request(self, dir_path):
+        """Ask for one directory to be indexed as soon as possible"""
+        dir_path = os.path.normpath(dir_path)
+        with self._requested_lock:
+            if dir_path in self._requested:
+                return
+            self._requested.add(dir_path)
+        self._requests.put(dir_path)
+
+    def index_directory(self, dir_path):
+        """Bring the rows of one directory up to date; returns the number of images read"""
+        # Read past the cache, which is meant for the folders being browsed
+        known = self.index.get_directory(dir_path, cache=False)
+        seen = set()
+        changed = {}
+        read = 0
+        try:
+            with os.scandir(dir_path) as it:
+                entries = [e for e in it if not e.name.startswith('.')
+                           and os.path.splitext(e.name.lower())[1] in IMAGE_EXTENSIONS]
+        except OSError:
+            entries = []
+
+        for entry in entries:
+            if self._stopped.is_set():
+                return read
+            try:
+                if not entry.is_file():
+                    continue
+                st = entry.stat()
+            except OSError:
+                continue
+            seen.add(entry.name)
+            row = known.get(entry.name)
+            if row is not None and row.size == st.st_size and row.mtime_ns == st.st_mtime_ns:
+                continue
+
+            while self.is_busy is not None and self.is_busy():
+                time.sleep(0.1)
+            try:
+                width, height, orientation, taken = read_image_metadata(entry.path)
+            except Exception:
+                # Keep a row anyway so the file isn't reopened on every pass
+                width = height = orientation = taken = None
+            changed[entry.name] = ImageMetadata(st.st_size, st.st_mtime_ns, width, height, orientation, taken)
+            read += 1
+            if len(changed) >= WRITE_BATCH_SIZE:
+                self.index.update_directory(dir_path, changed)
+                changed = {}
+
+        removed = set(known) - seen
+        if changed or removed:
+            self.index.update_directory(dir_path, changed, removed)
+        return read
+
+    def _serve_requests(self):
+        while True:
+            try:
+                dir_path = self._requests.get_nowait()
+            except queue.Empty:
+                return
+            with self._requested_lock:
+                self._requested.discard(dir_path)
+            self.index_directory(dir_path)
+
+    def run_pass(self):
+        """Walk the whole tree once; returns the number of images read"""
+        read = 0
+        for dirpath, dirnames, _ in os.walk(self.root):
+            dirnames[:] = sorted(d for d in dirnames if not d.startswith('.'))
+            if self._stopped.is_set():
+                break
+            self._serve_requests()
+            read += self.index_directory(dirpath)
+        return read
+
+    def run(self):
+        """Index passes until stopped, serving requested directories in between"""
+        lower_thread_priority()
+        while not self._stopped.is_set():
+            started = time.monotonic()
+            read = self.run_pass()
+            if read:
+                print(f"🗂️  Metadata index: read {read} images in {time.monotonic() - started:.1f}s "
+                      f"({self.index.count()} indexed)")
+            deadline = time.monotonic() + self.interval
+            while not self._stopped.is_set():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    dir_path = self._requests.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                with self._requested_lock:
+                    self._requested.discard(dir_path)
+                self.index_directory(dir_path)
+
+    def stop(self):
+        self._stopped.set()
+
+    def start(self):
+        """Run the indexer in a background daemon thread"""
+        thread = threading.Thread(target=self.run, name='gallery-metadata', daemon=True)
+        thread.start()
+        return thread
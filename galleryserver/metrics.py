@@ -0,0 +1,151 @@
+import bisect
+import threading
+import time
+
+METRICS_PATH = '/__metrics'
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Histogram bucket upper bounds in seconds: sub-millisecond cache hits up to
+# multi-second cold renders of large originals
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+RENDER_STAGES = ('decode', 'resize', 'encode')
+
+
+class Histogram:
+    """Cumulative-bucket latency histogram; callers hold the registry lock"""
+
+    __slots__ = ('counts', 'total', 'count')
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+
+    def lines(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS + (float('inf'),), self.counts):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            yield f'{name}_bucket{{{labels},le="{le}"}} {cumulative}'
+        yield f'{name}_sum{{{labels}}} {self.total!r}'
+        yield f'{name}_count{{{labels}}} {self.count}'
+
+
+class CountingWriter:
+    """Wrap a handler's wfile and count the bytes written through it"""
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.count = 0
+
+    def write(self, data):
+        written = self.raw.write(data)
+        self.count += len(data)
+        return written
+
+    def flush(self):
+        self.raw.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
+
+class Metrics:
+    """Request, render and cache statistics in the Prometheus text format.
+
+    Request handlers record one observation per request and per render;
+    recording is a few dict updates under one lock, cheap enough to leave on.
+    Caches registered with ``add_cache`` must count ``hits`` and ``misses``;
+    ``server`` supplies the connection gauges when it is set.
+    """
+
+    def __init__(self):
+        self.server = None
+        self.started = time.time()
+        self._caches = {}
+        self._requests = {}
+        self._latency = {}
+        self._bytes = {}
+        self._render = {stage: Histogram() for stage in RENDER_STAGES}
+        self._lock = threading.Lock()
+
+    def add_cache(self, name, cache):
+        if cache is not None:
+            self._caches[name] = cache
+
+    def observe_request(self, route, code, seconds, bytes_sent):
+        with self._lock:
+            key = (route, code)
+            self._requests[key] = self._requests.get(key, 0) + 1
+            histogram = self._latency.get(route)
+            if histogram is None:
+                histogram = self._latency[route] = Histogram()
+            histogram.observe(seconds)
+            self._bytes[route] = self._bytes.get(route, 0) + bytes_sent
+
+    def observe_render(self, timings):
+        """Record the stage timings filled in by render_thumbnail"""
+        with self._lock:
+            for stage, seconds in timings.items():
+                histogram = self._render.get(stage)
+                if histogram is not None:
+                    histogram.observe(seconds)
+
+    def exposition(self):
+        """Return all metrics as Prometheus text exposition"""
+        lines = []
+        with self._lock:
+            lines += ['# HELP galleryserver_requests_total Requests answered, by route and status code',
+                      '# TYPE galleryserver_requests_total counter']
+            for (route, code), count in sorted(self._requests.items()):
+                lines.append(f'galleryserver_requests_total{{route="{route}",code="{code}"}} {count}')
+
+            lines += ['# HELP galleryserver_request_duration_seconds Time to answer a request, by route',
+                      '# TYPE galleryserver_request_duration_seconds histogram']
+            for route, histogram in sorted(self._latency.items()):
+                lines += histogram.lines('galleryserver_request_duration_seconds', f'route="{route}"')
+
+            lines += ['# HELP galleryserver_response_bytes_total Response bytes sent, headers included, by route',
+                      '# TYPE galleryserver_response_bytes_total counter']
+            for route, count in sorted(self._bytes.items()):
+                lines.append(f'galleryserver_response_bytes_total{{route="{route}"}} {count}')
+
+            lines += ['# HELP galleryserver_render_stage_seconds Thumbnail render time, by stage',
+                      '# TYPE galleryserver_render_stage_seconds histogram']
+            for stage in RENDER_STAGES:
+                lines += self._render[stage].lines('galleryserver_render_stage_seconds', f'stage="{stage}"')
+
+        lines += ['# HELP galleryserver_cache_hits_total Cache lookups answered from the cache',
+                  '# TYPE galleryserver_cache_hits_total counter']
+        lines += [f'galleryserver_cache_hits_total{{cache="{name}"}} {cache.hits}'
+                  for name, cache in self._caches.items()]
+        lines += ['# HELP galleryserver_cache_misses_total Cache lookups that missed',
+                  '# TYPE galleryserver_cache_misses_total counter']
+        lines += [f'galleryserver_cache_misses_total{{cache="{name}"}} {cache.misses}'
+                  for name, cache in self._caches.items()]
+        lines += ['# HELP galleryserver_cache_hit_ratio Fraction of cache lookups that hit since start',
+                  '# TYPE galleryserver_cache_hit_ratio gauge']
+        for name, cache in self._caches.items():
+            lookups = cache.hits + cache.misses
+            lines.append(f'galleryserver_cache_hit_ratio{{cache="{name}"}} '
+                         f'{cache.hits / lookups if lookups else 0.0!r}')
+
+        if self.server is not None:
+            lines += ['# HELP galleryserver_in_flight_requests Requests being answered right now',
+                      '# TYPE galleryserver_in_flight_requests gauge',
+                      f'galleryserver_in_flight_requests {self.server.active_requests}',
+                      '# HELP galleryserver_queued_requests Connections or requests waiting for a worker',
+                      '# TYPE galleryserver_queued_requests gauge',
+                      f'galleryserver_queued_requests {self.server.queued_requests}',
+                      '# HELP galleryserver_open_connections Connections holding or waiting for a worker',
+                      '# TYPE galleryserver_open_connections gauge',
+                      f'galleryserver_open_connections {self.server.pending_requests}']
+        lines += ['# HELP process_start_time_seconds Start time of the process since the Unix epoch',
+                  '# TYPE process_start_time_seconds gauge',
+                  f'process_start_time_seconds {self.started!r}']
+        return '\n'.join(lines) + '\n'
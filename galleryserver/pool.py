@@ -0,0 +1,127 @@
+import contextlib
+import os
+import socketserver
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Sent as is to connections turned away because every worker and queue slot is taken
+SERVICE_UNAVAILABLE_RESPONSE = (b'HTTP/1.0 503 Service Unavailable\r\n'
+                                b'Retry-After: 1\r\n'
+                                b'Content-Length: 0\r\n'
+                                b'Connection: close\r\n\r\n')
+
+
+def default_worker_count():
+    """Default number of worker threads, same heuristic as ThreadPoolExecutor"""
+    return min(32, (os.cpu_count() or 1) + 4)
+
+
+class PooledTCPServer(socketserver.TCPServer):
+    """TCP server that handles connections on a bounded pool of worker threads.
+
+    At most ``workers`` connections are served at once and at most
+    ``queue_size`` more wait for a free worker. When both are full the accept
+    loop stops pulling connections off the listen backlog for up to
+    ``admission_timeout`` seconds, after which the connection is answered
+    with a 503.
+
+    A keep-alive connection holds its worker between requests, so handlers
+    should check ``reclaim_idle_connections`` while idle and close when it is
+    set, and report each request through ``track_request`` so
+    ``active_requests`` tells real work apart from idle connections.
+    """
+
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def __init__(self, server_address, handler_class, workers=None, queue_size=128,
+                 admission_timeout=5.0, bind_and_activate=True):
+        self.workers = workers or default_worker_count()
+        self.queue_size = queue_size
+        self.admission_timeout = admission_timeout
+        self._slots = threading.BoundedSemaphore(self.workers + queue_size)
+        self._pending_lock = threading.Lock()
+        self._pending = 0
+        self._active = 0
+        self._closing = False
+        self._executor = ThreadPoolExecutor(max_workers=self.workers,
+                                            thread_name_prefix='gallery-worker')
+        super().__init__(server_address, handler_class, bind_and_activate)
+
+    @property
+    def pending_requests(self):
+        """Number of connections currently served or waiting for a worker"""
+        return self._pending
+
+    @property
+    def active_requests(self):
+        """Number of requests being answered right now, not counting idle connections"""
+        return self._active
+
+    @property
+    def queued_requests(self):
+        """Number of connections waiting for a free worker"""
+        return max(0, self._pending - self.workers)
+
+    @property
+    def reclaim_idle_connections(self):
+        """True when idle keep-alive connections should give up their worker.
+
+        That is the case while other connections are queued for a worker and
+        once the server is shutting down.
+        """
+        return self._closing or self._pending > self.workers
+
+    @contextlib.contextmanager
+    def track_request(self):
+        """Count one request as active for as long as the block runs"""
+        with self._pending_lock:
+            self._active += 1
+        try:
+            yield
+        finally:
+            with self._pending_lock:
+                self._active -= 1
+
+    def process_request(self, request, client_address):
+        """Hand the request to the pool, or reject it if the queue stays full"""
+        if not self._slots.acquire(timeout=self.admission_timeout):
+            self.reject_request(request)
+            return
+        with self._pending_lock:
+            self._pending += 1
+        try:
+            self._executor.submit(self.process_request_worker, request, client_address)
+        except RuntimeError:
+            # Executor already shut down
+            self._release_slot()
+            self.shutdown_request(request)
+
+    def process_request_worker(self, request, client_address):
+        """Run a single request on a worker thread"""
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self._release_slot()
+
+    def reject_request(self, request):
+        """Answer with 503 Service Unavailable without involving a handler"""
+        try:
+            request.sendall(SERVICE_UNAVAILABLE_RESPONSE)
+        except OSError:
+            pass
+        self.shutdown_request(request)
+
+    def server_close(self):
+        # Idle keep-alive connections notice this and let their workers go
+        self._closing = True
+        super().server_close()
+        self._executor.shutdown(wait=True)
+
+    def _release_slot(self):
+        with self._pending_lock:
+            self._pending -= 1
+        self._slots.release()
@@ -0,0 +1,204 @@
+import argparse
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .cache import DEFAULT_CACHE_DIR, DEFAULT_CACHE_MAX_BYTES, ThumbnailDiskCache, thumbnail_cache_key
+from .render import (
+    IMAGE_EXTENSIONS,
+    PREWARM_SIZES,
+    RenderPool,
+    fallback_format,
+    render_thumbnail,
+    supported_modern_formats,
+)
+
+
+def iter_image_files(root='.'):
+    """Yield image paths under root, skipping hidden files and directories"""
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(d for d in dirnames if not d.startswith('.'))
+        for filename in sorted(filenames):
+            if filename.startswith('.'):
+                continue
+            if os.path.splitext(filename.lower())[1] in IMAGE_EXTENSIONS:
+                yield os.path.normpath(os.path.join(dirpath, filename))
+
+
+def lower_thread_priority(increment=10):
+    """Lower the scheduling priority of the calling thread where the OS allows it"""
+    try:
+        # On Linux the nice value is per thread, addressed by native thread id
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(),
+                       os.getpriority(os.PRIO_PROCESS, 0) + increment)
+    except (AttributeError, OSError):
+        pass
+
+
+class RateLimiter:
+    """Space calls at least 1/rate seconds apart across all threads"""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0.0
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+class Prewarmer:
+    """Fill the thumbnail disk cache for every image under a directory tree.
+
+    Every image is rendered at each of ``sizes`` in ``output_format``, or in
+    the per-source fallback format (JPEG or PNG) when that is None.
+    Renditions whose cache key
+    is already present are skipped, so an interrupted
+    run simply resumes where it left off when started again. Renders run on a
+    few low-priority threads, are spaced by ``rate`` images per second and
+    pause while ``is_busy()`` reports live requests waiting. Failures are
+    reported to ``on_error(message)``, by default printed.
+    """
+
+    def __init__(self, cache, sizes, root='.', workers=2, rate=None,
+                 render_pool=None, is_busy=None, progress_interval=5.0, output_format=None,
+                 on_error=None):
+        self.cache = cache
+        self.sizes = tuple(dict.fromkeys(sizes))
+        self.output_format = output_format
+        self.root = root
+        self.workers = workers
+        self.render_pool = render_pool
+        self.is_busy = is_busy
+        self.progress_interval = progress_interval
+        self.on_error = on_error or print
+        self.rate_limiter = RateLimiter(rate)
+        self.total = 0
+        self.rendered = 0
+        self.skipped = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._last_report = 0.0
+
+    def render(self, file_path, size, output_format):
+        if self.render_pool is not None:
+            return self.render_pool.render(file_path, size, output_format)
+        return render_thumbnail(file_path, size, output_format)
+
+    def prewarm_file(self, file_path):
+        """Render one image into the cache at every size whose entry isn't still valid"""
+        output_format = self.output_format or fallback_format(file_path)
+        for size in self.sizes:
+            if self._stopped.is_set():
+                return
+            try:
+                key = thumbnail_cache_key(file_path, os.stat(file_path), size, output_format)
+                if self.cache.contains(key):
+                    self._count('skipped')
+                    continue
+                while self.is_busy is not None and self.is_busy():
+                    time.sleep(0.1)
+                self.rate_limiter.wait()
+                self.cache.put(key, self.render(file_path, size, output_format))
+                self._count('rendered')
+            except Exception as e:
+                self.on_error(f"Error prewarming thumbnail for {file_path}: {e}")
+                self._count('failed')
+
+    def _count(self, outcome):
+        with self._lock:
+            setattr(self, outcome, getattr(self, outcome) + 1)
+        now = time.monotonic()
+        if now - self._last_report >= self.progress_interval:
+            self._last_report = now
+            self.report()
+
+    def report(self):
+        done = self.rendered + self.skipped + self.failed
+        print(f"🔥 Prewarm: {done}/{self.total} thumbnails "
+              f"({self.rendered} rendered, {self.skipped} cached, {self.failed} failed)")
+
+    def _worker_initializer(self):
+        lower_thread_priority()
+
+    def run(self):
+        """Prewarm the whole tree and block until done"""
+        files = list(iter_image_files(self.root))
+        self.total = len(files) * len(self.sizes)
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='gallery-prewarm',
+                                initializer=self._worker_initializer) as executor:
+            try:
+                for _ in executor.map(self.prewarm_file, files):
+                    pass
+            except BaseException:
+                self.stop()
+                raise
+        self.report()
+
+    def stop(self):
+        """Skip all images not yet started"""
+        self._stopped.set()
+
+    def start(self):
+        """Run the prewarm in a background daemon thread"""
+        thread = threading.Thread(target=self.run, name='gallery-prewarm', daemon=True)
+        thread.start()
+        return thread
+
+
+def main(argv=None):
+    """Entry point for ``galleryserver prewarm DIR``"""
+    parser = argparse.ArgumentParser(prog='galleryserver prewarm',
+                                     description='Fill the thumbnail cache for a directory tree')
+    parser.add_argument('directory', nargs='?', default='.',
+                        help='Directory to prewarm (default: current directory)')
+    parser.add_argument('--thumbnail-size', type=int, default=200,
+                        help='Default thumbnail size in pixels; the grid sizes '
+                             f'{", ".join(map(str, PREWARM_SIZES))} are prewarmed too (default: 200)')
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR,
+                        help=f'Thumbnail cache directory, relative to DIR (default: {DEFAULT_CACHE_DIR})')
+    parser.add_argument('--cache-max-bytes', type=int, default=DEFAULT_CACHE_MAX_BYTES,
+                        help=f'Maximum size of the thumbnail cache in bytes (default: {DEFAULT_CACHE_MAX_BYTES})')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='Number of images rendered in parallel (default: CPU count)')
+    parser.add_argument('--render-processes', type=int, default=0,
+                        help='Render in N worker processes instead of threads (default: 0)')
+    modern_formats = [name.lower() for name in supported_modern_formats()]
+    parser.add_argument('--format', choices=modern_formats + ['jpeg'], default=(modern_formats or ['jpeg'])[0],
+                        help='Thumbnail format to render; "jpeg" warms the JPEG/PNG fallback for '
+                             'browsers without AVIF or WebP support (default: %(default)s)')
+    parser.add_argument('--rate', type=float, default=None,
+                        help='Maximum images rendered per second (default: unlimited)')
+
+    args = parser.parse_args(argv)
+
+    os.chdir(args.directory)
+    try:
+        # Stay out of the way of anything interactive, including a running server
+        os.nice(10)
+    except (AttributeError, OSError):
+        pass
+
+    cache = ThumbnailDiskCache(args.cache_dir, args.cache_max_bytes)
+    render_pool = RenderPool(args.render_processes) if args.render_processes > 0 else None
+    sizes = (args.thumbnail_size,) + PREWARM_SIZES
+    output_format = None if args.format == 'jpeg' else args.format.upper()
+    prewarmer = Prewarmer(cache, sizes, workers=args.workers, rate=args.rate,
+                          render_pool=render_pool, progress_interval=1.0, output_format=output_format)
+    print(f"🔥 Prewarming thumbnails in {os.getcwd()}")
+    try:
+        prewarmer.run()
+    except KeyboardInterrupt:
+        print("\n✨ Prewarm interrupted; run again to resume.")
+    finally:
+        if render_pool is not None:
+            render_pool.shutdown()
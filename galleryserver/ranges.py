@@ -0,0 +1,75 @@
+import uuid
+
+# More ranges than this in one request are ignored and the whole file is sent
+MAX_RANGES = 16
+
+
+class UnsatisfiableRange(Exception):
+    """Raised when no requested range overlaps the file"""
+
+
+def parse_range_header(header, size):
+    """Parse a ``Range: bytes=...`` header into inclusive (start, end) pairs.
+
+    Returns None when the header should be ignored (missing, malformed, not
+    in bytes, or too many ranges), in which case the full file is sent.
+    Raises UnsatisfiableRange when the header is valid but no range overlaps
+    a file of the given size.
+    """
+    if not header:
+        return None
+    unit, _, spec = header.partition('=')
+    if unit.strip().lower() != 'bytes' or not spec.strip():
+        return None
+
+    ranges = []
+    for part in spec.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        first, sep, last = part.partition('-')
+        if not sep:
+            return None
+        first, last = first.strip(), last.strip()
+        try:
+            if first:
+                start = int(first)
+                end = int(last) if last else size - 1
+                if start < 0 or (last and end < start):
+                    return None
+            else:
+                # Suffix range: the last N bytes
+                suffix = int(last)
+                if suffix <= 0:
+                    continue
+                start = max(0, size - suffix)
+                end = size - 1
+        except ValueError:
+            return None
+        if start >= size:
+            continue
+        ranges.append((start, min(end, size - 1)))
+
+    if len(ranges) > MAX_RANGES:
+        return None
+    if not ranges:
+        raise UnsatisfiableRange()
+    return ranges
+
+
+class MultipartByteranges:
+    """Framing for a ``multipart/byteranges`` response body"""
+
+    def __init__(self, ranges, size, content_type):
+        self.boundary = uuid.uuid4().hex
+        self.content_type = f'multipart/byteranges; boundary={self.boundary}'
+        self.parts = []
+        for start, end in ranges:
+            head = (f'\r\n--{self.boundary}\r\n'
+                    f'Content-Type: {content_type}\r\n'
+                    f'Content-Range: bytes {start}-{end}/{size}\r\n\r\n').encode('latin-1')
+            self.parts.append((head, start, end))
+        self.trailer = f'\r\n--{self.boundary}--\r\n'.encode('latin-1')
+
+    def content_length(self):
+        return sum(len(head) + end - start + 1 for head, start, end in self.parts) + len(self.trailer)
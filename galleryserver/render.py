@@ -0,0 +1,205 @@
+import io
+import math
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+from PIL import Image
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tiff', '.tif', '.webp'}
+
+# Rendition sizes (longest side in pixels). Requested sizes are rounded up
+# to a bucket so the caches only ever hold a few renditions per image.
+THUMBNAIL_SIZES = (160, 240, 320, 480, 640)
+PREVIEW_SIZE = 1600
+
+# The buckets most screens pick from the grid's srcset: 1x desktops and
+# every high-DPI screen. Prewarming these covers nearly all tile requests.
+PREWARM_SIZES = (480, 640)
+
+# EXIF orientation tag values and the transpose that shows the image upright
+EXIF_ORIENTATION = 0x0112
+ORIENTATION_TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+
+# Modern thumbnail encodings, most preferred first. Clients that accept none
+# of them get the fallback format (see fallback_format).
+MODERN_FORMATS = ('AVIF', 'WEBP')
+FORMAT_MEDIA_TYPES = {'AVIF': 'image/avif', 'WEBP': 'image/webp', 'JPEG': 'image/jpeg', 'PNG': 'image/png'}
+
+# Encoder settings per output format. AVIF's default speed is several times
+# slower for a few percent in size, too slow for renders on request.
+SAVE_OPTIONS = {
+    'JPEG': {'quality': 85},
+    'WEBP': {'quality': 80},
+    'AVIF': {'quality': 60, 'speed': 8},
+    'PNG': {},
+}
+
+# Source types that can carry transparency
+ALPHA_EXTENSIONS = {'.png', '.gif', '.webp'}
+
+# The final LANCZOS resample always starts from at least this many times the
+# target size, so the cheap reduced decode never shows in the output.
+REDUCING_GAP = 2.0
+
+
+def request_reduced_decode(img, thumbnail_size):
+    """Ask the decoder for the smallest scale that still allows a quality resample.
+
+    For JPEG this enables libjpeg's DCT scaling (1/2, 1/4 or 1/8 size), so
+    the full-resolution pixels are never produced. Other formats ignore the
+    request; they are shrunk by an integer ``reduce`` step inside
+    ``Image.thumbnail`` instead.
+    """
+    scale = thumbnail_size * REDUCING_GAP / max(img.width, img.height)
+    if scale >= 1:
+        return
+    img.draft(img.mode, (math.ceil(img.width * scale), math.ceil(img.height * scale)))
+
+
+def supported_modern_formats():
+    """The MODERN_FORMATS this Pillow build can encode"""
+    Image.init()
+    return tuple(fmt for fmt in MODERN_FORMATS if fmt in Image.SAVE)
+
+
+def fallback_format(file_path):
+    """Thumbnail format for clients that accept no modern format.
+
+    JPEG, except for source types that can be transparent: those get PNG so
+    the alpha channel survives.
+    """
+    return 'PNG' if os.path.splitext(file_path.lower())[1] in ALPHA_EXTENSIONS else 'JPEG'
+
+
+def has_alpha(img):
+    """Check whether an image carries transparency"""
+    return img.mode in ('RGBA', 'LA', 'PA') or (img.mode == 'P' and 'transparency' in img.info)
+
+
+def render_thumbnail(file_path, thumbnail_size, output_format='JPEG', quality=None, timings=None):
+    """Decode an image, scale it down and return the encoded thumbnail bytes.
+
+    The thumbnail is turned upright according to the EXIF orientation, and
+    carries no EXIF itself. ``timings``, if given, is a dict that receives
+    the seconds spent in the ``decode``, ``resize`` and ``encode`` stages.
+    """
+    started = time.perf_counter()
+    with Image.open(file_path) as img:
+        orientation = img.getexif().get(EXIF_ORIENTATION)
+        request_reduced_decode(img, thumbnail_size)
+        img.load()
+        decoded = time.perf_counter()
+
+        # JPEG has no alpha channel; every other output format keeps it
+        if output_format == 'JPEG':
+            if img.mode in ('RGBA', 'LA', 'P'):
+                img = img.convert('RGB')
+        elif has_alpha(img):
+            img = img.convert('RGBA')
+        elif img.mode not in ('RGB', 'L'):
+            img = img.convert('RGB')
+
+        # Create thumbnail: integer reduce() down to REDUCING_GAP times the
+        # target size, then a LANCZOS resample for the rest
+        img.thumbnail((thumbnail_size, thumbnail_size), Image.Resampling.LANCZOS,
+                      reducing_gap=REDUCING_GAP)
+        # The bound is square, so turning the smaller image afterwards is equivalent
+        if orientation in ORIENTATION_TRANSPOSE:
+            img = img.transpose(ORIENTATION_TRANSPOSE[orientation])
+        resized = time.perf_counter()
+
+        # Save to bytes
+        options = dict(SAVE_OPTIONS.get(output_format, {}))
+        if quality is not None:
+            options['quality'] = quality
+        img_bytes = io.BytesIO()
+        img.save(img_bytes, format=output_format, **options)
+        if timings is not None:
+            timings.update(decode=decoded - started, resize=resized - decoded,
+                           encode=time.perf_counter() - resized)
+        return img_bytes.getvalue()
+
+
+def _render_thumbnail_timed(*args):
+    """render_thumbnail for worker processes: returns the bytes and the stage timings"""
+    timings = {}
+    return render_thumbnail(*args, timings=timings), timings
+
+
+class RenderError(Exception):
+    """Raised when a render job times out or its worker process dies"""
+
+
+class RenderPool:
+    """Render thumbnails in a pool of worker processes.
+
+    Decoding and resampling are CPU bound, so a process pool lets renders use
+    every core instead of contending for the GIL. Jobs return encoded bytes.
+    A job that runs longer than ``timeout`` or kills its worker (for example
+    a decoder crash on a corrupt file) fails with RenderError, and the pool
+    is replaced so later jobs are unaffected. Jobs are only submitted while
+    a worker is free, so time spent waiting behind other jobs doesn't count
+    against the timeout.
+    """
+
+    def __init__(self, processes, timeout=30.0):
+        self.processes = processes
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._free_workers = threading.Semaphore(processes)
+        self._executor = self._create_executor()
+
+    def _create_executor(self):
+        # Spawned (not forked) workers don't inherit the listening socket, so
+        # an orphaned worker can never keep the server port bound
+        return ProcessPoolExecutor(max_workers=self.processes,
+                                   mp_context=multiprocessing.get_context('spawn'))
+
+    def render(self, file_path, thumbnail_size, output_format='JPEG', quality=None, timings=None):
+        """Render a thumbnail in a worker process and return the encoded bytes"""
+        for _ in range(2):
+            with self._free_workers:
+                executor = self._executor
+                try:
+                    future = executor.submit(_render_thumbnail_timed, os.path.abspath(file_path),
+                                             thumbnail_size, output_format, quality)
+                    data, stage_timings = future.result(timeout=self.timeout)
+                    if timings is not None:
+                        timings.update(stage_timings)
+                    return data
+                except FutureTimeoutError:
+                    self._restart(executor)
+                    raise RenderError(f"Rendering timed out after {self.timeout:g}s")
+                except BrokenProcessPool:
+                    if self._restart(executor):
+                        raise RenderError("Render worker crashed")
+                    # The pool was torn down because of another job; retry once
+        raise RenderError("Render worker crashed")
+
+    def _restart(self, broken):
+        """Replace the executor; returns False if another thread already did"""
+        with self._lock:
+            if self._executor is not broken:
+                return False
+            self._executor = self._create_executor()
+        # A timed-out job may still be running; stop its worker processes
+        for process in list((getattr(broken, '_processes', None) or {}).values()):
+            process.terminate()
+        broken.shutdown(wait=False)
+        return True
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
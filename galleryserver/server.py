@@ -1,600 +1,1125 @@
 #!/usr/bin/env python3
+import contextlib
 import http.server
-import socketserver
 import os
+import select
+import sqlite3
+import stat
 import urllib.parse
 import mimetypes
-from PIL import Image
-import io
 import argparse
+import datetime
+import email.utils
+import functools
+import json
+import math
+import sys
+import time
+
+from . import __version__
+from .accesslog import DEFAULT_BACKUP_COUNT, DEFAULT_HIT_SAMPLE_RATE, AccessLog
+from .aioserver import AsyncHTTPServer
+from .assets import ASSET_PREFIX, ASSETS, ASSETS_VERSION, GALLERY_CSS_ASSET, GALLERY_JS_ASSET
+from .cache import (
+    DEFAULT_CACHE_DIR,
+    DEFAULT_CACHE_MAX_BYTES,
+    DEFAULT_MEMORY_CACHE_BYTES,
+    ThumbnailDiskCache,
+    ThumbnailMemoryCache,
+    thumbnail_cache_key,
+)
+from .compression import (
+    MAX_COMPRESS_FILE_SIZE,
+    MIN_COMPRESS_SIZE,
+    CompressedResponseCache,
+    StreamEncoder,
+    choose_encoding,
+    compress,
+    is_compressible_type,
+    parse_accept_encoding,
+)
+from .listing import DirectoryIndex, scan_directory
+from .metadata import DEFAULT_METADATA_DB_NAME, DEFAULT_RESCAN_INTERVAL, MetadataIndex, MetadataIndexer, display_size
+from .metrics import METRICS_CONTENT_TYPE, METRICS_PATH, CountingWriter, Metrics
+from .pool import PooledTCPServer, default_worker_count
+from .prewarm import Prewarmer
+from .prewarm import main as prewarm_main
+from .ranges import MultipartByteranges, UnsatisfiableRange, parse_range_header
+from .render import (
+    FORMAT_MEDIA_TYPES,
+    IMAGE_EXTENSIONS,
+    PREVIEW_SIZE,
+    PREWARM_SIZES,
+    THUMBNAIL_SIZES,
+    RenderPool,
+    fallback_format,
+    render_thumbnail,
+    supported_modern_formats,
+)
+from .singleflight import SingleFlight
+from .sprites import SPRITE_CELL, SPRITE_COLUMNS, SPRITE_SOURCE_SIZE, compose_sprite_sheet, sprite_layout
+from .tracing import DEFAULT_TRACE_DIR_NAME, DEFAULT_TRACE_KEEP, NULL_SPAN, PROFILE_HEADER, PROFILE_QUERY_FLAG, Tracer
+from .watch import DEFAULT_POLL_INTERVAL, CacheInvalidator, StatCache, create_watcher
+
+# Entries per listing window, and the largest window the JSON API hands out
+DEFAULT_PAGE_SIZE = 200
+MAX_PAGE_SIZE = 1000
+
+# Listing orders offered by ?sort=; a leading '-' reverses one
+SORT_ORDERS = (('name', 'Name'), ('-date', 'Newest'), ('date', 'Oldest'), ('-size', 'Largest'))
+
+# Rendered tile widths at the grid breakpoints of gallery.css
+THUMBNAIL_SIZES_ATTR = '(max-width: 480px) 100vw, (max-width: 768px) 50vw, 360px'
+
+# Streamed responses are written in pieces of about this many bytes
+STREAM_CHUNK_SIZE = 16 * 1024
+
+# Persistent connections: seconds a connection may sit idle between requests,
+# and requests answered on one connection before it is closed
+DEFAULT_KEEPALIVE_TIMEOUT = 5.0
+DEFAULT_MAX_KEEPALIVE_REQUESTS = 100
+
+# How often an idle connection checks whether its worker is needed elsewhere
+IDLE_POLL_INTERVAL = 0.25
+
+class BodylessWriter:
+    """Wrap a handler's wfile for a HEAD request: headers go out, the body is dropped"""
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.headers_sent = False
+
+    def write(self, data):
+        if self.headers_sent:
+            return len(data)
+        return self.raw.write(data)
+
+    def flush(self):
+        self.raw.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
 
 class ThumbnailHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
-    def __init__(self, *args, thumbnail_size=200, **kwargs):
+    # Every response carries Content-Length or chunked framing, so
+    # connections stay open for the burst of thumbnail requests a page makes
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out as separate writes; with Nagle's algorithm the
+    # body would wait for the client's delayed ACK of the headers (~40 ms)
+    disable_nagle_algorithm = True
+    
+    def __init__(self, *args, thumbnail_size=200, thumbnail_cache=None, memory_cache=None,
+                 render_flight=None, render_pool=None, listing_index=None, page_size=DEFAULT_PAGE_SIZE,
+                 compression=True, compressed_cache=None, keepalive_timeout=DEFAULT_KEEPALIVE_TIMEOUT,
+                 max_keepalive_requests=DEFAULT_MAX_KEEPALIVE_REQUESTS, thumbnail_formats=(),
+                 sprites=False, metadata_index=None, metadata_indexer=None, stat_cache=None,
+                 metrics=None, tracer=None, access_log=None, private_paths=(), **kwargs):
         self.thumbnail_size = thumbnail_size
+        self.thumbnail_cache = thumbnail_cache
+        self.memory_cache = memory_cache
+        self.render_flight = render_flight
+        self.render_pool = render_pool
+        self.listing_index = listing_index
+        self.page_size = page_size
+        self.compression = compression
+        self.compressed_cache = compressed_cache
+        # Also the socket timeout while a request is being read or written
+        self.timeout = keepalive_timeout
+        self.max_keepalive_requests = max_keepalive_requests
+        self.thumbnail_formats = thumbnail_formats
+        self.sprites = sprites
+        self.metadata_index = metadata_index
+        self.metadata_indexer = metadata_indexer
+        self.stat_cache = stat_cache
+        self.metrics = metrics
+        self.tracer = tracer
+        self.access_log = access_log
+        # Absolute paths of the server's own state (caches, index, traces,
+        # logs) that may sit inside the served tree but are never served
+        self.private_paths = private_paths
+        self.trace = None
+        self.route = None
+        self.response_code = None
+        self.cache_status = None
+        self.render_seconds = 0.0
+        self.sendfile_bytes = 0
+        self.requests_handled = 0
         super().__init__(*args, **kwargs)
     
+    def handle(self):
+        """Serve requests on this connection until it closes, idles out or hits the request limit"""
+        self.close_connection = False
+        track_request = getattr(self.server, 'track_request', contextlib.nullcontext)
+        while not self.close_connection and self.wait_for_next_request():
+            self.requests_handled += 1
+            try:
+                with track_request():
+                    self.handle_one_request()
+            except ConnectionError:
+                # Browsers drop idle persistent connections whenever they like
+                self.close_connection = True
+    
+    def wait_for_next_request(self):
+        """Wait for the next request to arrive on this connection.
+        
+        Returns False when the connection should be closed instead: it stayed
+        idle for the keep-alive timeout, or the server wants the worker back
+        for queued connections or to shut down.
+        """
+        # A pipelined request may already sit in the read buffer, where
+        # select() can't see it; peek without blocking
+        self.connection.settimeout(0.0)
+        try:
+            if self.rfile.peek(1):
+                return True
+        except OSError:
+            return False
+        finally:
+            self.connection.settimeout(self.timeout)
+        
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        while True:
+            wait = IDLE_POLL_INTERVAL
+            if deadline is not None:
+                wait = min(wait, deadline - time.monotonic())
+                if wait <= 0:
+                    return False
+            readable, _, _ = select.select([self.connection], [], [], wait)
+            if readable:
+                return True
+            if getattr(self.server, 'reclaim_idle_connections', False):
+                return False
+    
+    def handle_one_request(self):
+        """Answer one request, recording it in the metrics, the access log and, if traced, in a trace"""
+        if self.metrics is None and self.tracer is None and self.access_log is None:
+            super().handle_one_request()
+            return
+        if not isinstance(self.wfile, CountingWriter):
+            self.wfile = CountingWriter(self.wfile)
+        self.route = self.response_code = self.cache_status = None
+        self.sendfile_bytes = 0
+        self.render_seconds = 0.0
+        self.trace = self.tracer.begin() if self.tracer is not None else None
+        written = self.wfile.count
+        started = time.perf_counter()
+        try:
+            super().handle_one_request()
+        finally:
+            elapsed = time.perf_counter() - started
+            # In metrics and traces revalidations are their own route: they cost a stat, never a render
+            route = 'not_modified' if self.response_code == 304 else self.route or 'other'
+            sent = self.wfile.count - written + self.sendfile_bytes
+            if self.metrics is not None and self.response_code is not None:
+                self.metrics.observe_request(route, self.response_code, elapsed, sent)
+            if self.access_log is not None and self.response_code is not None:
+                record = {
+                    'client': self.client_address[0],
+                    'method': self.command,
+                    'path': self.path,
+                    'status': self.response_code,
+                    # The status already marks revalidations; keep the route they belong to
+                    'route': self.route or 'other',
+                    'bytes': sent,
+                    'duration_ms': round(elapsed * 1000, 3),
+                    'cache': self.cache_status,
+                }
+                if self.render_seconds:
+                    record['render_ms'] = round(self.render_seconds * 1000, 3)
+                self.access_log.request(record)
+            if self.trace is not None:
+                self.tracer.finish(self.trace, self, route, self.response_code, elapsed)
+            self.trace = None
+    
+    def log_request(self, code='-', size='-'):
+        # With an access log, handle_one_request writes one record per request instead
+        if self.access_log is None:
+            super().log_request(code, size)
+    
+    def log_error(self, format, *args):
+        # The access log record of the response already carries its status
+        if self.access_log is None or format != 'code %d, message %s':
+            super().log_error(format, *args)
+    
+    def log_message(self, format, *args):
+        """Send messages to the access log as error records, or to stderr without one"""
+        if self.access_log is None:
+            super().log_message(format, *args)
+        else:
+            self.access_log.error(format % args, client=self.client_address[0],
+                                  path=getattr(self, 'path', None))
+    
+    def span(self, name):
+        """Time a named stage of the current request when it is being traced"""
+        return self.trace.span(name) if self.trace is not None else NULL_SPAN
+    
+    def send_response_only(self, code, message=None):
+        self.response_code = code
+        super().send_response_only(code, message)
+    
+    def end_headers(self):
+        # Announce the end of a persistent connection on its last response
+        if not self.close_connection:
+            if (self.requests_handled >= self.max_keepalive_requests
+                    or getattr(self.server, 'reclaim_idle_connections', False)):
+                self.send_header('Connection', 'close')
+            elif self.request_version == 'HTTP/1.0':
+                # HTTP/1.0 clients that asked for keep-alive expect it confirmed
+                self.send_header('Connection', 'keep-alive')
+        super().end_headers()
+        if isinstance(self.wfile, BodylessWriter):
+            self.wfile.headers_sent = True
+    
+    def do_HEAD(self):
+        """Answer like GET, with the same status and headers but no body"""
+        wfile = self.wfile
+        self.wfile = BodylessWriter(wfile)
+        try:
+            self.do_GET()
+        finally:
+            self.wfile = wfile
+    
     def do_GET(self):
         # Parse the URL
         parsed_path = urllib.parse.urlparse(self.path)
         query_params = urllib.parse.parse_qs(parsed_path.query)
+        if self.tracer is not None:
+            self.trace = self.tracer.profile(self, query_params, self.trace)
         
+        if self.is_private_path(parsed_path.path):
+            self.route = 'static'
+            self.send_error(404, "File not found")
         # Check if this is a thumbnail request
-        if 'thumb' in query_params and parsed_path.path != '/':
-            self.serve_thumbnail(parsed_path.path)
+        elif parsed_path.path.startswith(ASSET_PREFIX):
+            self.route = 'static'
+            self.serve_asset(parsed_path.path)
+        elif parsed_path.path == METRICS_PATH and self.metrics is not None:
+            self.route = 'metrics'
+            self.serve_metrics()
+        elif 'thumb' in query_params and parsed_path.path != '/':
+            self.route = 'thumbnail'
+            self.serve_thumbnail(parsed_path.path, self.rendition_size(query_params['thumb'][0]))
         elif parsed_path.path == '/' or parsed_path.path.endswith('/'):
-            self.serve_directory_with_thumbnails(parsed_path.path)
+            self.route = 'sprite' if 'sprite' in query_params else 'listing'
+            self.serve_directory_with_thumbnails(parsed_path.path, query_params)
         else:
-            # Serve regular files
-            super().do_GET()
+            self.route = 'static'
+            if not self.serve_compressed_file(parsed_path.path) and not self.serve_file(parsed_path.path):
+                # Directories without a trailing slash, missing files, etc.
+                super().do_GET()
     
-    def serve_thumbnail(self, path):
-        """Generate and serve a thumbnail for an image"""
+    def is_private_path(self, path):
+        """True for URL paths inside one of the private paths"""
+        if not self.private_paths:
+            return False
+        file_path = os.path.normpath(self.translate_path(path))
+        return any(file_path == private or file_path.startswith(private + os.sep)
+                   for private in self.private_paths)
+    
+    def rendition_size(self, value):
+        """Map a ?thumb= value to a rendition size.
+        
+        ``1`` (or anything unparsable) is the --thumbnail-size default,
+        ``preview`` the modal view, and a pixel size rounds up to a bucket.
+        """
+        if value == 'preview':
+            return PREVIEW_SIZE
+        try:
+            requested = int(value)
+        except ValueError:
+            return self.thumbnail_size
+        if requested <= 1:
+            return self.thumbnail_size
+        for size in THUMBNAIL_SIZES:
+            if size >= requested:
+                return size
+        return THUMBNAIL_SIZES[-1]
+    
+    def serve_thumbnail(self, path, size=None):
+        """Generate and serve a thumbnail (or preview) of an image at one rendition size"""
         try:
             # Remove leading slash and decode URL
             file_path = urllib.parse.unquote(path[1:])
             
-            if not os.path.exists(file_path) or not self.is_image_file(file_path):
+            try:
+                with self.span('stat'):
+                    st = self.stat_path(file_path) if self.is_image_file(file_path) else None
+            except OSError:
+                st = None
+            if st is None:
                 self.send_error(404, "File not found or not an image")
                 return
             
-            # Generate thumbnail
-            with Image.open(file_path) as img:
-                # Convert to RGB if necessary (for PNG with transparency, etc.)
-                if img.mode in ('RGBA', 'LA', 'P'):
-                    img = img.convert('RGB')
-                
-                # Create thumbnail
-                img.thumbnail((self.thumbnail_size, self.thumbnail_size), Image.Resampling.LANCZOS)
-                
-                # Save to bytes
-                img_bytes = io.BytesIO()
-                img.save(img_bytes, format='JPEG', quality=85)
-                img_bytes.seek(0)
-                
-                # Send response
-                self.send_response(200)
-                self.send_header('Content-Type', 'image/jpeg')
-                self.send_header('Content-Length', len(img_bytes.getvalue()))
-                self.send_header('Cache-Control', 'max-age=3600')  # Cache for 1 hour
-                self.end_headers()
-                self.wfile.write(img_bytes.getvalue())
+            # Validators come from the source file and render parameters,
+            # so revalidation never needs to touch PIL
+            size = size or self.thumbnail_size
+            output_format = self.choose_thumbnail_format(file_path)
+            etag = '"%s"' % thumbnail_cache_key(file_path, st, size, output_format)[:32]
+            if self.is_not_modified(etag, st.st_mtime):
+                self.send_not_modified(etag, st.st_mtime, 'max-age=3600')
+                return
+            
+            with self.span('thumbnail'):
+                thumbnail = self.get_thumbnail(file_path, size, output_format)
+            
+            # Send response
+            self.send_response(200)
+            self.send_header('Content-Type', FORMAT_MEDIA_TYPES[output_format])
+            self.send_header('Content-Length', len(thumbnail))
+            self.send_header('Vary', 'Accept')
+            self.send_header('Cache-Control', 'max-age=3600')  # Cache for 1 hour
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', self.date_time_string(st.st_mtime))
+            self.end_headers()
+            with self.span('write'):
+                self.wfile.write(thumbnail)
                 
         except Exception as e:
-            print(f"Error generating thumbnail for {path}: {e}")
+            self.log_error("Error generating thumbnail for %s: %s", path, e)
             self.send_error(500, f"Error generating thumbnail: {str(e)}")
     
-    def serve_directory_with_thumbnails(self, path):
-        """Serve directory listing with image thumbnails"""
+    def stat_path(self, path):
+        """os.stat, answered from the watcher-maintained stat cache when there is one"""
+        if self.stat_cache is not None:
+            return self.stat_cache.stat(path)
+        return os.stat(path)
+    
+    def choose_thumbnail_format(self, file_path=None):
+        """Pick the best thumbnail encoding the client lists in Accept, or the fallback.
+        
+        Without a file_path (for sprite sheets) the fallback is always JPEG.
+        """
+        # Accept uses the same "token;q=" syntax as Accept-Encoding. Only an
+        # explicit media type counts: */* doesn't promise AVIF or WebP support.
+        accepted = parse_accept_encoding(self.headers.get('Accept'))
+        for output_format in self.thumbnail_formats:
+            if accepted.get(FORMAT_MEDIA_TYPES[output_format], 0.0) > 0:
+                return output_format
+        return fallback_format(file_path) if file_path is not None else 'JPEG'
+    
+    def preferred_thumbnail_format(self, file_path):
+        """The format most clients are sent, which is also the one prewarmed"""
+        return self.thumbnail_formats[0] if self.thumbnail_formats else fallback_format(file_path)
+    
+    def get_thumbnail(self, file_path, size=None, output_format='JPEG'):
+        """Return encoded thumbnail bytes, checking the memory and disk caches first"""
+        size = size or self.thumbnail_size
+        st = self.stat_path(file_path)
+        memory_key = (os.path.normpath(file_path), size, output_format)
+        # Previews are large and viewed one at a time; keep them out of the
+        # memory cache so they don't push out whole pages of grid tiles
+        use_memory_cache = self.memory_cache is not None and size < PREVIEW_SIZE
+        if use_memory_cache:
+            with self.span('memory_cache'):
+                thumbnail = self.memory_cache.get(memory_key, st)
+            if thumbnail is not None:
+                self.cache_status = 'memory'
+                return thumbnail
+        
+        # Overwritten below unless another request's render is shared
+        self.cache_status = 'shared'
+        if self.render_flight is None:
+            thumbnail = self.load_or_render_thumbnail(file_path, st, size, output_format)
+        else:
+            # Concurrent requests for the same rendition share one render
+            flight_key = memory_key + (st.st_mtime_ns, st.st_size)
+            thumbnail = self.render_flight.do(flight_key, self.load_or_render_thumbnail,
+                                              file_path, st, size, output_format)
+        
+        if use_memory_cache:
+            self.memory_cache.put(memory_key, st, thumbnail)
+        return thumbnail
+    
+    def load_or_render_thumbnail(self, file_path, st, size=None, output_format='JPEG'):
+        """Read a thumbnail from the disk cache, rendering and storing it on a miss"""
+        size = size or self.thumbnail_size
+        if self.thumbnail_cache is None:
+            return self.render_thumbnail(file_path, size, output_format)
+        
+        key = thumbnail_cache_key(file_path, st, size, output_format)
+        with self.span('disk_cache'):
+            thumbnail = self.thumbnail_cache.get(key)
+        self.cache_status = 'disk'
+        if thumbnail is None:
+            thumbnail = self.render_thumbnail(file_path, size, output_format)
+            try:
+                with self.span('disk_cache_put'):
+                    self.thumbnail_cache.put(key, thumbnail)
+            except OSError as e:
+                self.log_error("Error writing thumbnail cache for %s: %s", file_path, e)
+        return thumbnail
+    
+    def render_thumbnail(self, file_path, size=None, output_format='JPEG'):
+        """Render a thumbnail, in the render process pool when one is configured"""
+        size = size or self.thumbnail_size
+        self.cache_status = 'render'
+        timed = self.metrics is not None or self.trace is not None or self.access_log is not None
+        timings = {} if timed else None
+        with self.span('render'):
+            if self.render_pool is not None:
+                thumbnail = self.render_pool.render(file_path, size, output_format, timings=timings)
+            else:
+                thumbnail = render_thumbnail(file_path, size, output_format, timings=timings)
+            if timings and self.trace is not None:
+                self.trace.add_stages(timings)
+        if timings:
+            self.render_seconds += sum(timings.values())
+        if timings and self.metrics is not None:
+            self.metrics.observe_render(timings)
+        return thumbnail
+    
+    def serve_file(self, path):
+        """Serve a regular file with Range support; returns False to fall back to the plain handler"""
+        file_path = self.translate_path(path)
+        try:
+            f = open(file_path, 'rb')
+        except OSError:
+            return False
+        
+        with f:
+            st = os.fstat(f.fileno())
+            if not stat.S_ISREG(st.st_mode):
+                return False
+            
+            size = st.st_size
+            content_type = self.guess_type(file_path)
+            etag = '"%x-%x"' % (st.st_mtime_ns, size)
+            if self.is_not_modified(etag, st.st_mtime):
+                self.send_not_modified(etag, st.st_mtime)
+                return True
+            
+            ranges = None
+            if self.range_applies(etag, st.st_mtime):
+                try:
+                    ranges = parse_range_header(self.headers.get('Range'), size)
+                except UnsatisfiableRange:
+                    self.send_response(416)
+                    self.send_header('Content-Range', f'bytes */{size}')
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return True
+            
+            if ranges is None:
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', size)
+            elif len(ranges) == 1:
+                start, end = ranges[0]
+                self.send_response(206)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+                self.send_header('Content-Length', end - start + 1)
+            else:
+                multipart = MultipartByteranges(ranges, size, content_type)
+                self.send_response(206)
+                self.send_header('Content-Type', multipart.content_type)
+                self.send_header('Content-Length', multipart.content_length())
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', self.date_time_string(st.st_mtime))
+            self.end_headers()
+            
+            if ranges is None:
+                self.send_file_range(f, 0, size)
+            elif len(ranges) == 1:
+                self.send_file_range(f, start, end - start + 1)
+            else:
+                for head, start, end in multipart.parts:
+                    self.wfile.write(head)
+                    self.send_file_range(f, start, end - start + 1)
+                self.wfile.write(multipart.trailer)
+        return True
+    
+    def range_applies(self, etag, mtime):
+        """Check If-Range: a stale validator means the whole file is sent instead"""
+        if_range = self.headers.get('If-Range')
+        if if_range is None:
+            return True
+        if_range = if_range.strip()
+        if if_range.startswith('"'):
+            # Strong comparison only
+            return if_range == etag
+        try:
+            since = email.utils.parsedate_to_datetime(if_range)
+        except (TypeError, IndexError, OverflowError, ValueError):
+            return False
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=datetime.timezone.utc)
+        return int(mtime) == int(since.timestamp())
+    
+    def send_file_range(self, f, offset, count):
+        """Copy part of a file to the client, zero-copy via sendfile where the OS supports it"""
+        if count <= 0 or self.command == 'HEAD':
+            return
+        self.wfile.flush()
+        # socket.sendfile uses os.sendfile when available and falls back to
+        # plain send() otherwise (e.g. on Windows)
+        with self.span('sendfile'):
+            self.sendfile_bytes += self.connection.sendfile(f, offset, count)
+    
+    def serve_directory_with_thumbnails(self, path, query_params=None):
+        """Serve directory listing with image thumbnails, or one window of it as JSON"""
         try:
             # Remove leading slash and decode URL
             dir_path = urllib.parse.unquote(path[1:]) if path != '/' else '.'
             
-            if not os.path.exists(dir_path) or not os.path.isdir(dir_path):
+            try:
+                with self.span('stat'):
+                    dir_stat = self.stat_path(dir_path)
+            except OSError:
+                dir_stat = None
+            if dir_stat is None or not stat.S_ISDIR(dir_stat.st_mode):
                 self.send_error(404, "Directory not found")
                 return
             
+            # The listing changes when entries are added, removed or renamed,
+            # which is exactly when the directory mtime changes; pages also
+            # carry what the metadata index knew about this folder when they were built
+            dir_mtime = dir_stat.st_mtime
+            version = self.metadata_index.directory_version(dir_path) if self.metadata_index is not None else 0
+            etag = 'W/"%x-%x-%s-%s"' % (dir_stat.st_mtime_ns, version, __version__, ASSETS_VERSION)
+            if self.is_not_modified(etag, dir_mtime):
+                self.send_not_modified(etag, dir_mtime, 'no-cache')
+                return
+            
             # Get directory contents
             try:
-                entries = os.listdir(dir_path)
-                entries.sort()
+                with self.span('listing'):
+                    if self.listing_index is not None:
+                        entries = self.listing_index.get(dir_path, dir_stat)
+                    else:
+                        entries = scan_directory(dir_path)
             except OSError:
                 self.send_error(404, "Cannot list directory")
                 return
             
-            # Generate HTML
-            html = self.generate_directory_html(dir_path, entries, path)
+            sort = self.listing_sort(query_params)
+            if query_params and query_params.get('list') == ['json']:
+                self.serve_directory_json(dir_path, entries, path, query_params, etag, dir_mtime, sort)
+                return
+            if query_params and 'sprite' in query_params:
+                self.serve_sprite_sheet(dir_path, path, entries, query_params)
+                return
+            if query_params and query_params.get('list') == ['sprites']:
+                self.serve_sprite_map(dir_path, entries, path, etag, dir_mtime)
+                return
             
-            # Send response
+            # Repeat hits on an unchanged folder reuse the compressed page
+            coding = self.choose_response_encoding()
+            cache_key = ('html', path, sort, etag, coding)
+            if coding and self.compressed_cache is not None:
+                body = self.compressed_cache.get(cache_key)
+                if body is not None:
+                    self.cache_status = 'compressed'
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/html; charset=utf-8')
+                    self.send_header('Content-Length', len(body))
+                    self.send_header('Content-Encoding', coding)
+                    self.send_header('Vary', 'Accept-Encoding')
+                    self.send_header('Cache-Control', 'no-cache')
+                    self.send_header('ETag', etag)
+                    self.send_header('Last-Modified', self.date_time_string(dir_mtime))
+                    self.end_headers()
+                    self.wfile.write(body)
+                    return
+            
+            # Send response; the page is streamed as it is generated so the
+            # browser can fetch assets and thumbnails before it is complete
+            chunked = self.can_chunk()
             self.send_response(200)
             self.send_header('Content-Type', 'text/html; charset=utf-8')
-            self.send_header('Content-Length', len(html.encode('utf-8')))
+            if coding:
+                self.send_header('Content-Encoding', coding)
+            self.send_header('Vary', 'Accept-Encoding')
+            self.send_header('Cache-Control', 'no-cache')
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', self.date_time_string(dir_mtime))
+            if chunked:
+                self.send_header('Transfer-Encoding', 'chunked')
+            else:
+                # Without chunked framing the end of the body is the end of the connection
+                self.send_header('Connection', 'close')
             self.end_headers()
-            self.wfile.write(html.encode('utf-8'))
+            if self.command == 'HEAD':
+                return
+            
+            try:
+                encoder = StreamEncoder(coding) if coding else None
+                written = [] if coding and self.compressed_cache is not None else None
+                with self.span('html'):
+                    self.stream_lines(self.iter_directory_html(dir_path, entries, path, sort),
+                                      chunked, encoder, written)
+                if written is not None:
+                    self.compressed_cache.put(cache_key, b''.join(written))
+            except Exception as e:
+                # Headers are out; all we can do is cut the response short
+                self.log_error("Error streaming directory %s: %s", path, e)
+                self.close_connection = True
             
         except Exception as e:
-            print(f"Error serving directory {path}: {e}")
+            self.log_error("Error serving directory %s: %s", path, e)
             self.send_error(500, f"Error serving directory: {str(e)}")
     
-    def generate_directory_html(self, dir_path, entries, url_path):
-        """Generate HTML for directory listing with thumbnails"""
-        title = f"Gallery - {url_path if url_path != '/' else 'Root'}"
-        
-        # Start building HTML
-        html_parts = []
-        html_parts.append('<!DOCTYPE html>')
-        html_parts.append('<html lang="en">')
-        html_parts.append('<head>')
-        html_parts.append('    <meta charset="utf-8">')
-        html_parts.append('    <meta name="viewport" content="width=device-width, initial-scale=1.0">')
-        html_parts.append(f'    <title>{title}</title>')
-        
-        # Add CSS
-        css = '''    <style>
-        * {
-            margin: 0;
-            padding: 0;
-            box-sizing: border-box;
-        }
-        
-        body { 
-            font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, Oxygen, Ubuntu, Cantarell, sans-serif;
-            background: linear-gradient(135deg, #1a1a2e 0%, #16213e 50%, #0f3460 100%);
-            min-height: 100vh;
-            color: #e0e0e0;
-        }
-        
-        .header {
-            background: rgba(30, 30, 50, 0.95);
-            backdrop-filter: blur(10px);
-            padding: 20px;
-            margin-bottom: 30px;
-            box-shadow: 0 4px 20px rgba(0, 0, 0, 0.3);
-            border-bottom: 1px solid rgba(255, 255, 255, 0.1);
-        }
+    def listing_window(self, dir_path, entries, sort, offset, limit):
+        """Sort a listing and cut one window of it.
         
-        h1 { 
-            color: #ffffff;
-            font-size: clamp(1.5rem, 4vw, 2.5rem);
-            font-weight: 700;
-            text-align: center;
-            margin-bottom: 10px;
-        }
-        
-        .breadcrumb {
-            text-align: center;
-            color: #b0b0b0;
-            font-size: 0.9rem;
-        }
-        
-        .parent-button {
-            display: block;
-            width: 100%;
-            max-width: 300px;
-            margin: 20px auto;
-            padding: 15px 25px;
-            background: linear-gradient(135deg, #4facfe 0%, #00f2fe 100%);
-            color: white;
-            text-decoration: none;
-            border-radius: 50px;
-            font-size: 16px;
-            font-weight: 600;
-            text-align: center;
-            transition: all 0.3s ease;
-            box-shadow: 0 4px 15px rgba(79, 172, 254, 0.3);
-        }
-        
-        .parent-button:hover {
-            transform: translateY(-2px);
-            box-shadow: 0 8px 25px rgba(79, 172, 254, 0.4);
-        }
-        
-        .parent-button.disabled {
-            background: #444;
-            color: #888;
-            cursor: not-allowed;
-            box-shadow: none;
-        }
-        
-        .parent-button.disabled:hover {
-            transform: none;
-            box-shadow: none;
-        }
+        Returns the window's entries and the indexed {name: ImageMetadata}
+        of its images. Only date order needs the rows of the whole directory;
+        otherwise just the window's are read. Images the index doesn't know
+        yet are left out, and the directory is queued for indexing ahead of
+        the background walk.
+        """
+        if self.metadata_index is None:
+            return self.sort_entries(entries, sort, {})[offset:offset + limit], {}
+        with self.span('metadata'):
+            metadata = self.metadata_index.get_directory(dir_path) if sort.lstrip('-') == 'date' else None
+        window = self.sort_entries(entries, sort, metadata or {})[offset:offset + limit]
+        images = [e.name for e in window if not e.is_dir and self.is_image_file(e.name)]
+        if metadata is None:
+            with self.span('metadata'):
+                metadata = self.metadata_index.get_images(dir_path, images)
+        if self.metadata_indexer is not None and any(name not in metadata for name in images):
+            self.metadata_indexer.request(dir_path)
+        return window, metadata
+    
+    def listing_sort(self, query_params):
+        """The listing order asked for with ?sort=, 'name' by default"""
+        sort = (query_params or {}).get('sort', ['name'])[0]
+        return sort if sort.lstrip('-') in ('name', 'date', 'size') else 'name'
+    
+    def sort_entries(self, entries, sort, metadata):
+        """Order listing entries; folders stay first when sorting by date or size.
         
-        .container {
-            max-width: 1400px;
-            margin: 0 auto;
-            padding: 0 20px;
-        }
+        Dates are EXIF capture dates where the index has them and file
+        modification times otherwise.
+        """
+        field, reverse = sort.lstrip('-'), sort.startswith('-')
+        if field == 'name':
+            return entries[::-1] if reverse else entries
         
-        .grid {
-            display: grid;
-            grid-template-columns: repeat(auto-fill, minmax(280px, 1fr));
-            gap: 25px;
-            margin-bottom: 40px;
-        }
+        def date_key(entry):
+            row = metadata.get(entry.name)
+            if row is not None and row.taken:
+                return datetime.datetime.fromisoformat(row.taken).timestamp()
+            return entry.mtime or 0
         
-        .item {
-            background: rgba(45, 45, 70, 0.95);
-            backdrop-filter: blur(10px);
-            border-radius: 16px;
-            overflow: hidden;
-            box-shadow: 0 8px 32px rgba(0, 0, 0, 0.4);
-            transition: all 0.3s cubic-bezier(0.4, 0, 0.2, 1);
-            border: 1px solid rgba(255, 255, 255, 0.1);
-        }
+        key = date_key if field == 'date' else (lambda entry: entry.size or 0)
+        directories = [e for e in entries if e.is_dir]
+        files = sorted((e for e in entries if not e.is_dir), key=key, reverse=reverse)
+        return directories + files
+    
+    def can_chunk(self):
+        """Check whether this response may use chunked transfer encoding"""
+        return self.protocol_version >= 'HTTP/1.1' and self.request_version >= 'HTTP/1.1'
+    
+    def stream_lines(self, lines, chunked, encoder=None, written=None):
+        """Write lines of text to the client in STREAM_CHUNK_SIZE batches.
         
-        .item:hover {
-            transform: translateY(-8px) scale(1.02);
-            box-shadow: 0 20px 40px rgba(0, 0, 0, 0.6);
-            border-color: rgba(79, 172, 254, 0.3);
-        }
+        With an encoder each batch is compressed before it goes out; every
+        piece of body actually sent is appended to ``written`` when given.
+        """
+        def emit(data):
+            if encoder is not None:
+                data = encoder.compress(data)
+            self.write_body_chunk(data, chunked)
+            if written is not None:
+                written.append(data)
         
-        .thumbnail-container {
-            position: relative;
-            width: 100%;
-            height: 220px;
-            overflow: hidden;
-            background: linear-gradient(45deg, #2c2c3e, #1a1a2e);
-            cursor: pointer;
-        }
+        buffered = []
+        buffered_size = 0
+        for line in lines:
+            data = (line + '\n').encode('utf-8')
+            buffered.append(data)
+            buffered_size += len(data)
+            if buffered_size >= STREAM_CHUNK_SIZE:
+                emit(b''.join(buffered))
+                buffered = []
+                buffered_size = 0
+        if buffered:
+            emit(b''.join(buffered))
+        if encoder is not None:
+            tail = encoder.finish()
+            self.write_body_chunk(tail, chunked)
+            if written is not None:
+                written.append(tail)
+        if chunked:
+            self.wfile.write(b'0\r\n\r\n')
+    
+    def write_body_chunk(self, data, chunked):
+        """Write one piece of a streamed body, framed as a chunk if needed"""
+        if not data:
+            # An empty chunk would end a chunked body early
+            return
+        if chunked:
+            self.wfile.write(b'%X\r\n%s\r\n' % (len(data), data))
+        else:
+            self.wfile.write(data)
+    
+    def serve_directory_json(self, dir_path, entries, url_path, query_params, etag, dir_mtime, sort='name'):
+        """Serve the offset/limit window of a directory listing as JSON"""
+        try:
+            offset = max(0, int(query_params.get('offset', ['0'])[0]))
+            limit = int(query_params.get('limit', [str(self.page_size)])[0])
+        except ValueError:
+            self.send_error(400, "offset and limit must be integers")
+            return
+        limit = min(max(1, limit), MAX_PAGE_SIZE)
         
-        .thumbnail {
-            width: 100%;
-            height: 100%;
-            object-fit: cover;
-            transition: transform 0.3s ease, opacity 0.3s ease;
-        }
+        # scan_directory already leaves out hidden entries. Sprite sheets
+        # always follow name order, so their URLs don't depend on the sort
+        window, metadata = self.listing_window(dir_path, entries, sort, offset, limit)
+        with self.span('json'):
+            placements = self.sprite_layout(dir_path, entries)[1] if self.sprites else {}
+            body = json.dumps({
+                'path': url_path,
+                'offset': offset,
+                'limit': limit,
+                'total': len(entries),
+                'entries': [self.describe_entry(e, url_path, placements.get(e.name), metadata.get(e.name))
+                            for e in window],
+            }, ensure_ascii=False).encode('utf-8')
+        self.send_json(body, ('json', url_path, offset, limit, sort, etag), etag, dir_mtime)
+    
+    def send_json(self, body, cache_key, etag, mtime):
+        """Send an encoded JSON body, compressed (and cached) when worthwhile"""
+        coding = self.choose_response_encoding() if len(body) >= MIN_COMPRESS_SIZE else None
+        if coding:
+            cache_key = cache_key + (coding,)
+            compressed = self.compressed_cache.get(cache_key) if self.compressed_cache is not None else None
+            if compressed is not None:
+                self.cache_status = 'compressed'
+            else:
+                with self.span('compress'):
+                    compressed = compress(body, coding)
+                if self.compressed_cache is not None:
+                    self.compressed_cache.put(cache_key, compressed)
+            body = compressed
         
-        .item:hover .thumbnail {
-            transform: scale(1.1);
-        }
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', len(body))
+        if coding:
+            self.send_header('Content-Encoding', coding)
+        self.send_header('Vary', 'Accept-Encoding')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', self.date_time_string(mtime))
+        self.end_headers()
+        with self.span('write'):
+            self.wfile.write(body)
+    
+    def sprite_layout(self, dir_path, entries):
+        """The sprite layout of a listing, built once per cached listing"""
+        if self.listing_index is None:
+            return sprite_layout(entries)
+        return self.listing_index.derive(dir_path, entries, 'sprites', sprite_layout)
+    
+    def serve_sprite_map(self, dir_path, entries, url_path, etag, dir_mtime):
+        """Serve the sprite sheet layout of a directory as JSON"""
+        sheets, placements = self.sprite_layout(dir_path, entries)
+        tiles = {}
+        for name, (sheet, slot) in placements.items():
+            size, position = sheet.position(slot)
+            tiles[name] = {'sheet': sheet.index, 'slot': slot, 'size': size, 'position': position}
+        body = json.dumps({
+            'path': url_path,
+            'cell': list(SPRITE_CELL),
+            'columns': SPRITE_COLUMNS,
+            'sheets': [{'url': sheet.url(url_path), 'rows': sheet.rows, 'count': len(sheet.members)}
+                       for sheet in sheets],
+            'tiles': tiles,
+        }, ensure_ascii=False).encode('utf-8')
+        self.send_json(body, ('sprites', url_path, etag), etag, dir_mtime)
+    
+    def serve_sprite_sheet(self, dir_path, url_path, entries, query_params):
+        """Serve one sprite sheet: a directory's thumbnails tiled into a single image"""
+        sheets, _ = self.sprite_layout(dir_path, entries)
+        try:
+            listed = sheets[int(query_params['sprite'][0])]
+        except (ValueError, IndexError):
+            self.send_error(404, "Sprite sheet not found")
+            return
         
-        .item-content {
-            padding: 20px;
-        }
+        # The sheet is built from its members as they are now, which a
+        # cached listing may not know about
+        with self.span('stat'):
+            sheet = listed.restat(dir_path, self.stat_path)
+        output_format = self.choose_thumbnail_format()
+        key = sheet.cache_key(dir_path, output_format)
+        etag = '"%s"' % key[:32]
+        # The version in the URL pins the sheet contents. Pages only link the
+        # current version while a watcher keeps listings up to date; without
+        # one an image edited in place would keep its old sheet URL
+        if query_params.get('v') == [sheet.version] and self.stat_cache is not None:
+            cache_control = 'public, max-age=31536000, immutable'
+        else:
+            cache_control = 'no-cache'
+        if self.is_not_modified(etag, None):
+            self.send_not_modified(etag, None, cache_control)
+            return
         
-        .filename {
-            font-size: 16px;
-            font-weight: 600;
-            color: #ffffff;
-            text-decoration: none;
-            display: block;
-            margin-bottom: 8px;
-            word-break: break-word;
-            line-height: 1.4;
-        }
+        try:
+            if self.render_flight is None:
+                body = self.load_or_build_sprite_sheet(dir_path, sheet, key, output_format)
+            else:
+                body = self.render_flight.do(('sprite', key), self.load_or_build_sprite_sheet,
+                                             dir_path, sheet, key, output_format)
+        except Exception as e:
+            self.log_error("Error building sprite sheet for %s: %s", url_path, e)
+            self.send_error(500, f"Error building sprite sheet: {str(e)}")
+            return
         
-        .filename:hover {
-            color: #4facfe;
-        }
+        self.send_response(200)
+        self.send_header('Content-Type', FORMAT_MEDIA_TYPES[output_format])
+        self.send_header('Content-Length', len(body))
+        self.send_header('Vary', 'Accept')
+        self.send_header('Cache-Control', cache_control)
+        self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def load_or_build_sprite_sheet(self, dir_path, sheet, key, output_format):
+        """Read a sprite sheet from the disk cache, composing it from thumbnails on a miss.
         
-        .directory {
-            display: flex;
-            flex-direction: column;
-            align-items: center;
-            justify-content: center;
-            height: 220px;
-            font-size: 18px;
-            font-weight: 600;
-            color: white;
-            text-decoration: none;
-            background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-            transition: all 0.3s ease;
-        }
+        Cells come from the regular per-image thumbnails, so a sheet whose
+        membership changed is recomposed without re-rendering the images
+        that were already there.
+        """
+        if self.thumbnail_cache is not None:
+            body = self.thumbnail_cache.get(key)
+            if body is not None:
+                self.cache_status = 'disk'
+                return body
         
-        .directory:hover {
-            background: linear-gradient(135deg, #5a67d8 0%, #667eea 100%);
-        }
+        thumbnails = []
+        for entry in sheet.members:
+            file_path = os.path.join(dir_path, entry.name)
+            try:
+                thumbnails.append(self.get_thumbnail(file_path, SPRITE_SOURCE_SIZE,
+                                                     self.preferred_thumbnail_format(file_path)))
+            except Exception as e:
+                self.log_error("Error generating thumbnail for %s: %s", file_path, e)
+                thumbnails.append(None)
+        body = compose_sprite_sheet(thumbnails, output_format)
+        self.cache_status = 'render'
         
-        .directory-icon {
-            font-size: 3rem;
-            margin-bottom: 10px;
-            display: block;
-        }
+        if self.thumbnail_cache is not None:
+            try:
+                self.thumbnail_cache.put(key, body)
+            except OSError as e:
+                self.log_error("Error writing sprite sheet cache for %s: %s", dir_path, e)
+        return body
+    
+    def describe_entry(self, listing_entry, url_path, sprite=None, metadata=None):
+        """Describe one listing entry for the JSON listing API and the HTML grid.
         
-        .file-info {
-            font-size: 13px;
-            color: #b0b0b0;
-            display: flex;
-            justify-content: space-between;
-            align-items: center;
-        }
+        ``sprite`` is the entry's (sheet, slot) placement when sprite sheets
+        are enabled; ``metadata`` its row in the metadata index, if any.
+        """
+        entry = listing_entry.name
+        full_url = f"{url_path.rstrip('/')}/{urllib.parse.quote(entry)}"
         
-        .file-type {
-            background: rgba(79, 172, 254, 0.2);
-            color: #4facfe;
-            padding: 4px 8px;
-            border-radius: 12px;
-            font-size: 11px;
-            font-weight: 500;
-            text-transform: uppercase;
-            letter-spacing: 0.5px;
-            border: 1px solid rgba(79, 172, 254, 0.3);
-        }
+        if listing_entry.is_dir:
+            return {'name': entry, 'type': 'directory', 'url': full_url + '/'}
         
-        .image-overlay {
-            position: absolute;
-            top: 10px;
-            right: 10px;
-            background: rgba(0, 0, 0, 0.8);
-            color: white;
-            padding: 4px 8px;
-            border-radius: 12px;
-            font-size: 12px;
-            font-weight: 500;
+        info = {
+            'name': entry,
+            'url': full_url,
+            'size': listing_entry.size,
+            'size_text': self.format_file_size(listing_entry.size),
         }
+        if self.is_image_file(entry):
+            info['type'] = 'image'
+            info['thumb'] = f"{full_url}?thumb=1"
+            info['srcset'] = ', '.join(f"{full_url}?thumb={size} {width}w"
+                                       for size, width in self.rendition_widths(metadata))
+            info['sizes'] = THUMBNAIL_SIZES_ATTR
+            # A still JPEG preview would stop animated GIFs; those open as is
+            info['preview'] = full_url if entry.lower().endswith('.gif') else f"{full_url}?thumb=preview"
+            if sprite is not None:
+                sheet, slot = sprite
+                size, position = sheet.position(slot)
+                info['sprite'] = {'url': sheet.url(url_path), 'size': size, 'position': position}
+            if metadata is not None and metadata.width:
+                info['width'], info['height'] = display_size(metadata)
+                if metadata.taken:
+                    info['taken'] = metadata.taken
+            info['ext'] = os.path.splitext(entry)[1][1:].upper()
+        else:
+            info['type'] = 'text' if self.is_text_file(entry) else 'file'
+            info['ext'] = os.path.splitext(entry)[1][1:].upper() or 'FILE'
+            info['icon'] = self.get_file_icon(entry)
+        return info
+    
+    def rendition_widths(self, metadata=None):
+        """(size, pixel width) of each thumbnail bucket, for srcset.
         
-        .loading {
-            position: absolute;
-            top: 50%;
-            left: 50%;
-            transform: translate(-50%, -50%);
-            color: #888;
-            font-size: 14px;
-        }
+        Buckets bound the longer side, so without the image's dimensions the
+        width is assumed to be the bucket size; with them, portrait images
+        report their real, narrower widths and get a large enough bucket.
+        """
+        if metadata is None or not metadata.width or not metadata.height:
+            return [(size, size) for size in THUMBNAIL_SIZES]
+        # Thumbnails are rendered upright, so widths follow the EXIF orientation
+        width, height = display_size(metadata)
+        longest = max(width, height)
+        return [(size, max(1, round(width * min(1, size / longest)))) for size in THUMBNAIL_SIZES]
+    
+    def generate_entry_html(self, info):
+        """Generate the grid item markup for one described entry"""
+        name = self.escape_html(info['name'])
         
-        @media (max-width: 768px) {
-            .grid {
-                grid-template-columns: repeat(auto-fill, minmax(250px, 1fr));
-                gap: 20px;
-            }
-            
-            .header {
-                padding: 15px;
-                margin-bottom: 20px;
-            }
-            
-            .container {
-                padding: 0 15px;
-            }
-            
-            .thumbnail-container {
-                height: 180px;
-            }
-            
-            .item-content {
-                padding: 15px;
-            }
-        }
+        if info['type'] == 'directory':
+            return [
+                '            <div class="item fade-in">',
+                f'                <a href="{info["url"]}" class="directory">',
+                '                    <span class="directory-icon">📁</span>',
+                f'                    <div>{name}</div>',
+                '                </a>',
+                '            </div>'
+            ]
         
-        @media (max-width: 480px) {
-            .grid {
-                grid-template-columns: repeat(auto-fill, minmax(200px, 1fr));
-                gap: 15px;
-            }
-            
-            .thumbnail-container {
-                height: 160px;
-            }
-        }
+        if info['type'] == 'image' and 'sprite' in info:
+            # Image tile cut from a sprite sheet
+            sprite = info['sprite']
+            style = (f"background-image: url('{sprite['url']}'); background-size: {sprite['size']}; "
+                     f"background-position: {sprite['position']}")
+            return [
+                '            <div class="item fade-in">',
+                f'                <a href="{info["url"]}" target="_blank">',
+                '                    <div class="thumbnail-container">',
+                f'                        <div class="thumbnail sprite-tile" role="img" aria-label="{name}" '
+                f'style="{style}" data-preview="{info["preview"]}" data-full="{info["url"]}"></div>',
+                f'                        <div class="image-overlay">{info["ext"]}</div>',
+                '                    </div>',
+                '                    <div class="item-content">',
+                f'                        <div class="filename">{name}</div>',
+                '                        <div class="file-info">',
+                f'                            <span>{info["size_text"]}</span>',
+                '                            <span class="file-type">Image</span>',
+                '                        </div>',
+                '                    </div>',
+                '                </a>',
+                '            </div>'
+            ]
         
-        .fade-in {
-            animation: fadeIn 0.6s ease-out;
-        }
+        if info['type'] == 'image':
+            # Image file with thumbnail
+            return [
+                '            <div class="item fade-in">',
+                f'                <a href="{info["url"]}" target="_blank">',
+                '                    <div class="thumbnail-container">',
+                f'                        <img src="{info["thumb"]}" srcset="{info["srcset"]}" sizes="{info["sizes"]}" '
+                f'data-preview="{info["preview"]}" data-full="{info["url"]}" alt="{name}" class="thumbnail" loading="lazy">',
+                '                        <div class="loading" style="display: none;">🖼️ Image unavailable</div>',
+                f'                        <div class="image-overlay">{info["ext"]}</div>',
+                '                    </div>',
+                '                    <div class="item-content">',
+                f'                        <div class="filename">{name}</div>',
+                '                        <div class="file-info">',
+                f'                            <span>{info["size_text"]}</span>',
+                '                            <span class="file-type">Image</span>',
+                '                        </div>',
+                '                    </div>',
+                '                </a>',
+                '            </div>'
+            ]
         
-        @keyframes fadeIn {
-            from {
-                opacity: 0;
-                transform: translateY(20px);
-            }
-            to {
-                opacity: 1;
-                transform: translateY(0);
-            }
-        }
+        # Regular file; text files open in the same tab
+        is_text_file = info['type'] == 'text'
+        target_attr = '' if is_text_file else ' target="_blank"'
+        return [
+            '            <div class="item fade-in">',
+            f'                <a href="{info["url"]}"{target_attr}>',
+            '                    <div class="thumbnail-container">',
+            '                        <div class="directory" style="background: linear-gradient(135deg, #6c5ce7 0%, #a29bfe 100%);">',
+            f'                            <span class="directory-icon">{info["icon"]}</span>',
+            f'                            <div>{info["ext"]}</div>',
+            '                        </div>',
+            '                    </div>',
+            '                    <div class="item-content">',
+            f'                        <div class="filename">{name}</div>',
+            '                        <div class="file-info">',
+            f'                            <span>{info["size_text"]}</span>',
+            f'                            <span class="file-type">{"Text" if is_text_file else "File"}</span>',
+            '                        </div>',
+            '                    </div>',
+            '                </a>',
+            '            </div>'
+        ]
+    
+    def generate_directory_html(self, dir_path, entries, url_path, sort='name'):
+        """Generate HTML for directory listing with thumbnails"""
+        return '\n'.join(self.iter_directory_html(dir_path, entries, url_path, sort))
+    
+    def iter_directory_html(self, dir_path, entries, url_path, sort='name'):
+        """Yield the directory listing HTML line by line, header first"""
+        title = f"Gallery - {url_path if url_path != '/' else 'Root'}"
         
-        .no-items {
-            text-align: center;
-            padding: 60px 20px;
-            color: #b0b0b0;
-            font-size: 18px;
-            background: rgba(45, 45, 70, 0.9);
-            border-radius: 16px;
-            margin: 20px;
-            border: 1px solid rgba(255, 255, 255, 0.1);
-        }
-
-        /* Image Modal */
-        .modal {
-            display: none;
-            position: fixed;
-            z-index: 10000;
-            padding-top: 60px;
-            left: 0;
-            top: 0;
-            width: 100%;
-            height: 100%;
-            overflow: hidden;
-            background: rgba(0,0,0,0.9);
-            touch-action: none;
-        }
-
-        .modal-inner {
-            width: 100%;
-            height: 100%;
-            display: flex;
-            align-items: center;
-            justify-content: center;
-            position: relative;
-        }
-
-        .modal-content {
-            margin: auto;
-            display: block;
-            max-width: 90%;
-            max-height: 80vh;
-            transition: transform 0.2s ease;
-            will-change: transform;
-            cursor: grab;
-            touch-action: none;
-        }
-
-        .modal-content.grabbing {
-            cursor: grabbing;
-        }
-
-        .close {
-            position: absolute;
-            top: 20px;
-            right: 40px;
-            color: #fff;
-            font-size: 40px;
-            font-weight: bold;
-            cursor: pointer;
-            z-index: 10001;
-        }
-
-        .prev, .next {
-            cursor: pointer;
-            position: absolute;
-            top: 50%;
-            padding: 16px;
-            margin-top: -50px;
-            color: #fff;
-            font-weight: bold;
-            font-size: 40px;
-            user-select: none;
-            z-index: 10001;
-            background: rgba(0,0,0,0.2);
-            border-radius: 6px;
-        }
-
-        .prev { left: 10px; }
-        .next { right: 10px; }
-
-        .modal-caption {
-            text-align: center;
-            color: #bbb;
-            margin-top: 10px;
-            position: absolute;
-            bottom: 24px;
-            left: 50%;
-            transform: translateX(-50%);
-            z-index: 10001;
-            font-size: 14px;
-        }
-
-        .modal-controls {
-            position: absolute;
-            top: 20px;
-            left: 40px;
-            z-index: 10001;
-            display: flex;
-            gap: 10px;
-            align-items: center;
-        }
-
-        .control-btn {
-            background: rgba(255,255,255,0.06);
-            color: #fff;
-            padding: 8px 12px;
-            border-radius: 8px;
-            font-size: 14px;
-            cursor: pointer;
-            border: 1px solid rgba(255,255,255,0.06);
-        }
-
-        .control-btn.playing {
-            background: rgba(79, 172, 254, 0.95);
-            color: #04213a;
-            border-color: rgba(79,172,254,0.7);
-        }
-
-        @media (max-width: 480px) {
-            .close { right: 20px; font-size: 36px; top: 14px; }
-            .prev, .next { font-size: 32px; padding: 12px; }
-            .modal-caption { font-size: 13px; bottom: 18px; }
-        }
-    </style>'''
+        # Start building HTML
+        yield '<!DOCTYPE html>'
+        yield '<html lang="en">'
+        yield '<head>'
+        yield '    <meta charset="utf-8">'
+        yield '    <meta name="viewport" content="width=device-width, initial-scale=1.0">'
+        yield f'    <title>{title}</title>'
         
-        html_parts.append(css)
-        html_parts.append('</head>')
-        html_parts.append('<body>')
+        # Stylesheet is a versioned, long-cached static asset
+        yield f'    <link rel="stylesheet" href="{GALLERY_CSS_ASSET.url}">'
+        yield '</head>'
+        yield '<body>'
         
         # Header
-        html_parts.append('    <div class="header">')
-        html_parts.append(f'        <h1>{title}</h1>')
-        html_parts.append(f'        <div class="breadcrumb">{os.getcwd()}</div>')
-        html_parts.append('    </div>')
+        yield '    <div class="header">'
+        yield f'        <h1>{title}</h1>'
+        yield f'        <div class="breadcrumb">{os.getcwd()}</div>'
+        yield '    </div>'
         
-        html_parts.append('    <div class="container">')
+        yield '    <div class="container">'
         
         # Parent Directory Button
         if url_path != '/':
             parent_path = '/'.join(url_path.rstrip('/').split('/')[:-1]) + '/' if url_path.count('/') > 1 else '/'
-            html_parts.append(f'        <a href="{parent_path}" class="parent-button">')
-            html_parts.append('            ⬆️ Back to Parent Folder')
-            html_parts.append('        </a>')
+            yield f'        <a href="{parent_path}" class="parent-button">'
+            yield '            ⬆️ Back to Parent Folder'
+            yield '        </a>'
         else:
-            html_parts.append('        <div class="parent-button disabled">')
-            html_parts.append('            📁 Root Directory')
-            html_parts.append('        </div>')
+            yield '        <div class="parent-button disabled">'
+            yield '            📁 Root Directory'
+            yield '        </div>'
+        
+        # Hidden entries are already left out by scan_directory
+        visible_entries, metadata = self.listing_window(dir_path, entries, sort, 0, self.page_size)
         
-        # Count visible entries
-        visible_entries = [e for e in entries if not e.startswith('.')]
+        if visible_entries:
+            links = ' '.join(
+                f'<a href="?sort={value}" class="active">{label}</a>' if value == sort
+                else f'<a href="?sort={value}">{label}</a>'
+                for value, label in SORT_ORDERS)
+            yield f'        <div class="sort-links">Sort: {links}</div>'
         
         if not visible_entries:
-            html_parts.append('        <div class="no-items">📁 This directory is empty</div>')
+            yield '        <div class="no-items">📁 This directory is empty</div>'
         else:
-            html_parts.append('        <div class="grid">')
+            yield '        <div class="grid">'
             
-            # Process entries
-            for entry in visible_entries:
-                entry_path = os.path.join(dir_path, entry)
-                url_entry_path = urllib.parse.quote(entry)
-                
-                if os.path.isdir(entry_path):
-                    # Directory
-                    full_url = f"{url_path.rstrip('/')}/{url_entry_path}/"
-                    html_parts.extend([
-                        '            <div class="item fade-in">',
-                        f'                <a href="{full_url}" class="directory">',
-                        '                    <span class="directory-icon">📁</span>',
-                        f'                    <div>{self.escape_html(entry)}</div>',
-                        '                </a>',
-                        '            </div>'
-                    ])
-                elif self.is_image_file(entry):
-                    # Image file with thumbnail
-                    full_url = f"{url_path.rstrip('/')}/{url_entry_path}"
-                    thumb_url = f"{full_url}?thumb=1"
-                    file_size = self.get_file_size(entry_path)
-                    file_ext = os.path.splitext(entry)[1][1:].upper()
-                    
-                    html_parts.extend([
-                        '            <div class="item fade-in">',
-                        f'                <a href="{full_url}" target="_blank">',
-                        '                    <div class="thumbnail-container">',
-                        f'                        <img src="{thumb_url}" data-full="{full_url}" alt="{self.escape_html(entry)}" class="thumbnail" loading="lazy">',
-                        '                        <div class="loading" style="display: none;">🖼️ Image unavailable</div>',
-                        f'                        <div class="image-overlay">{file_ext}</div>',
-                        '                    </div>',
-                        '                    <div class="item-content">',
-                        f'                        <div class="filename">{self.escape_html(entry)}</div>',
-                        '                        <div class="file-info">',
-                        f'                            <span>{file_size}</span>',
-                        '                            <span class="file-type">Image</span>',
-                        '                        </div>',
-                        '                    </div>',
-                        '                </a>',
-                        '            </div>'
-                    ])
-                else:
-                    # Regular file
-                    full_url = f"{url_path.rstrip('/')}/{url_entry_path}"
-                    file_size = self.get_file_size(entry_path)
-                    file_ext = os.path.splitext(entry)[1][1:].upper() or 'FILE'
-                    
-                    # Get file type icon
-                    file_icon = self.get_file_icon(entry)
-                    
-                    # Check if file might be text-readable
-                    is_text_file = self.is_text_file(entry)
-                    target_attr = '' if is_text_file else ' target="_blank"'
-                    
-                    html_parts.extend([
-                        '            <div class="item fade-in">',
-                        f'                <a href="{full_url}"{target_attr}>',
-                        '                    <div class="thumbnail-container">',
-                        '                        <div class="directory" style="background: linear-gradient(135deg, #6c5ce7 0%, #a29bfe 100%);">',
-                        f'                            <span class="directory-icon">{file_icon}</span>',
-                        f'                            <div>{file_ext}</div>',
-                        '                        </div>',
-                        '                    </div>',
-                        '                    <div class="item-content">',
-                        f'                        <div class="filename">{self.escape_html(entry)}</div>',
-                        '                        <div class="file-info">',
-                        f'                            <span>{file_size}</span>',
-                        f'                            <span class="file-type">{"Text" if is_text_file else "File"}</span>',
-                        '                        </div>',
-                        '                    </div>',
-                        '                </a>',
-                        '            </div>'
-                    ])
+            # Only the first window is rendered; the rest is fetched from
+            # the JSON listing API as the user scrolls
+            placements = self.sprite_layout(dir_path, entries)[1] if self.sprites else {}
+            for listing_entry in visible_entries:
+                yield from self.generate_entry_html(
+                    self.describe_entry(listing_entry, url_path, placements.get(listing_entry.name),
+                                        metadata.get(listing_entry.name)))
+            
+            yield '        </div>'
             
-            html_parts.append('        </div>')
+            if len(entries) > self.page_size:
+                yield (f'        <div id="gridSentinel" class="grid-sentinel" data-offset="{self.page_size}" '
+                       f'data-limit="{self.page_size}" data-total="{len(entries)}" '
+                       f'data-sort="{sort}"></div>')
         
-        html_parts.extend([
+        yield from [
             '    </div>',
             '',
             # Modal HTML
@@ -613,299 +1138,119 @@ class ThumbnailHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
             '  </div>',
             '</div>',
             '',
-            '    <script>',
-            '        (function(){',
-            '            // Utilities',
-            '            const q = s => document.querySelector(s);',
-            '            const qa = s => Array.from(document.querySelectorAll(s));',
-            '',
-            '            document.addEventListener("DOMContentLoaded", function () {',
-            '                // Fade-in stagger',
-            '                const items = document.querySelectorAll(".fade-in");',
-            '                items.forEach((item, index) => {',
-            '                    item.style.animationDelay = (index * 0.1) + "s";',
-            '                });',
-            '',
-            '                // Lazy thumb animations',
-            '                qa(".thumbnail").forEach(img => {',
-            '                    img.addEventListener("load", function () { this.style.opacity = "1"; });',
-            '                    img.addEventListener("error", function () { this.style.display = "none"; this.nextElementSibling.style.display = "block"; });',
-            '                    img.style.opacity = "0";',
-            '                    img.style.transition = "opacity 0.3s ease";',
-            '                });',
-            '',
-            '                // Modal elements',
-            '                const modal = q("#imgModal");',
-            '                const modalImg = q("#modalImg");',
-            '                const modalCaption = q("#modalCaption");',
-            '                const closeBtn = q("#modalClose");',
-            '                const prevBtn = q("#modalPrev");',
-            '                const nextBtn = q("#modalNext");',
-            '                const slideshowBtn = q("#slideshowBtn");',
-            '                const zoomResetBtn = q("#zoomResetBtn");',
-            '',
-            '                const thumbnails = qa(".thumbnail");',
-            '                let currentIndex = 0;',
-            '',
-            '                // Zoom & pan state',
-            '                let scale = 1, minScale = 1, maxScale = 5;',
-            '                let translateX = 0, translateY = 0;',
-            '                let isPanning = false, startX = 0, startY = 0;',
-            '',
-            '                // Slideshow state',
-            '                let slideshowInterval = null;',
-            '                const SLIDE_DELAY = 3000; // 3s per slide',
-            '',
-            '                function resetTransform() {',
-            '                    scale = 1; translateX = 0; translateY = 0;',
-            '                    applyTransform();',
-            '                }',
-            '',
-            '                function applyTransform() {',
-            '                    modalImg.style.transform = `translate(${translateX}px, ${translateY}px) scale(${scale})`;',
-            '                }',
-            '',
-            '                function openModal(index) {',
-            '                    if (thumbnails.length === 0) return;',
-            '                    currentIndex = (index + thumbnails.length) % thumbnails.length;',
-            '                    const thumb = thumbnails[currentIndex];',
-            '                    const full = thumb.dataset.full || thumb.src;',
-            '                    modalImg.src = full;',
-            '                    modalImg.alt = thumb.alt || "";',
-            '                    modalCaption.textContent = thumb.alt || "";',
-            '                    modal.style.display = "block";',
-            '                    modal.setAttribute("aria-hidden", "false");',
-            '                    resetTransform();',
-            '                    // focus for keyboard events',
-            '                    setTimeout(()=> modal.focus && modal.focus(), 50);',
-            '                }',
-            '',
-            '                function closeModal() {',
-            '                    modal.style.display = "none";',
-            '                    modal.setAttribute("aria-hidden", "true");',
-            '                    stopSlideshow();',
-            '                }',
-            '',
-            '                function showNext() {',
-            '                    openModal(currentIndex + 1);',
-            '                }',
-            '',
-            '                function showPrev() {',
-            '                    openModal(currentIndex - 1);',
-            '                }',
-            '',
-            '                // Thumbnail handlers',
-            '                thumbnails.forEach((thumb, index) => {',
-            '                    // Single click → modal open',
-            '                    thumb.addEventListener("click", function (event) {',
-            '                        event.preventDefault();',
-            '                        openModal(index);',
-            '                    });',
-            '',
-            '                    // Double-click → open image in new tab',
-            '                    thumb.addEventListener("dblclick", function (event) {',
-            '                        event.preventDefault();',
-            '                        const href = thumb.parentElement.parentElement.href || thumb.dataset.full || thumb.src;',
-            '                        window.open(href, "_blank");',
-            '                    });',
-            '                });',
-            '',
-            '                // Modal button events',
-            '                closeBtn.addEventListener("click", closeModal);',
-            '                prevBtn.addEventListener("click", showPrev);',
-            '                nextBtn.addEventListener("click", showNext);',
-            '',
-            '                // Keyboard navigation (← → Esc) and space toggles slideshow',
-            '                document.addEventListener("keydown", function(e) {',
-            '                    if (modal.style.display !== "block") return;',
-            '                    if (e.key === "ArrowRight") { showNext(); }',
-            '                    else if (e.key === "ArrowLeft") { showPrev(); }',
-            '                    else if (e.key === "Escape") { closeModal(); }',
-            '                    else if (e.key === " " || e.key === "Spacebar") { // space toggles slideshow',
-            '                        e.preventDefault();',
-            '                        toggleSlideshow();',
-            '                    }',
-            '                });',
-            '',
-            '                // Slideshow controls',
-            '                function startSlideshow() {',
-            '                    if (slideshowInterval) return;',
-            '                    slideshowBtn.classList.add("playing");',
-            '                    slideshowBtn.textContent = "⏸ Pause";',
-            '                    slideshowInterval = setInterval(showNext, SLIDE_DELAY);',
-            '                }',
-            '                function stopSlideshow() {',
-            '                    if (!slideshowInterval) return;',
-            '                    slideshowBtn.classList.remove("playing");',
-            '                    slideshowBtn.textContent = "▶ Play";',
-            '                    clearInterval(slideshowInterval); slideshowInterval = null;',
-            '                }',
-            '                function toggleSlideshow() {',
-            '                    if (slideshowInterval) stopSlideshow(); else startSlideshow();',
-            '                }',
-            '                slideshowBtn.addEventListener("click", toggleSlideshow);',
-            '                // Reset zoom button',
-            '                zoomResetBtn.addEventListener("click", resetTransform);',
-            '',
-            '                // Click on modal image toggles fullscreen',
-            '                modalImg.addEventListener("click", function(e) {',
-            '                    // If image is zoomed (scale>1), do nothing on click to avoid accidental fullscreen toggle',
-            '                    if (Math.abs(scale - 1) > 0.01) return;',
-            '                    toggleFullScreen();',
-            '                });',
-            '',
-            '                // Fullscreen helpers',
-            '                function toggleFullScreen() {',
-            '                    if (!document.fullscreenElement) {',
-            '                        if (modal.requestFullscreen) modal.requestFullscreen();',
-            '                        else if (modal.webkitRequestFullscreen) modal.webkitRequestFullscreen();',
-            '                    } else {',
-            '                        if (document.exitFullscreen) document.exitFullscreen();',
-            '                        else if (document.webkitExitFullscreen) document.webkitExitFullscreen();',
-            '                    }',
-            '                }',
-            '',
-            '                // Mouse wheel for zoom (desktop)',
-            '                modalImg.addEventListener("wheel", function(e) {',
-            '                    if (modal.style.display !== "block") return;',
-            '                    e.preventDefault();',
-            '                    const delta = -e.deltaY || e.wheelDelta;',
-            '                    const zoomFactor = delta > 0 ? 1.08 : 0.92;',
-            '                    const newScale = Math.min(maxScale, Math.max(minScale, scale * zoomFactor));',
-            '                    // adjust translate so zoom is centered at mouse position',
-            '                    const rect = modalImg.getBoundingClientRect();',
-            '                    const mx = e.clientX - rect.left;',
-            '                    const my = e.clientY - rect.top;',
-            '                    const dx = (mx - translateX) / scale;',
-            '                    const dy = (my - translateY) / scale;',
-            '                    translateX = mx - dx * newScale;',
-            '                    translateY = my - dy * newScale;',
-            '                    scale = newScale;',
-            '                    applyTransform();',
-            '                }, { passive: false });',
-            '',
-            '                // Drag to pan (mouse)',
-            '                modalImg.addEventListener("mousedown", function(e) {',
-            '                    if (scale <= 1) return;',
-            '                    isPanning = true;',
-            '                    startX = e.clientX - translateX;',
-            '                    startY = e.clientY - translateY;',
-            '                    modalImg.classList.add("grabbing");',
-            '                });',
-            '                document.addEventListener("mousemove", function(e) {',
-            '                    if (!isPanning) return;',
-            '                    translateX = e.clientX - startX;',
-            '                    translateY = e.clientY - startY;',
-            '                    applyTransform();',
-            '                });',
-            '                document.addEventListener("mouseup", function() {',
-            '                    isPanning = false; modalImg.classList.remove("grabbing");',
-            '                });',
-            '',
-            '                // Touch handling: pan, swipe, pinch-zoom',
-            '                let touchStartX = 0, touchStartY = 0, touchStartTime = 0;',
-            '                let lastTouchDistance = null;',
-            '                let isTouchPanning = false;',
-            '',
-            '                modalImg.addEventListener("touchstart", function(e) {',
-            '                    if (e.touches.length === 1) {',
-            '                        touchStartX = e.touches[0].clientX;',
-            '                        touchStartY = e.touches[0].clientY;',
-            '                        touchStartTime = Date.now();',
-            '                        isTouchPanning = (scale > 1);',
-            '                        startX = e.touches[0].clientX - translateX;',
-            '                        startY = e.touches[0].clientY - translateY;',
-            '                        lastTouchDistance = null;',
-            '                    } else if (e.touches.length === 2) {',
-            '                        lastTouchDistance = Math.hypot(',
-            '                            e.touches[0].clientX - e.touches[1].clientX,',
-            '                            e.touches[0].clientY - e.touches[1].clientY',
-            '                        );',
-            '                    }',
-            '                }, { passive: false });',
-            '',
-            '                modalImg.addEventListener("touchmove", function(e) {',
-            '                    if (e.touches.length === 1 && isTouchPanning) {',
-            '                        e.preventDefault();',
-            '                        translateX = e.touches[0].clientX - startX;',
-            '                        translateY = e.touches[0].clientY - startY;',
-            '                        applyTransform();',
-            '                    } else if (e.touches.length === 2) {',
-            '                        e.preventDefault();',
-            '                        const dist = Math.hypot(',
-            '                            e.touches[0].clientX - e.touches[1].clientX,',
-            '                            e.touches[0].clientY - e.touches[1].clientY',
-            '                        );',
-            '                        if (lastTouchDistance) {',
-            '                            const zoomFactor = dist / lastTouchDistance;',
-            '                            const newScale = Math.min(maxScale, Math.max(minScale, scale * zoomFactor));',
-            '                            // center between touches',
-            '                            const rect = modalImg.getBoundingClientRect();',
-            '                            const mx = (e.touches[0].clientX + e.touches[1].clientX)/2 - rect.left;',
-            '                            const my = (e.touches[0].clientY + e.touches[1].clientY)/2 - rect.top;',
-            '                            const dx = (mx - translateX) / scale;',
-            '                            const dy = (my - translateY) / scale;',
-            '                            translateX = mx - dx * newScale;',
-            '                            translateY = my - dy * newScale;',
-            '                            scale = newScale;',
-            '                            applyTransform();',
-            '                        }',
-            '                        lastTouchDistance = dist;',
-            '                    }',
-            '                }, { passive: false });',
-            '',
-            '                modalImg.addEventListener("touchend", function(e) {',
-            '                    // detect swipe left/right for quick navigation when not zooming',
-            '                    if (e.changedTouches.length === 1 && Math.abs(scale - 1) < 0.01) {',
-            '                        const dx = e.changedTouches[0].clientX - touchStartX;',
-            '                        const dt = Date.now() - touchStartTime;',
-            '                        if (dt < 500 && Math.abs(dx) > 60) {',
-            '                            if (dx < 0) showNext(); else showPrev();',
-            '                        } else {',
-            '                            // detect single tap vs double-tap for fullscreen toggle or open in new tab',
-            '                            const target = e.target;',
-            '                            // single tap: open fullscreen if not zoomed',
-            '                        }',
-            '                    }',
-            '                    // reset pinch state',
-            '                    lastTouchDistance = null; isTouchPanning = false;',
-            '                });',
-            '',
-            '                // Double-tap to zoom (mobile)',
-            '                let lastTap = 0;',
-            '                modalImg.addEventListener("touchend", function(e) {',
-            '                    const currentTime = Date.now();',
-            '                    const tapLength = currentTime - lastTap;',
-            '                    if (tapLength < 300 && tapLength > 0) {',
-            '                        // double tap -> toggle zoom between min and 2x (or maxScale)',
-            '                        if (scale <= 1.01) scale = Math.min(2, maxScale);',
-            '                        else scale = 1;',
-            '                        applyTransform();',
-            '                    }',
-            '                    lastTap = currentTime;',
-            '                });',
-            '',
-            '                // Prevent gestures outside modal from scrolling the body while modal open',
-            '                modal.addEventListener("touchmove", function(e){ if (modal.style.display === "block") e.preventDefault(); }, { passive:false });',
-            '',
-            '                // Accessibility: close on focus loss (optional) and trap focus could be added later',
-            '',
-            '                // Close when clicking outside image (but allow clicks on controls)',
-            '                modal.addEventListener("click", function(e) {',
-            '                    if (e.target === modal) closeModal();',
-            '                });',
-            '',
-            '                // Clean up image transforms when an image fails to load',
-            '                modalImg.addEventListener("error", function(){ resetTransform(); });',
-            '',
-            '            });',
-            '        })();',
-            '    </script>',
+            f'    <script src="{GALLERY_JS_ASSET.url}"></script>',
             '</body>',
             '</html>'
-        ])
+        ]
+    
+    def serve_metrics(self):
+        """Serve request, render and cache statistics in the Prometheus text format"""
+        body = self.metrics.exposition().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', METRICS_CONTENT_TYPE)
+        self.send_header('Content-Length', len(body))
+        self.send_header('Cache-Control', 'no-store')
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def serve_asset(self, path):
+        """Serve a versioned CSS/JS asset, gzip-compressed when the client accepts it"""
+        asset = ASSETS.get(path)
+        if asset is None:
+            self.send_error(404, "File not found")
+            return
+        
+        cache_control = 'public, max-age=31536000, immutable'
+        if self.is_not_modified(asset.etag, None):
+            self.send_not_modified(asset.etag, None, cache_control)
+            return
         
-        return '\n'.join(html_parts)
+        coding = self.choose_response_encoding(asset.compressed)
+        body = asset.compressed[coding] if coding else asset.body
+        self.send_response(200)
+        self.send_header('Content-Type', asset.content_type)
+        self.send_header('Content-Length', len(body))
+        if coding:
+            self.send_header('Content-Encoding', coding)
+        self.send_header('Vary', 'Accept-Encoding')
+        self.send_header('Cache-Control', cache_control)
+        self.send_header('ETag', asset.etag)
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def choose_response_encoding(self, available=None):
+        """Pick the content coding for this response from Accept-Encoding, or None"""
+        if not self.compression:
+            return None
+        return choose_encoding(self.headers.get('Accept-Encoding'), available)
+    
+    def serve_compressed_file(self, path):
+        """Serve a text file compressed; returns False to fall back to the plain handler"""
+        file_path = self.translate_path(path)
+        content_type = self.guess_type(file_path)
+        if not is_compressible_type(content_type):
+            return False
+        coding = self.choose_response_encoding()
+        if coding is None or 'Range' in self.headers:
+            return False
+        try:
+            st = os.stat(file_path)
+        except OSError:
+            return False
+        if not stat.S_ISREG(st.st_mode) or not MIN_COMPRESS_SIZE <= st.st_size <= MAX_COMPRESS_FILE_SIZE:
+            return False
+        
+        etag = 'W/"%x-%x"' % (st.st_mtime_ns, st.st_size)
+        if self.is_not_modified(etag, st.st_mtime):
+            self.send_not_modified(etag, st.st_mtime, 'no-cache')
+            return True
+        
+        with open(file_path, 'rb') as f:
+            body = compress(f.read(), coding)
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', len(body))
+        self.send_header('Content-Encoding', coding)
+        self.send_header('Vary', 'Accept-Encoding')
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', self.date_time_string(st.st_mtime))
+        self.end_headers()
+        self.wfile.write(body)
+        return True
+    
+    def is_not_modified(self, etag, mtime):
+        """Check the request's conditional headers against the current validators"""
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match is not None:
+            # If-None-Match takes precedence; compare weakly as RFC 9110 requires
+            opaque = etag[2:] if etag.startswith('W/') else etag
+            for candidate in if_none_match.split(','):
+                candidate = candidate.strip()
+                if candidate == '*' or (candidate[2:] if candidate.startswith('W/') else candidate) == opaque:
+                    return True
+            return False
+        
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since is not None and mtime is not None:
+            try:
+                since = email.utils.parsedate_to_datetime(if_modified_since)
+            except (TypeError, IndexError, OverflowError, ValueError):
+                return False
+            if since.tzinfo is None:
+                since = since.replace(tzinfo=datetime.timezone.utc)
+            # HTTP dates have whole-second resolution
+            return int(mtime) <= since.timestamp()
+        return False
+    
+    def send_not_modified(self, etag, mtime, cache_control=None):
+        """Send a 304 response carrying the current validators"""
+        self.send_response(304)
+        self.send_header('ETag', etag)
+        if mtime is not None:
+            self.send_header('Last-Modified', self.date_time_string(mtime))
+        if cache_control is not None:
+            self.send_header('Cache-Control', cache_control)
+        self.end_headers()
     
     def escape_html(self, text):
         """Escape HTML special characters"""
@@ -917,8 +1262,7 @@ class ThumbnailHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
     
     def is_image_file(self, filename):
         """Check if file is an image based on extension"""
-        image_extensions = {'.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tiff', '.tif', '.webp'}
-        return os.path.splitext(filename.lower())[1] in image_extensions
+        return os.path.splitext(filename.lower())[1] in IMAGE_EXTENSIONS
     
     def is_text_file(self, filename):
         """Check if file is likely a text file that should open in browser"""
@@ -953,51 +1297,340 @@ class ThumbnailHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
     def get_file_size(self, filepath):
         """Get human-readable file size"""
         try:
-            size = os.path.getsize(filepath)
-            for unit in ['B', 'KB', 'MB', 'GB']:
-                if size < 1024.0:
-                    return f"{size:.1f} {unit}"
-                size /= 1024.0
-            return f"{size:.1f} TB"
+            return self.format_file_size(os.path.getsize(filepath))
         except OSError:
             return "Unknown size"
+    
+    def format_file_size(self, size):
+        """Format a byte count as a human-readable size"""
+        if size is None:
+            return "Unknown size"
+        for unit in ['B', 'KB', 'MB', 'GB']:
+            if size < 1024.0:
+                return f"{size:.1f} {unit}"
+            size /= 1024.0
+        return f"{size:.1f} TB"
 
 
-def create_handler_class(thumbnail_size):
-    """Create a handler class with custom thumbnail size"""
+def create_handler_class(thumbnail_size, thumbnail_cache=None, memory_cache=None, render_pool=None,
+                         listing_index=None, page_size=DEFAULT_PAGE_SIZE, compression=True,
+                         compressed_cache=None, keepalive_timeout=DEFAULT_KEEPALIVE_TIMEOUT,
+                         max_keepalive_requests=DEFAULT_MAX_KEEPALIVE_REQUESTS, thumbnail_formats=(),
+                         sprites=False, metadata_index=None, metadata_indexer=None, stat_cache=None,
+                         metrics=None, tracer=None, access_log=None, private_paths=()):
+    """Create a handler class with custom thumbnail size and shared caches"""
+    render_flight = SingleFlight()
+    
     class CustomThumbnailHandler(ThumbnailHTTPRequestHandler):
         def __init__(self, *args, **kwargs):
-            super().__init__(*args, thumbnail_size=thumbnail_size, **kwargs)
+            super().__init__(*args, thumbnail_size=thumbnail_size,
+                             thumbnail_cache=thumbnail_cache,
+                             memory_cache=memory_cache,
+                             render_flight=render_flight,
+                             render_pool=render_pool,
+                             listing_index=listing_index,
+                             page_size=page_size,
+                             compression=compression,
+                             compressed_cache=compressed_cache,
+                             keepalive_timeout=keepalive_timeout,
+                             max_keepalive_requests=max_keepalive_requests,
+                             thumbnail_formats=thumbnail_formats,
+                             sprites=sprites,
+                             metadata_index=metadata_index,
+                             metadata_indexer=metadata_indexer,
+                             stat_cache=stat_cache,
+                             metrics=metrics,
+                             tracer=tracer,
+                             access_log=access_log,
+                             private_paths=private_paths, **kwargs)
     return CustomThumbnailHandler
 
 
-def main():
-    parser = argparse.ArgumentParser(description='Modern HTTP server with image thumbnails')
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] == ['prewarm']:
+        prewarm_main(argv[1:])
+        return
+    if argv[:1] == ['bench']:
+        # Imported here: the benchmark drives this module's handler
+        from .bench import main as bench_main
+        bench_main(argv[1:])
+        return
+    
+    parser = argparse.ArgumentParser(description='Modern HTTP server with image thumbnails',
+                                     epilog='Run "%(prog)s prewarm DIR" to fill the thumbnail cache '
+                                            'ahead of time, or "%(prog)s bench" to benchmark the '
+                                            'server on a synthetic corpus.')
     parser.add_argument('port', type=int, nargs='?', default=8000, 
                         help='Port to serve on (default: 8000)')
     parser.add_argument('--thumbnail-size', type=int, default=200,
                         help='Thumbnail size in pixels (default: 200)')
     parser.add_argument('--directory', '-d', default='.',
                         help='Directory to serve (default: current directory)')
+    parser.add_argument('--engine', choices=['threads', 'asyncio'], default='threads',
+                        help='Connection handling: a thread per connection, or one asyncio event '
+                             'loop for all connections with requests answered on the worker '
+                             'threads (default: threads)')
+    parser.add_argument('--workers', type=int, default=default_worker_count(),
+                        help='Number of worker threads serving requests '
+                             f'(default: {default_worker_count()})')
+    parser.add_argument('--queue-size', type=int, default=128,
+                        help='Maximum number of connections waiting for a worker (default: 128)')
+    parser.add_argument('--keepalive-timeout', type=float, default=DEFAULT_KEEPALIVE_TIMEOUT,
+                        help='Seconds an idle persistent connection is kept open '
+                             f'(default: {DEFAULT_KEEPALIVE_TIMEOUT:g})')
+    parser.add_argument('--max-keepalive-requests', type=int, default=DEFAULT_MAX_KEEPALIVE_REQUESTS,
+                        help='Requests answered on one connection before it is closed, 1 disables '
+                             f'keep-alive (default: {DEFAULT_MAX_KEEPALIVE_REQUESTS})')
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR,
+                        help='Thumbnail cache directory, relative to the served directory '
+                             f'(default: {DEFAULT_CACHE_DIR})')
+    parser.add_argument('--cache-max-bytes', type=int, default=DEFAULT_CACHE_MAX_BYTES,
+                        help=f'Maximum size of the thumbnail cache in bytes (default: {DEFAULT_CACHE_MAX_BYTES})')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Disable the on-disk thumbnail cache')
+    parser.add_argument('--memory-cache-bytes', type=int, default=DEFAULT_MEMORY_CACHE_BYTES,
+                        help='Byte budget of the in-memory thumbnail cache, 0 to disable '
+                             f'(default: {DEFAULT_MEMORY_CACHE_BYTES})')
+    parser.add_argument('--render-processes', type=int, default=0,
+                        help='Render thumbnails in N worker processes, 0 renders in the '
+                             'request thread (default: 0)')
+    parser.add_argument('--render-timeout', type=float, default=30.0,
+                        help='Seconds a single thumbnail render may take in a worker process '
+                             '(default: 30)')
+    parser.add_argument('--page-size', type=int, default=DEFAULT_PAGE_SIZE,
+                        help='Entries rendered per listing window; the rest load while scrolling '
+                             f'(default: {DEFAULT_PAGE_SIZE})')
+    parser.add_argument('--thumbnail-formats', default=','.join(supported_modern_formats()).lower(),
+                        help='Comma-separated thumbnail formats (avif, webp) offered to browsers that '
+                             'accept them, most preferred first; others get JPEG, or PNG for sources '
+                             'with transparency. "jpeg" disables them '
+                             f'(default: {",".join(supported_modern_formats()).lower() or "jpeg"})')
+    parser.add_argument('--sprites', action='store_true',
+                        help='Draw grid tiles from per-folder sprite sheets instead of one '
+                             'thumbnail request per image')
+    parser.add_argument('--metadata-db', default=None,
+                        help='SQLite file of the image metadata index, relative to the served '
+                             f'directory (default: {DEFAULT_METADATA_DB_NAME} in the cache directory)')
+    parser.add_argument('--metadata-rescan-interval', type=float, default=DEFAULT_RESCAN_INTERVAL,
+                        help='Seconds between incremental rescans of the tree for the metadata index '
+                             f'(default: {DEFAULT_RESCAN_INTERVAL:g})')
+    parser.add_argument('--no-metadata-index', action='store_true',
+                        help='Disable the metadata index (image dimensions, EXIF dates, date sorting '
+                             'by capture time)')
+    parser.add_argument('--watch', action='store_true',
+                        help='Watch the served tree for changes (inotify, or polling where that is '
+                             'unavailable) and trust cached file stats until a change is seen')
+    parser.add_argument('--watch-poll', action='store_true',
+                        help='Watch by polling even where inotify is available, e.g. on network '
+                             'filesystems')
+    parser.add_argument('--watch-poll-interval', type=float, default=DEFAULT_POLL_INTERVAL,
+                        help=f'Seconds between polling rescans (default: {DEFAULT_POLL_INTERVAL:g})')
+    parser.add_argument('--watch-rerender', action='store_true',
+                        help='With --watch, render thumbnails of new and changed images right away')
+    parser.add_argument('--no-metrics', action='store_true',
+                        help=f'Disable request instrumentation and the {METRICS_PATH} endpoint')
+    parser.add_argument('--access-log', default='-',
+                        help='File for JSON access and error records, relative to the served '
+                             'directory, or - for stderr (default: -)')
+    parser.add_argument('--access-log-sample', type=float, default=DEFAULT_HIT_SAMPLE_RATE,
+                        help='Share of successful thumbnail cache hits and revalidations that are '
+                             f'logged (default: {DEFAULT_HIT_SAMPLE_RATE:g})')
+    parser.add_argument('--access-log-max-bytes', type=int, default=0,
+                        help='Rotate the access log file once it reaches this size (default: never)')
+    parser.add_argument('--access-log-backups', type=int, default=DEFAULT_BACKUP_COUNT,
+                        help=f'Rotated access log files to keep (default: {DEFAULT_BACKUP_COUNT})')
+    parser.add_argument('--plain-log', action='store_true',
+                        help='Log every request as a plain text line on stderr as it is answered, '
+                             'instead of the JSON access log')
+    parser.add_argument('--profile', action='store_true',
+                        help=f'Profile requests from localhost that send the {PROFILE_HEADER} header '
+                             f'or the {PROFILE_QUERY_FLAG} query flag')
+    parser.add_argument('--profile-slow-ms', type=float, default=None,
+                        help='Write a trace of every request that takes at least this many milliseconds')
+    parser.add_argument('--profile-dir', default=None,
+                        help='Directory for request traces, relative to the served directory '
+                             f'(default: {DEFAULT_TRACE_DIR_NAME} in the cache directory)')
+    parser.add_argument('--profile-keep', type=int, default=DEFAULT_TRACE_KEEP,
+                        help=f'Number of newest traces to keep (default: {DEFAULT_TRACE_KEEP})')
+    parser.add_argument('--no-compression', action='store_true',
+                        help='Disable gzip/brotli compression of pages, JSON and text files')
+    parser.add_argument('--prewarm', action='store_true',
+                        help='Render missing thumbnails for the whole tree in the background')
+    parser.add_argument('--prewarm-rate', type=float, default=None,
+                        help='Maximum thumbnails prewarmed per second (default: unlimited)')
     
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     
     # Change to the specified directory
     os.chdir(args.directory)
     
+    # Open the on-disk thumbnail cache
+    thumbnail_cache = None
+    if not args.no_cache:
+        try:
+            thumbnail_cache = ThumbnailDiskCache(args.cache_dir, args.cache_max_bytes)
+        except OSError as e:
+            print(f"⚠️  Thumbnail cache disabled: {e}")
+    
+    memory_cache = ThumbnailMemoryCache(args.memory_cache_bytes) if args.memory_cache_bytes > 0 else None
+    
+    render_pool = None
+    if args.render_processes > 0:
+        render_pool = RenderPool(args.render_processes, args.render_timeout)
+    
+    # Modern thumbnail formats, limited to what this Pillow build can encode
+    thumbnail_formats = []
+    for name in filter(None, (part.strip().upper() for part in args.thumbnail_formats.split(','))):
+        if name in supported_modern_formats():
+            thumbnail_formats.append(name)
+        elif name != 'JPEG':
+            print(f"⚠️  Thumbnail format {name.lower()} is not supported by this Pillow build")
+    
+    # Requests and background failures go to the access log when there is one
+    access_log = None
+    if not args.plain_log:
+        try:
+            access_log = AccessLog(args.access_log, args.access_log_sample, args.access_log_max_bytes,
+                                   args.access_log_backups)
+        except OSError as e:
+            print(f"⚠️  Access log disabled, logging plain text to stderr: {e}")
+        else:
+            access_log.start()
+    
+    def error_reporter(source):
+        return functools.partial(access_log.error, source=source) if access_log is not None else None
+    
+    # Open the metadata index; it is filled by a background indexer
+    metadata_index = metadata_indexer = None
+    if not args.no_metadata_index:
+        db_path = args.metadata_db or os.path.join(args.cache_dir, DEFAULT_METADATA_DB_NAME)
+        try:
+            os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+            metadata_index = MetadataIndex(db_path)
+        except (OSError, sqlite3.Error) as e:
+            print(f"⚠️  Metadata index disabled: {e}")
+        else:
+            metadata_indexer = MetadataIndexer(metadata_index, interval=args.metadata_rescan_interval)
+    
+    # Watch the tree so file stats can be cached until something changes
+    listing_index = DirectoryIndex()
+    stat_cache = watcher = invalidator = None
+    if args.watch or args.watch_poll:
+        stat_cache = StatCache()
+        rerender = None
+        if args.watch_rerender and thumbnail_cache is not None:
+            rerender = Prewarmer(thumbnail_cache, (args.thumbnail_size,) + PREWARM_SIZES,
+                                 workers=1, render_pool=render_pool, progress_interval=math.inf,
+                                 output_format=thumbnail_formats[0] if thumbnail_formats else None,
+                                 on_error=error_reporter('watch-rerender'))
+        invalidator = CacheInvalidator(stat_cache, listing_index, thumbnail_cache, metadata_indexer,
+                                       rerender, sizes=(args.thumbnail_size, PREVIEW_SIZE) + THUMBNAIL_SIZES,
+                                       formats=tuple(thumbnail_formats) + ('JPEG', 'PNG'))
+        watcher = create_watcher('.', invalidator, args.watch_poll, args.watch_poll_interval,
+                                 on_error=error_reporter('watch'))
+    
     # Create handler class with custom thumbnail size
-    handler_class = create_handler_class(args.thumbnail_size)
+    compressed_cache = None if args.no_compression else CompressedResponseCache()
+    metrics = None
+    if not args.no_metrics:
+        metrics = Metrics()
+        metrics.add_cache('memory', memory_cache)
+        metrics.add_cache('disk', thumbnail_cache)
+        metrics.add_cache('compressed', compressed_cache)
+        metrics.add_cache('stat', stat_cache)
+    tracer = None
+    if args.profile or args.profile_slow_ms is not None:
+        trace_dir = args.profile_dir or os.path.join(args.cache_dir, DEFAULT_TRACE_DIR_NAME)
+        try:
+            tracer = Tracer(trace_dir, args.profile_slow_ms, args.profile, args.profile_keep)
+        except OSError as e:
+            print(f"⚠️  Request tracing disabled: {e}")
+    # The server's own files are never served, even when they sit in the served tree
+    private_paths = [args.cache_dir]
+    if metadata_index is not None:
+        private_paths.append(metadata_index.db_path)
+    if tracer is not None:
+        private_paths.append(tracer.directory)
+    if access_log is not None and access_log.path is not None:
+        private_paths.append(access_log.path)
+    private_paths = tuple(os.path.abspath(path) for path in private_paths)
+    handler_class = create_handler_class(args.thumbnail_size, thumbnail_cache, memory_cache, render_pool,
+                                         listing_index, args.page_size,
+                                         not args.no_compression, compressed_cache,
+                                         args.keepalive_timeout, args.max_keepalive_requests,
+                                         tuple(thumbnail_formats), args.sprites,
+                                         metadata_index, metadata_indexer, stat_cache, metrics, tracer,
+                                         access_log, private_paths)
     
     # Start server
-    with socketserver.TCPServer(("", args.port), handler_class) as httpd:
+    if args.engine == 'asyncio':
+        httpd = AsyncHTTPServer(("", args.port), handler_class, workers=args.workers,
+                                queue_size=args.queue_size, keepalive_timeout=args.keepalive_timeout)
+    else:
+        httpd = PooledTCPServer(("", args.port), handler_class,
+                                workers=args.workers, queue_size=args.queue_size)
+    if metrics is not None:
+        metrics.server = httpd
+    with httpd:
         print(f"🚀 Modern Gallery Server running at http://localhost:{args.port}")
         print(f"📁 Directory: {os.getcwd()}")
-        print(f"🖼️  Thumbnail size: {args.thumbnail_size}px")
+        print(f"🖼️  Thumbnail size: {args.thumbnail_size}px "
+              f"({', '.join(name.lower() for name in thumbnail_formats + ['JPEG'])})")
+        if thumbnail_cache is not None:
+            print(f"💾 Thumbnail cache: {os.path.abspath(thumbnail_cache.cache_dir)}")
+        print(f"🧵 Workers: {httpd.workers} (queue: {args.queue_size}, engine: {args.engine})")
+        if render_pool is not None:
+            print(f"⚙️  Render processes: {render_pool.processes}")
+        if metadata_index is not None:
+            print(f"🗂️  Metadata index: {os.path.abspath(metadata_index.db_path)}")
+        if watcher is not None:
+            print(f"👀 Watching for changes: {type(watcher).__name__}")
+        if tracer is not None:
+            print(f"🔬 Request traces: {os.path.abspath(tracer.directory)}")
+        if access_log is not None and access_log.path is not None:
+            print(f"📝 Access log: {os.path.abspath(access_log.path)}")
         print("Press Ctrl+C to stop the server")
+        
+        if args.prewarm:
+            if thumbnail_cache is None:
+                print("⚠️  --prewarm needs the thumbnail cache; skipping")
+            else:
+                # Back off whenever live requests are being answered or waiting
+                # for a worker; idle keep-alive connections don't count
+                sizes = (args.thumbnail_size,) + PREWARM_SIZES
+                # Warm the format most browsers will be sent
+                Prewarmer(thumbnail_cache, sizes, rate=args.prewarm_rate,
+                          render_pool=render_pool,
+                          output_format=thumbnail_formats[0] if thumbnail_formats else None,
+                          on_error=error_reporter('prewarm'),
+                          is_busy=lambda: httpd.active_requests > 0 or httpd.reclaim_idle_connections).start()
+        
+        if metadata_indexer is not None:
+            metadata_indexer.is_busy = lambda: httpd.active_requests > 0 or httpd.reclaim_idle_connections
+            metadata_indexer.start()
+        if watcher is not None:
+            if invalidator.rerender is not None:
+                invalidator.rerender.is_busy = (
+                    lambda: httpd.active_requests > 0 or httpd.reclaim_idle_connections)
+            watcher.start()
+        
         try:
             httpd.serve_forever()
         except KeyboardInterrupt:
             print("\n✨ Server stopped gracefully.")
+            if memory_cache is not None:
+                print(f"📊 Memory cache: {memory_cache.hits} hits, {memory_cache.misses} misses "
+                      f"({memory_cache.hit_ratio():.0%} hit ratio)")
+        finally:
+            if watcher is not None:
+                watcher.stop()
+            if metadata_indexer is not None:
+                metadata_indexer.stop()
+            if render_pool is not None:
+                render_pool.shutdown()
+            if access_log is not None:
+                access_log.stop()
 
 
 if __name__ == "__main__":
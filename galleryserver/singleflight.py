@@ -0,0 +1,52 @@
+import threading
+
+
+class _Call:
+    """An in-flight call whose result is shared by every waiter"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Collapse concurrent calls with the same key into a single execution.
+
+    The first caller for a key runs the function; callers arriving while it
+    is still running block and receive the same result (or exception).
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, *args, **kwargs):
+        """Run fn(*args, **kwargs) once per key among concurrent callers"""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn(*args, **kwargs)
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def in_flight(self):
+        """Number of keys currently being computed"""
+        with self._lock:
+            return len(self._calls)
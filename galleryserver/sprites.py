@@ -0,0 +1,114 @@
+import hashlib
+import io
+import math
+import os
+import urllib.parse
+
+from PIL import Image, ImageOps
+
+from .cache import RENDITION_VERSION
+from .render import IMAGE_EXTENSIONS, SAVE_OPTIONS
+
+# Every sheet is a grid of SPRITE_COLUMNS x SPRITE_ROWS cells. Cells have the
+# aspect ratio of the gallery's grid tiles and each image is cropped to fill
+# its cell, so a tile shows its cell as is and the layout depends only on an
+# image's position in the listing, never on its pixel size.
+SPRITE_COLUMNS = 8
+SPRITE_ROWS = 8
+SPRITE_CELL = (360, 240)
+SPRITE_BACKGROUND = (44, 44, 62)
+
+# Cells are cut from the per-image thumbnail of this size, which the regular
+# thumbnail caches (and the prewarmer) already hold
+SPRITE_SOURCE_SIZE = 640
+
+
+class SpriteSheet:
+    """One sheet of a directory's sprite layout: up to a grid's worth of images.
+
+    ``version`` follows the names, sizes and mtimes of the member entries,
+    so it is only as fresh as the listing they came from; see ``restat``.
+    """
+
+    def __init__(self, index, members):
+        self.index = index
+        self.members = members
+        self.rows = math.ceil(len(members) / SPRITE_COLUMNS)
+        identity = RENDITION_VERSION + '\0' + '\0'.join(f'{e.name}\0{e.size}\0{e.mtime!r}' for e in members)
+        # Changes whenever an image joins, leaves or changes
+        self.version = hashlib.sha256(identity.encode('utf-8')).hexdigest()[:16]
+
+    def restat(self, dir_path, stat=os.stat):
+        """Return this sheet with its members' sizes and mtimes read afresh.
+
+        Images edited in place leave the directory mtime, and so a cached
+        listing, unchanged. Members that can't be stat'ed are kept as listed.
+        """
+        members = []
+        for entry in self.members:
+            try:
+                st = stat(os.path.join(dir_path, entry.name))
+            except OSError:
+                members.append(entry)
+                continue
+            members.append(entry._replace(size=st.st_size, mtime=st.st_mtime))
+        return SpriteSheet(self.index, members)
+
+    def cache_key(self, dir_path, output_format):
+        parts = ('sprite', os.path.normpath(dir_path), self.version, output_format.upper(),
+                 '%dx%d' % SPRITE_CELL, str(SPRITE_COLUMNS))
+        return hashlib.sha256('\0'.join(parts).encode('utf-8')).hexdigest()
+
+    def url(self, url_path):
+        # Quoted so the URL can sit unescaped inside CSS url()
+        return f"{urllib.parse.quote(url_path, safe='/%')}?sprite={self.index}&v={self.version}"
+
+    def position(self, slot):
+        """CSS background-size and background-position showing one cell"""
+        column, row = slot % SPRITE_COLUMNS, slot // SPRITE_COLUMNS
+        x = column * 100 / (SPRITE_COLUMNS - 1) if SPRITE_COLUMNS > 1 else 0
+        y = row * 100 / (self.rows - 1) if self.rows > 1 else 0
+        return f'{SPRITE_COLUMNS * 100}% {self.rows * 100}%', f'{x:g}% {y:g}%'
+
+
+def sprite_layout(entries):
+    """Split a listing's images into sheets.
+
+    Returns the sheets and a {name: (sheet, slot)} dict. Sheets hold images
+    in listing order, so adding a file only changes the sheets from its
+    position on, and every image keeps its cached thumbnail.
+    """
+    images = [e for e in entries
+              if not e.is_dir and os.path.splitext(e.name.lower())[1] in IMAGE_EXTENSIONS]
+    per_sheet = SPRITE_COLUMNS * SPRITE_ROWS
+    sheets = []
+    placements = {}
+    for start in range(0, len(images), per_sheet):
+        sheet = SpriteSheet(len(sheets), images[start:start + per_sheet])
+        sheets.append(sheet)
+        for slot, entry in enumerate(sheet.members):
+            placements[entry.name] = (sheet, slot)
+    return sheets, placements
+
+
+def compose_sprite_sheet(thumbnails, output_format='JPEG'):
+    """Paste encoded thumbnails into one sheet image and return it encoded.
+
+    ``thumbnails`` holds one encoded thumbnail (or None for an image that
+    failed to render) per slot; failed slots stay background coloured.
+    """
+    rows = math.ceil(len(thumbnails) / SPRITE_COLUMNS)
+    cell_width, cell_height = SPRITE_CELL
+    sheet = Image.new('RGB', (SPRITE_COLUMNS * cell_width, rows * cell_height), SPRITE_BACKGROUND)
+    for slot, data in enumerate(thumbnails):
+        if data is None:
+            continue
+        with Image.open(io.BytesIO(data)) as thumb:
+            thumb = thumb.convert('RGBA')
+            cell = ImageOps.fit(thumb, SPRITE_CELL, Image.Resampling.LANCZOS)
+        box = ((slot % SPRITE_COLUMNS) * cell_width, (slot // SPRITE_COLUMNS) * cell_height)
+        sheet.paste(cell, box, cell)
+
+    img_bytes = io.BytesIO()
+    sheet.save(img_bytes, format=output_format, **SAVE_OPTIONS.get(output_format, {}))
+    return img_bytes.getvalue()
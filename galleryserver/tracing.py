@@ -0,0 +1,153 @@
+import contextlib
+import cProfile
+import datetime
+import io
+import json
+import os
+import pstats
+import threading
+import time
+
+PROFILE_HEADER = 'X-Gallery-Profile'
+PROFILE_QUERY_FLAG = '__profile'
+DEFAULT_TRACE_DIR_NAME = 'traces'
+DEFAULT_TRACE_KEEP = 200
+
+# Functions listed in the text summary written next to each cProfile dump
+PROFILE_SUMMARY_LINES = 40
+
+LOCAL_ADDRESSES = {'127.0.0.1', '::1', '::ffff:127.0.0.1'}
+
+# Returned by span() when no trace is being taken
+NULL_SPAN = contextlib.nullcontext()
+
+
+class Trace:
+    """Named, nested timings of one request, optionally with a cProfile run"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.spans = []
+        self.profiler = None
+        self.requested = False
+        self._depth = 0
+
+    @contextlib.contextmanager
+    def span(self, name):
+        start = time.perf_counter()
+        depth = self._depth
+        self._depth += 1
+        try:
+            yield
+        finally:
+            self._depth = depth
+            self.spans.append((name, depth, start - self.started, time.perf_counter() - start))
+
+    def add_stages(self, timings):
+        """Record consecutive stages timed elsewhere (say, in a render process), ending now"""
+        start = time.perf_counter() - self.started - sum(timings.values())
+        for name, seconds in timings.items():
+            self.spans.append((name, self._depth, start, seconds))
+            start += seconds
+
+
+class Tracer:
+    """Write traces of slow or explicitly profiled requests to a rotating directory.
+
+    With ``slow_ms`` set, every request records its spans and those that
+    take at least that long are written out. With ``on_demand``, requests
+    from localhost carrying the X-Gallery-Profile header or the
+    ``__profile`` query flag are also run under cProfile and always written.
+    Only the newest ``keep`` traces are kept.
+    """
+
+    def __init__(self, directory, slow_ms=None, on_demand=False, keep=DEFAULT_TRACE_KEEP):
+        self.directory = directory
+        self.slow_ms = slow_ms
+        self.on_demand = on_demand
+        self.keep = keep
+        # cProfile can only run one profile at a time
+        self._profile_lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def begin(self):
+        """Start the trace of a request, or return None if it isn't traced by default"""
+        return Trace() if self.slow_ms is not None else None
+
+    def profile_requested(self, handler, query_params):
+        if not self.on_demand or handler.client_address[0] not in LOCAL_ADDRESSES:
+            return False
+        return PROFILE_QUERY_FLAG in query_params or handler.headers.get(PROFILE_HEADER) is not None
+
+    def profile(self, handler, query_params, trace=None):
+        """Run the rest of a request under cProfile if it asked for that; returns its trace.
+
+        Only one request is profiled at a time; others that ask meanwhile
+        get a span-only trace.
+        """
+        if not self.profile_requested(handler, query_params):
+            return trace
+        trace = trace or Trace()
+        if self._profile_lock.acquire(blocking=False):
+            trace.profiler = cProfile.Profile()
+            trace.profiler.enable()
+        else:
+            trace.requested = True
+        return trace
+
+    def finish(self, trace, handler, route, status, seconds):
+        """End a trace; write it out if it was profiled or slow.
+
+        ``status`` is None when no request was answered (say, an idle
+        keep-alive connection closed); nothing is written then.
+        """
+        if trace.profiler is not None:
+            trace.profiler.disable()
+            self._profile_lock.release()
+        if status is None:
+            return
+        if (trace.profiler is None and not trace.requested
+                and (self.slow_ms is None or seconds * 1000 < self.slow_ms)):
+            return
+        try:
+            self.write(trace, handler, route, status, seconds)
+        except OSError as e:
+            handler.log_error("Error writing trace to %s: %s", self.directory, e)
+
+    def write(self, trace, handler, route, status, seconds):
+        now = datetime.datetime.now()
+        name = f"{now:%Y%m%d-%H%M%S-%f}-{route}-{round(seconds * 1000)}ms"
+        record = {
+            'time': now.isoformat(timespec='milliseconds'),
+            'client': handler.client_address[0],
+            'request': handler.requestline,
+            'route': route,
+            'status': status,
+            'duration_ms': round(seconds * 1000, 3),
+            'reason': 'requested' if trace.profiler is not None or trace.requested else 'slow',
+            'spans': [{'name': span_name, 'depth': depth, 'start_ms': round(start * 1000, 3),
+                       'duration_ms': round(duration * 1000, 3)}
+                      for span_name, depth, start, duration in sorted(trace.spans, key=lambda s: s[2])],
+        }
+        if trace.profiler is not None:
+            summary = io.StringIO()
+            stats = pstats.Stats(trace.profiler, stream=summary)
+            stats.sort_stats('cumulative').print_stats(PROFILE_SUMMARY_LINES)
+            record['profile'] = summary.getvalue()
+            record['profile_file'] = name + '.prof'
+            stats.dump_stats(os.path.join(self.directory, name + '.prof'))
+        with open(os.path.join(self.directory, name + '.json'), 'w', encoding='utf-8') as f:
+            json.dump(record, f, indent=2)
+        self.rotate()
+
+    def rotate(self):
+        """Delete the oldest traces beyond ``keep``"""
+        with self._write_lock:
+            traces = sorted(entry for entry in os.listdir(self.directory) if entry.endswith('.json'))
+            for old in traces[:max(0, len(traces) - self.keep)]:
+                for path in (old, old[:-len('.json')] + '.prof'):
+                    try:
+                        os.unlink(os.path.join(self.directory, path))
+                    except OSError:
+                        pass
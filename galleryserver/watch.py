@@ -0,0 +1,379 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import threading
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from .cache import thumbnail_cache_key
+from .prewarm import lower_thread_priority
+from .render import IMAGE_EXTENSIONS
+
+DEFAULT_POLL_INTERVAL = 2.0
+DEFAULT_STAT_CACHE_ENTRIES = 65536
+
+# inotify(7) event bits
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+              | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+
+_INOTIFY_EVENT = struct.Struct('iIII')
+
+# ``kind`` is 'created' (an entry appeared; a file may still be being
+# written), 'modified' (a file was written, touched or moved in), 'deleted'
+# or 'overflow' (events were lost; assume anything changed)
+ChangeEvent = namedtuple('ChangeEvent', ['kind', 'dir_path', 'name', 'is_dir'])
+
+
+class StatCache:
+    """os.stat results kept until a filesystem watcher reports a change.
+
+    Only valid while a watcher covers every cached path, so hidden paths
+    and paths outside the served tree are always stat'ed afresh. A stat
+    taken while an invalidation ran is not stored, so a late result can't
+    hide a change.
+    """
+
+    def __init__(self, max_entries=DEFAULT_STAT_CACHE_ENTRIES):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def stat(self, path):
+        key = os.path.normpath(path)
+        if os.path.isabs(key) or any(part.startswith('.') and part != '.' for part in key.split(os.sep)):
+            return os.stat(key)
+        with self._lock:
+            st = self._entries.get(key)
+            if st is not None:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return st
+            self.misses += 1
+            generation = self._generation
+        st = os.stat(key)
+        with self._lock:
+            if generation == self._generation:
+                self._entries[key] = st
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return st
+
+    def pop(self, path):
+        """Forget one path; returns its cached stat result, if any"""
+        with self._lock:
+            self._generation += 1
+            return self._entries.pop(os.path.normpath(path), None)
+
+    def invalidate_tree(self, dir_path):
+        """Forget a directory and everything cached below it"""
+        key = os.path.normpath(dir_path)
+        prefix = key + os.sep
+        with self._lock:
+            self._generation += 1
+            for path in [p for p in self._entries if p == key or p.startswith(prefix)]:
+                del self._entries[path]
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+
+def _visible_dirs(root):
+    """Yield root and every non-hidden directory below it"""
+    for dirpath, dirnames, _ in os.walk(root):
+        dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+        yield os.path.normpath(dirpath)
+
+
+class InotifyWatcher:
+    """Report changes under a directory tree with Linux inotify, through ctypes.
+
+    Every visible directory gets a watch; directories created or moved in
+    later are added as they appear. Hidden entries (the thumbnail cache
+    among them) are ignored. Directories that can't be watched are reported
+    to ``on_error(message)``, by default printed.
+    """
+
+    def __init__(self, root, on_change, on_error=None):
+        self.root = os.path.normpath(root)
+        self.on_change = on_change
+        self.on_error = on_error or print
+        self._stopped = threading.Event()
+        self._paths = {}
+        self._watches = {}
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+        self._rm_watch = libc.inotify_rm_watch
+        self._rm_watch.argtypes = (ctypes.c_int, ctypes.c_int)
+        self._fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1: ' + os.strerror(ctypes.get_errno()))
+        try:
+            self.add_tree(self.root)
+        except OSError:
+            os.close(self._fd)
+            raise
+
+    def add_tree(self, dir_path):
+        """Watch a directory and every visible directory below it"""
+        for path in _visible_dirs(dir_path):
+            wd = self._add_watch(self._fd, os.fsencode(path), WATCH_MASK)
+            if wd < 0:
+                errno = ctypes.get_errno()
+                if path == self.root or errno == 28:
+                    # ENOSPC: out of watches (fs.inotify.max_user_watches)
+                    raise OSError(errno, f'inotify_add_watch {path}: {os.strerror(errno)}')
+                continue
+            self._paths[wd] = path
+            self._watches[path] = wd
+
+    def remove_tree(self, dir_path):
+        """Drop the watches of a directory that moved away, and of everything below it"""
+        prefix = dir_path + os.sep
+        for path in [p for p in self._watches if p == dir_path or p.startswith(prefix)]:
+            wd = self._watches.pop(path)
+            self._paths.pop(wd, None)
+            self._rm_watch(self._fd, wd)
+
+    def read_events(self):
+        """Read and dispatch whatever events are queued"""
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = _INOTIFY_EVENT.unpack_from(data, offset)
+            offset += _INOTIFY_EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0')) or None
+            offset += length
+            self.dispatch(wd, mask, name)
+
+    def dispatch(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            self.on_change(ChangeEvent('overflow', self.root, None, True))
+            return
+        if mask & IN_IGNORED:
+            path = self._paths.pop(wd, None)
+            if path is not None and self._watches.get(path) == wd:
+                del self._watches[path]
+            return
+        dir_path = self._paths.get(wd)
+        if dir_path is None or name is None or name.startswith('.'):
+            # Self events are reported again, with a name, by the parent
+            return
+
+        is_dir = bool(mask & IN_ISDIR)
+        path = os.path.join(dir_path, name)
+        if mask & (IN_DELETE | IN_MOVED_FROM):
+            if is_dir:
+                self.remove_tree(path)
+            self.on_change(ChangeEvent('deleted', dir_path, name, is_dir))
+        elif is_dir and mask & (IN_CREATE | IN_MOVED_TO):
+            try:
+                self.add_tree(path)
+            except OSError as e:
+                self.on_error(f"Not watching {path}: {e}")
+            self.on_change(ChangeEvent('created', dir_path, name, True))
+            # Files may have landed before the watch was in place
+            for sub_dir in _visible_dirs(path):
+                try:
+                    with os.scandir(sub_dir) as it:
+                        for entry in it:
+                            if not entry.name.startswith('.') and entry.is_file():
+                                self.on_change(ChangeEvent('modified', sub_dir, entry.name, False))
+                except OSError:
+                    pass
+        elif mask & IN_CREATE:
+            self.on_change(ChangeEvent('created', dir_path, name, is_dir))
+        else:
+            self.on_change(ChangeEvent('modified', dir_path, name, is_dir))
+
+    def run(self):
+        try:
+            while not self._stopped.is_set():
+                ready, _, _ = select.select([self._fd], [], [], 1.0)
+                if ready:
+                    self.read_events()
+        finally:
+            os.close(self._fd)
+
+    def stop(self):
+        self._stopped.set()
+
+    def start(self):
+        """Watch in a background daemon thread"""
+        thread = threading.Thread(target=self.run, name='gallery-watch', daemon=True)
+        thread.start()
+        return thread
+
+
+class PollingWatcher:
+    """Report changes under a directory tree by rescanning it every ``interval`` seconds.
+
+    The fallback where inotify isn't available (other platforms, network
+    filesystems). New and changed files are both reported as 'modified'.
+    """
+
+    def __init__(self, root, on_change, interval=DEFAULT_POLL_INTERVAL):
+        self.root = os.path.normpath(root)
+        self.on_change = on_change
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._snapshot = self.scan()
+
+    def scan(self):
+        """Return {dir_path: {name: (is_dir, size, mtime_ns)}} for the visible tree"""
+        snapshot = {}
+        for dir_path in _visible_dirs(self.root):
+            entries = {}
+            try:
+                with os.scandir(dir_path) as it:
+                    for entry in it:
+                        if entry.name.startswith('.'):
+                            continue
+                        try:
+                            is_dir = entry.is_dir()
+                            st = entry.stat()
+                        except OSError:
+                            continue
+                        entries[entry.name] = (is_dir, 0 if is_dir else st.st_size,
+                                               0 if is_dir else st.st_mtime_ns)
+            except OSError:
+                continue
+            snapshot[dir_path] = entries
+        return snapshot
+
+    def poll(self):
+        """Rescan once and report the differences from the previous scan"""
+        snapshot = self.scan()
+        for dir_path, entries in snapshot.items():
+            old_entries = self._snapshot.get(dir_path, {})
+            for name, identity in entries.items():
+                if old_entries.get(name) != identity:
+                    kind = 'created' if identity[0] else 'modified'
+                    self.on_change(ChangeEvent(kind, dir_path, name, identity[0]))
+            for name, identity in old_entries.items():
+                if name not in entries:
+                    self.on_change(ChangeEvent('deleted', dir_path, name, identity[0]))
+        for dir_path, old_entries in self._snapshot.items():
+            if dir_path not in snapshot:
+                for name, identity in old_entries.items():
+                    self.on_change(ChangeEvent('deleted', dir_path, name, identity[0]))
+        self._snapshot = snapshot
+
+    def run(self):
+        lower_thread_priority()
+        while not self._stopped.wait(self.interval):
+            self.poll()
+
+    def stop(self):
+        self._stopped.set()
+
+    def start(self):
+        """Watch in a background daemon thread"""
+        thread = threading.Thread(target=self.run, name='gallery-watch', daemon=True)
+        thread.start()
+        return thread
+
+
+def create_watcher(root, on_change, poll=False, poll_interval=DEFAULT_POLL_INTERVAL, on_error=None):
+    """Watch root with inotify where possible, falling back to polling"""
+    if not poll and sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(root, on_change, on_error)
+        except (OSError, AttributeError) as e:
+            print(f"⚠️  inotify unavailable ({e}); polling every {poll_interval:g}s instead")
+    return PollingWatcher(root, on_change, poll_interval)
+
+
+class CacheInvalidator:
+    """Apply watcher events to the server's caches.
+
+    A change drops the cached stat results and the listing of the affected
+    directory, removes the changed file's thumbnails from the disk cache
+    (for the renditions its last known stat can name), queues the directory
+    for the metadata indexer, and, given a ``rerender`` prewarmer, renders
+    new and changed images again in the background.
+    """
+
+    def __init__(self, stat_cache, listing_index=None, thumbnail_cache=None, metadata_indexer=None,
+                 rerender=None, sizes=(), formats=()):
+        self.stat_cache = stat_cache
+        self.listing_index = listing_index
+        self.thumbnail_cache = thumbnail_cache
+        self.metadata_indexer = metadata_indexer
+        self.rerender = rerender
+        self.sizes = tuple(dict.fromkeys(sizes))
+        self.formats = tuple(dict.fromkeys(formats))
+        self._pending = set()
+        self._pending_lock = threading.Lock()
+        self._executor = None
+        if rerender is not None:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='gallery-rerender',
+                                                initializer=lower_thread_priority)
+
+    def __call__(self, event):
+        if event.kind == 'overflow':
+            self.stat_cache.clear()
+            if self.listing_index is not None:
+                self.listing_index.clear()
+            return
+
+        path = os.path.join(event.dir_path, event.name)
+        # The entry and its directory (whose mtime moved) are both stale
+        self.stat_cache.pop(event.dir_path)
+        if event.is_dir:
+            self.stat_cache.invalidate_tree(path)
+            if self.listing_index is not None:
+                self.listing_index.invalidate(path)
+        else:
+            self.discard_thumbnails(path, self.stat_cache.pop(path))
+        if self.listing_index is not None:
+            self.listing_index.invalidate(event.dir_path)
+
+        if event.is_dir or os.path.splitext(event.name.lower())[1] not in IMAGE_EXTENSIONS:
+            return
+        if self.metadata_indexer is not None:
+            self.metadata_indexer.request(event.dir_path)
+        if self._executor is not None and event.kind == 'modified':
+            with self._pending_lock:
+                if path in self._pending:
+                    return
+                self._pending.add(path)
+            self._executor.submit(self._rerender, path)
+
+    def discard_thumbnails(self, file_path, old_stat):
+        """Remove the cached renditions of a file's previous version"""
+        if self.thumbnail_cache is None or old_stat is None:
+            return
+        for size in self.sizes:
+            for output_format in self.formats:
+                self.thumbnail_cache.discard(thumbnail_cache_key(file_path, old_stat, size, output_format))
+
+    def _rerender(self, file_path):
+        with self._pending_lock:
+            self._pending.discard(file_path)
+        if os.path.isfile(file_path):
+            self.rerender.prewarm_file(file_path)